@@ -0,0 +1,286 @@
+import functools
+import logging
+import re
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pytz
+
+from ephemeris import BODIES, julian_day
+from generation_cache import normalize_place
+
+logger = logging.getLogger(__name__)
+
+BODY_NAMES = ('Солнце', 'Луна', 'Меркурий', 'Венера', 'Марс', 'Юпитер', 'Сатурн', 'Уран', 'Нептун', 'Плутон')
+# Знаки в родительном (15° Овна) и предложном (Солнце в Овне) падеже
+SIGNS_GENITIVE = ('Овна', 'Тельца', 'Близнецов', 'Рака', 'Льва', 'Девы', 'Весов', 'Скорпиона', 'Стрельца',
+                  'Козерога', 'Водолея', 'Рыб')
+SIGNS_PREPOSITIONAL = ('Овне', 'Тельце', 'Близнецах', 'Раке', 'Льве', 'Деве', 'Весах', 'Скорпионе', 'Стрельце',
+                       'Козероге', 'Водолее', 'Рыбах')
+
+# Аспекты: название, угол, орб для транзитов и вес
+ASPECTS = (('соединение', 0.0, 3.0, 1.0), ('секстиль', 60.0, 2.0, 0.6), ('квадрат', 90.0, 3.0, 0.9),
+           ('трин', 120.0, 3.0, 0.8), ('оппозиция', 180.0, 3.0, 0.9))
+_ASPECT_ANGLES = np.array([aspect[1] for aspect in ASPECTS])
+_ASPECT_ORBS = np.array([aspect[2] for aspect in ASPECTS])
+_ASPECT_WEIGHTS = np.array([aspect[3] for aspect in ASPECTS])
+# Значимость транзитных (медленные планеты важнее) и натальных (светила важнее) тел
+_TRANSIT_WEIGHTS = np.array([1.0, 0.6, 0.8, 0.8, 1.0, 1.2, 1.3, 1.1, 1.0, 1.0])
+_NATAL_WEIGHTS = np.array([1.3, 1.2, 1.0, 1.0, 1.0, 0.9, 0.9, 0.8, 0.8, 0.8])
+
+# Справочник городов: широта, долгота (восточная положительна), часовой пояс
+PLACES = {
+    'москва': (55.7558, 37.6173, 'Europe/Moscow'),
+    'санкт петербург': (59.9343, 30.3351, 'Europe/Moscow'),
+    'новосибирск': (55.0084, 82.9357, 'Asia/Novosibirsk'),
+    'екатеринбург': (56.8389, 60.6057, 'Asia/Yekaterinburg'),
+    'казань': (55.7961, 49.1064, 'Europe/Moscow'),
+    'нижний новгород': (56.2965, 43.9361, 'Europe/Moscow'),
+    'челябинск': (55.1644, 61.4368, 'Asia/Yekaterinburg'),
+    'самара': (53.1959, 50.1002, 'Europe/Samara'),
+    'омск': (54.9885, 73.3242, 'Asia/Omsk'),
+    'ростов на дону': (47.2357, 39.7015, 'Europe/Moscow'),
+    'уфа': (54.7388, 55.9721, 'Asia/Yekaterinburg'),
+    'красноярск': (56.0153, 92.8932, 'Asia/Krasnoyarsk'),
+    'воронеж': (51.6615, 39.2003, 'Europe/Moscow'),
+    'пермь': (58.0105, 56.2502, 'Asia/Yekaterinburg'),
+    'волгоград': (48.7080, 44.5133, 'Europe/Volgograd'),
+    'краснодар': (45.0355, 38.9753, 'Europe/Moscow'),
+    'саратов': (51.5336, 46.0343, 'Europe/Saratov'),
+    'тюмень': (57.1530, 65.5343, 'Asia/Yekaterinburg'),
+    'тольятти': (53.5078, 49.4204, 'Europe/Samara'),
+    'ижевск': (56.8526, 53.2045, 'Europe/Samara'),
+    'барнаул': (53.3548, 83.7698, 'Asia/Barnaul'),
+    'ульяновск': (54.3142, 48.4031, 'Europe/Ulyanovsk'),
+    'иркутск': (52.2870, 104.3050, 'Asia/Irkutsk'),
+    'хабаровск': (48.4827, 135.0838, 'Asia/Vladivostok'),
+    'ярославль': (57.6261, 39.8845, 'Europe/Moscow'),
+    'владивосток': (43.1155, 131.8855, 'Asia/Vladivostok'),
+    'махачкала': (42.9849, 47.5047, 'Europe/Moscow'),
+    'томск': (56.4847, 84.9482, 'Asia/Tomsk'),
+    'оренбург': (51.7682, 55.0970, 'Asia/Yekaterinburg'),
+    'кемерово': (55.3547, 86.0873, 'Asia/Novokuznetsk'),
+    'новокузнецк': (53.7557, 87.1099, 'Asia/Novokuznetsk'),
+    'рязань': (54.6269, 39.6916, 'Europe/Moscow'),
+    'астрахань': (46.3497, 48.0408, 'Europe/Astrakhan'),
+    'пенза': (53.1959, 45.0183, 'Europe/Moscow'),
+    'липецк': (52.6088, 39.5992, 'Europe/Moscow'),
+    'киров': (58.6036, 49.6680, 'Europe/Kirov'),
+    'калининград': (54.7104, 20.4522, 'Europe/Kaliningrad'),
+    'тула': (54.1931, 37.6173, 'Europe/Moscow'),
+    'курск': (51.7373, 36.1874, 'Europe/Moscow'),
+    'ставрополь': (45.0448, 41.9691, 'Europe/Moscow'),
+    'сочи': (43.5855, 39.7231, 'Europe/Moscow'),
+    'тверь': (56.8587, 35.9176, 'Europe/Moscow'),
+    'мурманск': (68.9585, 33.0827, 'Europe/Moscow'),
+    'архангельск': (64.5399, 40.5152, 'Europe/Moscow'),
+    'смоленск': (54.7826, 32.0453, 'Europe/Moscow'),
+    'белгород': (50.5997, 36.5983, 'Europe/Moscow'),
+    'владимир': (56.1290, 40.4070, 'Europe/Moscow'),
+    'чебоксары': (56.1439, 47.2489, 'Europe/Moscow'),
+    'якутск': (62.0355, 129.6755, 'Asia/Yakutsk'),
+    'магадан': (59.5638, 150.8035, 'Asia/Magadan'),
+    'южно сахалинск': (46.9591, 142.7380, 'Asia/Sakhalin'),
+    'петропавловск камчатский': (53.0452, 158.6483, 'Asia/Kamchatka'),
+    'симферополь': (44.9521, 34.1024, 'Europe/Simferopol'),
+    'севастополь': (44.6166, 33.5254, 'Europe/Simferopol'),
+    'минск': (53.9006, 27.5590, 'Europe/Minsk'),
+    'киев': (50.4501, 30.5234, 'Europe/Kiev'),
+    'харьков': (49.9935, 36.2304, 'Europe/Kiev'),
+    'одесса': (46.4825, 30.7233, 'Europe/Kiev'),
+    'днепр': (48.4647, 35.0462, 'Europe/Kiev'),
+    'кишинев': (47.0105, 28.8638, 'Europe/Chisinau'),
+    'рига': (56.9496, 24.1052, 'Europe/Riga'),
+    'вильнюс': (54.6872, 25.2797, 'Europe/Vilnius'),
+    'таллин': (59.4370, 24.7536, 'Europe/Tallinn'),
+    'алматы': (43.2220, 76.8512, 'Asia/Almaty'),
+    'астана': (51.1694, 71.4491, 'Asia/Almaty'),
+    'ташкент': (41.2995, 69.2401, 'Asia/Tashkent'),
+    'бишкек': (42.8746, 74.5698, 'Asia/Bishkek'),
+    'душанбе': (38.5598, 68.7870, 'Asia/Dushanbe'),
+    'баку': (40.4093, 49.8671, 'Asia/Baku'),
+    'ереван': (40.1792, 44.4991, 'Asia/Yerevan'),
+    'тбилиси': (41.7151, 44.8271, 'Asia/Tbilisi'),
+    'стамбул': (41.0082, 28.9784, 'Europe/Istanbul'),
+    'тель авив': (32.0853, 34.7818, 'Asia/Jerusalem'),
+    'берлин': (52.5200, 13.4050, 'Europe/Berlin'),
+    'париж': (48.8566, 2.3522, 'Europe/Paris'),
+    'лондон': (51.5074, -0.1278, 'Europe/London'),
+    'нью йорк': (40.7128, -74.0060, 'America/New_York'),
+}
+PLACE_ALIASES = {
+    'петербург': 'санкт петербург', 'спб': 'санкт петербург', 'питер': 'санкт петербург',
+    'ленинград': 'санкт петербург', 'свердловск': 'екатеринбург', 'горький': 'нижний новгород',
+    'куйбышев': 'самара', 'сталинград': 'волгоград', 'днепропетровск': 'днепр', 'алма ата': 'алматы',
+    'нур султан': 'астана', 'целиноград': 'астана', 'ростов': 'ростов на дону', 'мск': 'москва',
+}
+_PLACE_PREFIXES = re.compile(r'^(г|гор|город|пгт|пос|поселок|с|село|д|деревня) ')
+
+
+def find_place(place_of_birth):
+    """Координаты и часовой пояс места рождения из справочника (None, если места там нет)."""
+    parts = [place_of_birth] + re.split(r'[,(/]', place_of_birth)
+    for part in parts:
+        name = _PLACE_PREFIXES.sub('', normalize_place(part.replace('-', ' ')))
+        name = PLACE_ALIASES.get(name, name)
+        if name in PLACES:
+            return PLACES[name]
+    return None
+
+
+def house_angles(jd, latitude, longitude):
+    """Асцендент и MC (градусы эклиптики) для массивов юлианских дат и координат."""
+    jd = np.asarray(jd, dtype=np.float64)
+    obliquity = np.radians(23.4393 - 3.563e-7 * (jd - 2451543.5))
+    sidereal = np.radians((280.46061837 + 360.98564736629 * (jd - 2451545.0) + longitude) % 360.0)
+    latitude = np.radians(latitude)
+    midheaven = np.degrees(np.arctan2(np.sin(sidereal), np.cos(sidereal) * np.cos(obliquity))) % 360.0
+    ascendant = np.degrees(np.arctan2(np.cos(sidereal), -(np.sin(sidereal) * np.cos(obliquity)
+                                                           + np.tan(latitude) * np.sin(obliquity)))) % 360.0
+    return ascendant, midheaven
+
+
+def format_degree(longitude):
+    """15°23′ Овна."""
+    sign, within = divmod(longitude, 30.0)
+    degrees, minutes = divmod(int(within * 60), 60)
+    return f"{degrees}°{minutes:02d}′ {SIGNS_GENITIVE[int(sign) % 12]}"
+
+
+def sign_of(longitude):
+    return SIGNS_PREPOSITIONAL[int(longitude // 30) % 12]
+
+
+class NatalChart(NamedTuple):
+    longitudes: tuple
+    retrograde: tuple
+    # Асцендент и MC; None, если место рождения не найдено в справочнике
+    ascendant: Optional[float]
+    midheaven: Optional[float]
+
+
+class ChartEngine:
+    """Натальные карты и транзиты по таблице эфемерид без обращения к LLM.
+
+    Модель получает готовые положения и только толкует их. Дома считаются по
+    системе равных домов от Асцендента. Время рождения переводится в UT по
+    часовому поясу места рождения (с историческими переходами из базы pytz);
+    если места нет в справочнике, время считается по default_timezone, а дома
+    не рассчитываются.
+    """
+
+    def __init__(self, ephemeris, default_timezone='Europe/Moscow'):
+        self.ephemeris = ephemeris
+        self.default_timezone = default_timezone
+        self.natal = functools.lru_cache(maxsize=65536)(self._natal)
+        self._birth_moment = functools.lru_cache(maxsize=65536)(self._birth_moment_uncached)
+
+    def _birth_moment_uncached(self, date_of_birth, time_of_birth, place_of_birth):
+        """(юлианская дата, широта, долгота) рождения; широта и долгота NaN без места."""
+        try:
+            moment = datetime.strptime(f"{date_of_birth.strip()} {time_of_birth.strip()}", '%d.%m.%Y %H:%M')
+        except (ValueError, AttributeError):
+            return None
+        place = find_place(place_of_birth or '')
+        latitude, longitude, zone = place if place else (np.nan, np.nan, self.default_timezone)
+        jd = julian_day(pytz.timezone(zone).localize(moment))
+        if not self.ephemeris.covers(jd):
+            return None
+        return jd, latitude, longitude
+
+    def _natal(self, date_of_birth, time_of_birth, place_of_birth):
+        """Натальная карта или None, если данные рождения не разбираются или вне диапазона таблицы."""
+        birth = self._birth_moment(date_of_birth, time_of_birth, place_of_birth)
+        if birth is None:
+            return None
+        jd, latitude, longitude = birth
+        positions, speeds = self.ephemeris.positions(np.array([jd]))
+        ascendant = midheaven = None
+        if not np.isnan(latitude):
+            ascendant, midheaven = (float(angle[0]) for angle in house_angles([jd], latitude, longitude))
+        return NatalChart(tuple(float(value) for value in positions[0]),
+                          tuple(bool(speed < 0) for speed in speeds[0]), ascendant, midheaven)
+
+    def format_chart(self, chart):
+        """Положения карты для промпта."""
+        parts = []
+        for index, name in enumerate(BODY_NAMES):
+            text = f"{name} {format_degree(chart.longitudes[index])}"
+            if chart.retrograde[index] and BODIES[index] not in ('sun', 'moon'):
+                text += ", ретроградный"
+            if chart.ascendant is not None:
+                text += f", {int(((chart.longitudes[index] - chart.ascendant) % 360.0) // 30) + 1} дом"
+            parts.append(text)
+        if chart.ascendant is not None:
+            parts.append(f"Асцендент {format_degree(chart.ascendant)}")
+            parts.append(f"MC {format_degree(chart.midheaven)}")
+            return '; '.join(parts) + ". Дома - система равных домов от Асцендента."
+        return '; '.join(parts) + (". Асцендент и дома не рассчитаны: места рождения нет в справочнике, "
+                                   f"время рождения считается по часовому поясу {self.default_timezone}.")
+
+    def describe(self, date_of_birth, time_of_birth, place_of_birth):
+        """Текст натальной карты для промпта или пояснение, почему ее нет."""
+        chart = self.natal(date_of_birth, time_of_birth, place_of_birth)
+        if chart is None:
+            return "не рассчитана: данные рождения вне поддерживаемого диапазона или в неверном формате."
+        return self.format_chart(chart)
+
+    def daily_transits(self, users, date, timezone, top=3):
+        """Краткая натальная карта и главные транзитные аспекты на полдень date (ГГГГ-ММ-ДД, часовой
+        пояс pytz) для списка пользователей.
+
+        Положения и аспекты считаются одной векторной операцией по всем
+        пользователям (порциями, чтобы ограничить память). Возвращает словарь
+        user_id -> (натальная карта кратко, транзиты); пользователей с
+        неразборчивыми данными рождения в словаре нет.
+        """
+        noon = timezone.localize(datetime.strptime(f"{date} 12:00", '%Y-%m-%d %H:%M'))
+        transit, transit_speed = self.ephemeris.positions(np.array([julian_day(noon)]))
+        transit, transit_speed = transit[0], transit_speed[0]
+        retrograde = [BODY_NAMES[index] for index in range(2, len(BODIES)) if transit_speed[index] < 0]
+        common = f"Луна в {sign_of(transit[1])}"
+        if retrograde:
+            common += f"; ретроградны: {', '.join(retrograde)}"
+
+        ids, births = [], []
+        for user in users:
+            birth = self._birth_moment(user.get('date_of_birth') or '', user.get('time_of_birth') or '',
+                                       user.get('place_of_birth') or '')
+            if birth is not None:
+                ids.append(user['user_id'])
+                births.append(birth)
+        if not births:
+            return {}
+        births = np.array(births)
+        natal, _ = self.ephemeris.positions(births[:, 0])
+        ascendant, _ = house_angles(births[:, 0], births[:, 1], births[:, 2])
+
+        result = {}
+        chunk = 5000
+        for start in range(0, len(ids), chunk):
+            part = natal[start:start + chunk]
+            # Угловое расстояние транзит-натал для всех пар тел: (n, транзит, натал)
+            distance = np.abs((transit[None, :, None] - part[:, None, :] + 180.0) % 360.0 - 180.0)
+            deviation = np.abs(distance[..., None] - _ASPECT_ANGLES)
+            strength = np.where(deviation <= _ASPECT_ORBS, 1.0 - deviation / _ASPECT_ORBS, 0.0) * _ASPECT_WEIGHTS
+            aspect = strength.argmax(axis=-1)
+            score = strength.max(axis=-1) * _TRANSIT_WEIGHTS[None, :, None] * _NATAL_WEIGHTS[None, None, :]
+            flat = score.reshape(len(part), -1)
+            best = np.argsort(-flat, axis=1)[:, :top]
+            for row in range(len(part)):
+                index = start + row
+                lines = []
+                for pair in best[row]:
+                    if flat[row, pair] <= 0:
+                        break
+                    moving, fixed = divmod(int(pair), len(BODIES))
+                    name = ASPECTS[aspect[row, moving, fixed]][0]
+                    orb = deviation[row, moving, fixed, aspect[row, moving, fixed]]
+                    lines.append(f"{BODY_NAMES[moving]} (транзит) - {name} - {BODY_NAMES[fixed]} (натал), орб {orb:.0f}°")
+                brief = f"Солнце в {sign_of(part[row, 0])}, Луна в {sign_of(part[row, 1])}"
+                if not np.isnan(ascendant[index]):
+                    brief += f", Асцендент в {sign_of(ascendant[index])}"
+                transits = '; '.join(lines) if lines else "точных аспектов к натальной карте нет"
+                result[ids[index]] = (brief, f"{common}. {transits}")
+        return result
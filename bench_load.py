@@ -0,0 +1,309 @@
+"""Нагрузочный прогон бота на локальных заглушках Telegram Bot API и LLM.
+
+Поднимает FakeBotAPI и FakeLLMServer, собирает приложение тем же
+build_application, что и main(), и прогоняет через обработчики синтетический
+трафик: пользователи разных ролей, текстовые и голосовые сообщения, затем
+ежедневную рассылку. В конце печатает p50/p95/p99 времени обработки по типам
+обновлений, пропускную способность, процессорное время и запись на диск в
+расчете на одно обновление, а также число обращений к внешним API.
+
+Запуск: python bench_load.py --users 1000 --messages 3 --llm-latency 1.0
+Данные бота пишутся во временный каталог (или в --workdir).
+"""
+import argparse
+import asyncio
+import io
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from fake_backends import FakeBotAPI, FakeLLMServer, LatencyModel, start_server
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+QUESTIONS = (
+    "Что меня ждет в отношениях в ближайший месяц?",
+    "Стоит ли мне менять работу?",
+    "Как справиться с тревогой перед важным разговором?",
+    "Какие шаги помогут мне в карьере?",
+    "Что мешает мне достичь цели?",
+)
+
+ROLE_WEIGHTS = {
+    'tarot': 30, 'astrology': 20, 'numerology': 15,
+    'psychologist': 15, 'career_consultant': 10, 'self_development_coach': 10,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help="число синтетических пользователей")
+    parser.add_argument('--messages', type=int, default=3, help="вопросов на пользователя")
+    parser.add_argument('--voice-share', type=float, default=0.1, help="доля вопросов голосом")
+    parser.add_argument('--ramp', type=float, default=10.0, help="за сколько секунд приходят все пользователи")
+    parser.add_argument('--think', type=float, default=1.0, help="средняя пауза пользователя между сообщениями, с")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="задержка LLM до первого токена, с")
+    parser.add_argument('--llm-jitter', type=float, default=0.5, help="разброс задержки LLM, с")
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help="пауза между фрагментами потока LLM, с")
+    parser.add_argument('--completion-tokens', type=int, default=120, help="длина ответа LLM в словах")
+    parser.add_argument('--tg-latency', type=float, default=0.03, help="задержка Bot API, с")
+    parser.add_argument('--tg-jitter', type=float, default=0.02, help="разброс задержки Bot API, с")
+    parser.add_argument('--no-broadcast', action='store_true', help="не запускать рассылку после трафика")
+    parser.add_argument('--broadcast-rate', type=float, default=1000, help="лимит отправки рассылки, сообщений/с")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help="каталог для данных бота (по умолчанию временный)")
+    parser.add_argument('--verbose', action='store_true', help="не приглушать логи бота")
+    return parser.parse_args()
+
+
+def make_voice_bytes():
+    """Секунда тишины в OGG. Нужен ffmpeg, как и для настоящих голосовых."""
+    try:
+        from pydub import AudioSegment
+        buffer = io.BytesIO()
+        AudioSegment.silent(duration=1000).export(buffer, format='ogg')
+        return buffer.getvalue()
+    except Exception as e:
+        print(f"Голосовые сообщения отключены: не удалось подготовить OGG ({e})")
+        return None
+
+
+def configure_environment(args, workdir, bot_port, llm_port):
+    """Переменные окружения бота до импорта tarot_bot: все данные - в workdir, внешние API - заглушки."""
+    os.environ.update({
+        'TELEGRAM_TOKEN': '123456:LOADTEST',
+        'PROXY_API_URL': f'http://127.0.0.1:{llm_port}/v1/chat/completions',
+        'PROXY_API_KEY': 'loadtest',
+        'MODEL_NAME': 'loadtest',
+        'MAX_TOKENS': '500',
+        'TEMPERATURE': '0.7',
+        'CHANNEL_IDS': '@loadtest',
+        'ADMIN_CHAT_ID': '1',
+        'USER_DB_FILE': os.path.join(workdir, 'bot_data.db'),
+        'CHAT_HISTORY_LOG_FILE': os.path.join(workdir, 'chat_history.log'),
+        'BROADCAST_PROGRESS_FILE': os.path.join(workdir, 'broadcast_progress.jsonl'),
+        'QUOTA_SNAPSHOT_FILE': os.path.join(workdir, 'quota_snapshot.json'),
+        'QUOTA_DEFAULT_LIMIT': '-1',
+        'VOICE_RECOGNIZER': 'stub',
+        'BROADCAST_RATE': str(args.broadcast_rate),
+        'BROADCAST_DRY_RUN': 'false',
+    })
+    shutil.copy(os.path.join(REPO_DIR, 'stop_words.txt'), workdir)
+
+
+class UpdateFactory:
+    """Собирает JSON обновлений Telegram для синтетических пользователей."""
+
+    def __init__(self):
+        self._update_id = 0
+        self._message_id = 0
+
+    def _next(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def _message(self, user_id, **fields):
+        update_id, message_id = self._next()
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), **fields}
+        return {'update_id': update_id, 'message': message}
+
+    def text(self, user_id, text):
+        if text.startswith('/'):
+            return self._message(user_id, text=text, entities=[{'type': 'bot_command', 'offset': 0, 'length': len(text)}])
+        return self._message(user_id, text=text)
+
+    def voice(self, user_id, duration=1):
+        file_id = f'voice{self._update_id + 1}'
+        return self._message(user_id, voice={'file_id': file_id, 'file_unique_id': file_id, 'duration': duration})
+
+    def callback(self, user_id, data):
+        update_id, message_id = self._next()
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': user_id, 'type': 'private'}, 'from': {'id': 1, 'is_bot': True, 'first_name': 'Бот'},
+                   'text': "Выберите методику"}
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': self._user(user_id), 'chat_instance': str(user_id),
+            'data': data, 'message': message}}
+
+
+def user_script(role, args, rng, voice_enabled):
+    """Последовательность (тип, аргументы) обновлений одного пользователя."""
+    script = [('command', '/start'), ('command', f'/{role}')]
+    if role == 'psychologist':
+        script.append(('callback', rng.choice(('cbt', 'psychodynamic', 'gestalt', 'unsure'))))
+    if role in ('astrology', 'numerology'):
+        script.append(('birth_data', f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{rng.randint(1960, 2005)}"))
+    if role == 'astrology':
+        script.append(('birth_data', f"{rng.randint(0, 23):02d}:{rng.choice((0, 15, 30, 45)):02d}"))
+        script.append(('birth_data', rng.choice(("Казань", "Москва", "Выборг, Ленинградская обл."))))
+    for _ in range(args.messages):
+        if voice_enabled and rng.random() < args.voice_share:
+            script.append(('voice', None))
+        else:
+            script.append(('text', rng.choice(QUESTIONS)))
+    return script
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def io_counters():
+    """Байты и число системных вызовов записи процесса (Linux), иначе нули."""
+    try:
+        with open('/proc/self/io') as file:
+            fields = dict(line.split(': ') for line in file.read().splitlines())
+        return int(fields['wchar']), int(fields['syscw'])
+    except OSError:
+        return 0, 0
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_load_')
+    os.makedirs(workdir, exist_ok=True)
+
+    voice_bytes = make_voice_bytes() if args.voice_share > 0 else None
+    bot_api = FakeBotAPI(LatencyModel(args.tg_latency, args.tg_jitter, random.Random(args.seed)), voice_bytes or b'')
+    llm = FakeLLMServer(LatencyModel(args.llm_latency, args.llm_jitter, random.Random(args.seed + 1)),
+                        chunk_delay=args.chunk_delay, completion_tokens=args.completion_tokens, seed=args.seed)
+    bot_runner, bot_port = await start_server(bot_api.app)
+    llm_runner, llm_port = await start_server(llm.app)
+
+    configure_environment(args, workdir, bot_port, llm_port)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import tarot_bot
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, CallbackContext
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+
+    application = tarot_bot.build_application(
+        ApplicationBuilder()
+        .base_url(f'http://127.0.0.1:{bot_port}/bot')
+        .base_file_url(f'http://127.0.0.1:{bot_port}/file/bot')
+    )
+    await application.initialize()
+    await application.start()
+
+    factory = UpdateFactory()
+    latencies = defaultdict(list)
+
+    async def process(kind, data):
+        started = time.perf_counter()
+        await application.process_update(Update.de_json(data, application.bot))
+        latencies[kind].append(time.perf_counter() - started)
+
+    async def simulate_user(user_id, role, script, user_rng):
+        await asyncio.sleep(user_rng.random() * args.ramp)
+        for kind, value in script:
+            if kind == 'callback':
+                data = factory.callback(user_id, value)
+            elif kind == 'voice':
+                data = factory.voice(user_id)
+            else:
+                data = factory.text(user_id, value)
+            await process(f"{kind}:{role}" if kind in ('text', 'voice') else kind, data)
+            await asyncio.sleep(user_rng.expovariate(1 / args.think) if args.think > 0 else 0)
+
+    roles = list(ROLE_WEIGHTS)
+    weights = [ROLE_WEIGHTS[role] for role in roles]
+    users = []
+    for index in range(args.users):
+        role = rng.choices(roles, weights)[0]
+        users.append((100000 + index, role, user_script(role, args, rng, voice_bytes is not None),
+                      random.Random(rng.random())))
+
+    print(f"Пользователей: {args.users}, данные: {workdir}")
+    wchar_before, syscw_before = io_counters()
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(*user) for user in users))
+    traffic_seconds = time.perf_counter() - started
+    cpu_used = cpu_seconds() - cpu_before
+    wchar_after, syscw_after = io_counters()
+    # Отложенная запись на диск тоже часть стоимости обновлений
+    await tarot_bot.flush_user_cache(None)
+    wchar_flushed, syscw_flushed = io_counters()
+
+    total_updates = sum(len(values) for values in latencies.values())
+    print(f"\n{'тип обновления':<32} {'кол-во':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for kind in sorted(latencies):
+        values = latencies[kind]
+        print(f"{kind:<32} {len(values):>7} {percentile(values, 0.5) * 1000:>9.1f} "
+              f"{percentile(values, 0.95) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f}")
+    all_values = [value for values in latencies.values() for value in values]
+    print(f"{'все':<32} {total_updates:>7} {percentile(all_values, 0.5) * 1000:>9.1f} "
+          f"{percentile(all_values, 0.95) * 1000:>9.1f} {percentile(all_values, 0.99) * 1000:>9.1f}")
+
+    per_update = max(total_updates, 1)
+    print(f"\nПропускная способность: {total_updates / traffic_seconds:.1f} обновлений/с за {traffic_seconds:.1f} с")
+    print(f"Процессорное время: {cpu_used / per_update * 1000:.2f} мс на обновление")
+    print(f"Запись: {(wchar_after - wchar_before) / per_update:.0f} байт и {(syscw_after - syscw_before) / per_update:.2f} "
+          f"вызовов write на обновление, отложенный сброс: {wchar_flushed - wchar_after} байт, "
+          f"{syscw_flushed - syscw_after} вызовов")
+    print(f"Обращения к Bot API: {dict(bot_api.calls)}")
+    print(f"Обращения к LLM: {dict(llm.calls)}")
+    print(f"Ошибок в логе: {errors.count}")
+
+    if not args.no_broadcast:
+        subscribed = len(tarot_bot.user_cache.subscribed_users())
+        llm_before = sum(llm.calls.values())
+        sent_before = bot_api.calls['sendMessage']
+        cpu_before = cpu_seconds()
+        started = time.perf_counter()
+        await tarot_bot.send_daily_horoscopes(CallbackContext(application))
+        broadcast_seconds = time.perf_counter() - started
+        print(f"\nРассылка: {subscribed} подписчиков за {broadcast_seconds:.1f} с, "
+              f"отправлено {bot_api.calls['sendMessage'] - sent_before}, "
+              f"запросов к LLM {sum(llm.calls.values()) - llm_before}, "
+              f"процессорное время {(cpu_seconds() - cpu_before) * 1000:.0f} мс")
+
+    await application.stop()
+    await application.shutdown()
+    await tarot_bot.on_shutdown(application)
+    await bot_runner.cleanup()
+    await llm_runner.cleanup()
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == '__main__':
+    main()
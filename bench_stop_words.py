@@ -0,0 +1,45 @@
+"""Сравнение скорости проверки стоп-слов: старое регулярное выражение против автомата Ахо-Корасик.
+
+Запуск: python bench_stop_words.py [путь к файлу стоп-слов]
+"""
+import random
+import re
+import sys
+import timeit
+from stop_words import StopWordsFilter
+
+SAMPLE_WORDS = ("что меня ждет в ближайшем будущем в отношениях карьера коллеги деньги любовь "
+                "здоровье семья решение ситуация путь друзья переезд учеба выбор год месяц").split()
+
+
+def create_stop_words_regex(stop_words):
+    """Прежняя реализация: одна альтернация из всех стоп-слов с IGNORECASE."""
+    return re.compile('|'.join(map(re.escape, stop_words)), re.IGNORECASE)
+
+
+def make_message(length, rng):
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(rng.choice(SAMPLE_WORDS))
+    return ' '.join(words)
+
+
+def main():
+    file_path = sys.argv[1] if len(sys.argv) > 1 else 'stop_words.txt'
+    with open(file_path, 'r', encoding='utf-8') as file:
+        stop_words = {line.strip() for line in file if line.strip()}
+    regex = create_stop_words_regex(stop_words)
+    stop_words_filter = StopWordsFilter(file_path, check_interval=3600)
+
+    rng = random.Random(42)
+    print(f"{'длина':>8} {'regex, мс':>12} {'ahocorasick, мс':>16} {'ускорение':>10}")
+    for length in (100, 1000, 4000, 16000):
+        message = make_message(length, rng)
+        runs = max(10, 20000 // length)
+        regex_time = timeit.timeit(lambda: regex.search(message), number=runs) / runs * 1000
+        filter_time = timeit.timeit(lambda: stop_words_filter.find(message), number=runs) / runs * 1000
+        print(f"{length:>8} {regex_time:>12.3f} {filter_time:>16.3f} {regex_time / filter_time:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Асинхронный token bucket: не больше rate событий в секунду с запасом capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Обнуляет запас после ответа 429, чтобы все отправители подождали."""
+        self._tokens = -seconds * self.rate
+        self._updated = time.monotonic()
+
+
+class SendLimiter:
+    """Общий лимит Telegram на отправку плюс минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, global_rate=25, per_chat_interval=1.0):
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self._last_sent = {}
+
+    async def acquire(self, chat_id):
+        wait = self._last_sent.get(chat_id, 0) + self.per_chat_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.bucket.acquire()
+        self._last_sent[chat_id] = time.monotonic()
+
+
+class BroadcastProgress:
+    """Прогресс рассылки за дату в файле: по строке на обработанного пользователя.
+
+    После перезапуска уже обработанные пользователи пропускаются. Пользователи,
+    которым не удалось отправить из-за временных ошибок, записываются со статусом
+    retry и при следующем запуске рассылки получают ее снова; пока такие есть,
+    рассылка за дату не считается завершенной. Отметки копятся в памяти и пишутся
+    в файл пачками (каждые flush_every пользователей или flush_interval секунд)
+    в отдельном потоке. Без file_path прогресс хранится только в памяти (пробный прогон).
+    """
+
+    def __init__(self, file_path=None, flush_every=100, flush_interval=5.0):
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.date = None
+        self.done = set()
+        self.failed = set()
+        self.started = False
+        self.completed = False
+        self._buffer = []
+        self._flushed_at = time.monotonic()
+        self._flush_lock = asyncio.Lock()
+
+    def load(self, date):
+        self.date = date
+        self.done = set()
+        self.failed = set()
+        self.started = False
+        self.completed = False
+        self._buffer = []
+        if not self.file_path or not os.path.exists(self.file_path):
+            return
+        with open(self.file_path, 'r', encoding='utf-8') as file:
+            lines = [json.loads(line) for line in file if line.endswith('\n')]
+        if not lines or lines[0].get('date') != date:
+            return
+        self.started = True
+        for record in lines[1:]:
+            if record.get('completed'):
+                self.completed = True
+            elif record.get('status') == 'retry':
+                self.failed.add(record['user_id'])
+            else:
+                self.done.add(record['user_id'])
+                self.failed.discard(record['user_id'])
+
+    async def start(self):
+        if not self.started:
+            self.started = True
+            await self._write_records([{'date': self.date}], mode='w')
+
+    @property
+    def interrupted(self):
+        """Рассылка за дату начиналась, но не была завершена."""
+        return self.started and not self.completed
+
+    async def mark(self, user_id, status):
+        if status == 'retry':
+            self.failed.add(user_id)
+        else:
+            self.done.add(user_id)
+            self.failed.discard(user_id)
+        self._buffer.append({'user_id': user_id, 'status': status})
+        if len(self._buffer) >= self.flush_every or time.monotonic() - self._flushed_at >= self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            records, self._buffer = self._buffer, []
+            self._flushed_at = time.monotonic()
+            if records:
+                await self._write_records(records)
+
+    async def finish(self):
+        """Сбрасывает отметки на диск. Рассылка завершена, только если не осталось пользователей для повтора."""
+        if not self.failed:
+            self.completed = True
+            self._buffer.append({'completed': True})
+        await self.flush()
+
+    async def _write_records(self, records, mode='a'):
+        if self.file_path:
+            await asyncio.to_thread(self._write, records, mode)
+
+    def _write(self, records, mode):
+        with open(self.file_path, mode, encoding='utf-8') as file:
+            file.write(''.join(json.dumps(record) + '\n' for record in records))
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class DryRunBot:
+    """Заглушка бота для пробной рассылки: сообщения только запоминаются."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class HoroscopeBroadcaster:
+    """Рассылка ежедневных гороскопов.
+
+    generate(user, date) - корутина, возвращающая текст для пользователя. Тексты
+    генерируются не более чем в concurrency задач одновременно, а отправка идет
+    через SendLimiter с повтором при 429 и экспоненциальной задержкой при сетевых
+    ошибках. Пользователи, которым не удалось отправить из-за временных ошибок
+    (сеть, генерация текста), учитываются в stats['retry'] и получат рассылку
+    при следующем запуске run на ту же дату.
+    """
+
+    def __init__(self, generate, progress_file, concurrency=5, global_rate=25, per_chat_interval=1.0,
+                 max_retries=3, base_delay=1.0, on_blocked=None):
+        self.generate = generate
+        self.progress_file = progress_file
+        self.concurrency = concurrency
+        self.limiter = SendLimiter(global_rate, per_chat_interval)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.on_blocked = on_blocked
+        self._running = False
+
+    async def run(self, bot, users, date, dry_run=False):
+        """Рассылает гороскопы на date. Возвращает статистику прогона."""
+        stats = {'sent': 0, 'failed': 0, 'blocked': 0, 'skipped': 0, 'retry': 0}
+        if self._running:
+            logger.warning("Рассылка уже выполняется, повторный запуск пропущен")
+            return stats
+        self._running = True
+        try:
+            progress = BroadcastProgress(None if dry_run else self.progress_file)
+            progress.load(date)
+            if progress.completed:
+                logger.info(f"Рассылка на {date} уже завершена")
+                return stats
+            await progress.start()
+
+            queue = asyncio.Queue()
+            for user in users:
+                if user['user_id'] in progress.done:
+                    stats['skipped'] += 1
+                else:
+                    queue.put_nowait(user)
+            logger.info(f"Рассылка на {date}: к отправке {queue.qsize()}, уже отправлено ранее {stats['skipped']}")
+
+            started = time.monotonic()
+            workers = [asyncio.create_task(self._worker(queue, bot, date, progress, stats))
+                       for _ in range(self.concurrency)]
+            await queue.join()
+            for worker in workers:
+                worker.cancel()
+            await progress.finish()
+            if progress.failed:
+                logger.warning(f"Рассылка на {date} не завершена: {len(progress.failed)} пользователей ждут повтора; "
+                               f"{stats}")
+            else:
+                logger.info(f"Рассылка на {date} завершена за {time.monotonic() - started:.1f} с: {stats}")
+            return stats
+        finally:
+            self._running = False
+
+    async def _worker(self, queue, bot, date, progress, stats):
+        while True:
+            user = await queue.get()
+            try:
+                try:
+                    status = await self._deliver(bot, user, date)
+                except Exception as e:
+                    status = 'retry'
+                    logger.error(f"Error generating astrology forecast for user {user['user_id']}: {e}")
+                stats[status] += 1
+                await progress.mark(user['user_id'], status)
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, bot, user, date):
+        user_id = user['user_id']
+        text = await self.generate(user, date)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(user_id)
+            try:
+                await bot.send_message(chat_id=user_id, text=text)
+                return 'sent'
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logger.warning(f"Лимит Telegram при рассылке, пауза {retry_after} с")
+                self.limiter.bucket.pause(retry_after)
+            except Forbidden:
+                # Пользователь заблокировал бота
+                if self.on_blocked:
+                    self.on_blocked(user_id)
+                return 'blocked'
+            except BadRequest as e:
+                logger.error(f"Гороскоп пользователю {user_id} не отправлен: {e}")
+                return 'failed'
+            except (TimedOut, NetworkError) as e:
+                delay = self.base_delay * 2 ** attempt * (1 + random.random())
+                logger.warning(f"Ошибка отправки гороскопа пользователю {user_id}: {e}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+        logger.error(f"Не удалось отправить гороскоп пользователю {user_id} после {self.max_retries + 1} попыток")
+        return 'retry'
@@ -0,0 +1,225 @@
+import bisect
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+
+class ChatHistoryStore:
+    """Журнал истории чатов только на дозапись с индексом смещений по пользователям.
+
+    Каждая запись - одна JSON-строка в файле журнала. В памяти хранится список
+    смещений строк каждого пользователя, поэтому добавление стоит O(1), а чтение
+    последних N записей - O(N). Записи пользователя нумеруются возрастающим seq,
+    который сохраняется при компактировании. Если компактирование удаляет
+    последние записи пользователя, в журнал пишется отметка {'user_id', 'seq_mark'},
+    чтобы нумерация продолжилась с прежнего номера, а не началась заново.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._index = {}
+        self._seqs = {}
+        self._last_seqs = {}
+        self._open()
+
+    def _open(self):
+        self._writer = open(self.log_path, 'ab')
+        self._reader = open(self.log_path, 'rb')
+        self._build_index()
+
+    def _build_index(self):
+        """Один проход по журналу при запуске для построения индекса."""
+        self._index = {}
+        self._seqs = {}
+        self._last_seqs = {}
+        self._reader.seek(0)
+        offset = 0
+        for line in self._reader:
+            if line.endswith(b'\n'):
+                record = json.loads(line)
+                user_id = record['user_id']
+                if 'seq_mark' in record:
+                    self._last_seqs[user_id] = max(self._last_seqs.get(user_id, 0), record['seq_mark'])
+                else:
+                    # У записей старого формата seq нет - нумеруем по порядку
+                    seq = record.get('seq') or self._last_seqs.get(user_id, 0) + 1
+                    self._seqs.setdefault(user_id, []).append(seq)
+                    self._index.setdefault(user_id, []).append(offset)
+                    self._last_seqs[user_id] = max(self._last_seqs.get(user_id, 0), seq)
+            offset += len(line)
+        if self._writer.tell() != offset:
+            # Недописанная строка после сбоя - обрезаем хвост журнала
+            logger.warning(f"Обрезана поврежденная запись в конце {self.log_path}")
+            self._writer.truncate(offset)
+            self._writer.seek(offset)
+
+    def _write(self, record):
+        offset = self._writer.tell()
+        self._writer.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        self._writer.flush()
+        return offset
+
+    def append(self, user_id, message, role, timestamp=None):
+        """Добавляет сообщение в историю пользователя."""
+        record = {
+            'user_id': user_id,
+            'timestamp': timestamp or datetime.now().strftime(TIMESTAMP_FORMAT),
+            'message': message,
+            'role': role
+        }
+        with self._lock:
+            record['seq'] = self._last_seqs.get(user_id, 0) + 1
+            offset = self._write(record)
+            self._index.setdefault(user_id, []).append(offset)
+            self._seqs.setdefault(user_id, []).append(record['seq'])
+            self._last_seqs[user_id] = record['seq']
+
+    def since(self, user_id, seq, limit=None):
+        """Возвращает записи пользователя с номером больше seq (не больше limit последних)."""
+        with self._lock:
+            offsets = self._index.get(user_id, [])
+            start = bisect.bisect_right(self._seqs.get(user_id, []), seq)
+            if limit is not None:
+                start = max(start, len(offsets) - limit) if limit > 0 else len(offsets)
+            return [self._read(offset) for offset in offsets[start:]]
+
+    def between(self, user_id, after_seq, up_to_seq):
+        """Возвращает записи с номерами в полуинтервале (after_seq, up_to_seq]."""
+        with self._lock:
+            seqs = self._seqs.get(user_id, [])
+            start = bisect.bisect_right(seqs, after_seq)
+            end = bisect.bisect_right(seqs, up_to_seq)
+            return [self._read(offset) for offset in self._index.get(user_id, [])[start:end]]
+
+    def _read(self, offset):
+        self._reader.seek(offset)
+        record = json.loads(self._reader.readline())
+        return {'timestamp': record['timestamp'], 'message': record['message'], 'role': record['role'],
+                'seq': record.get('seq')}
+
+    def last_seq(self, user_id):
+        """Номер последней записи пользователя, в том числе удаленной компактированием (0, если истории нет)."""
+        with self._lock:
+            return self._last_seqs.get(user_id, 0)
+
+    def compact(self, retention=None, max_age_days=None):
+        """Переписывает журнал, оставляя не более retention последних записей на пользователя
+        и только записи не старше max_age_days. Замена файла атомарная.
+
+        Новый файл и его индекс строятся без блокировки по снимку индекса, поэтому
+        append и чтение не ждут перезаписи. Под блокировкой в новый файл только
+        дописываются записи, добавленные после снимка, и файлы меняются местами.
+        """
+        min_time = datetime.now() - timedelta(days=max_age_days) if max_age_days else None
+        tmp_path = self.log_path + '.tmp'
+        with self._lock:
+            snapshot_end = self._writer.tell()
+            snapshot = [(user_id, list(self._index.get(user_id, [])), list(self._seqs.get(user_id, [])), last_seq)
+                        for user_id, last_seq in self._last_seqs.items()]
+        index, seqs_index, last_seqs = {}, {}, {}
+        kept = dropped = 0
+        with open(self.log_path, 'rb') as source, open(tmp_path, 'wb') as tmp:
+            for user_id, offsets, seqs, last_seq in snapshot:
+                last_seqs[user_id] = last_seq
+                last_kept = 0
+                if retention is not None:
+                    dropped += max(len(offsets) - retention, 0)
+                    offsets, seqs = offsets[-retention:], seqs[-retention:]
+                for offset, seq in zip(offsets, seqs):
+                    source.seek(offset)
+                    record = json.loads(source.readline())
+                    if min_time and datetime.strptime(record['timestamp'], TIMESTAMP_FORMAT) < min_time:
+                        dropped += 1
+                        continue
+                    record['seq'] = seq
+                    index.setdefault(user_id, []).append(tmp.tell())
+                    seqs_index.setdefault(user_id, []).append(seq)
+                    tmp.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+                    kept += 1
+                    last_kept = seq
+                if last_kept < last_seq:
+                    tmp.write(json.dumps({'user_id': user_id, 'seq_mark': last_seq}).encode('utf-8') + b'\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            with self._lock:
+                # Записи, добавленные во время перезаписи, переносятся как есть (seq в них уже проставлен)
+                source.seek(snapshot_end)
+                for line in source:
+                    if not line.endswith(b'\n'):
+                        break
+                    record = json.loads(line)
+                    user_id = record['user_id']
+                    index.setdefault(user_id, []).append(tmp.tell())
+                    seqs_index.setdefault(user_id, []).append(record['seq'])
+                    last_seqs[user_id] = record['seq']
+                    tmp.write(line)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+                source.close()
+                tmp.close()
+                self._writer.close()
+                self._reader.close()
+                os.replace(tmp_path, self.log_path)
+                self._writer = open(self.log_path, 'ab')
+                self._reader = open(self.log_path, 'rb')
+                self._index, self._seqs, self._last_seqs = index, seqs_index, last_seqs
+        logger.info(f"Компактирование истории чатов: оставлено {kept}, удалено {dropped} записей")
+        return kept, dropped
+
+    def migrate_from_json(self, file_path):
+        """Однократно переносит историю из старого user_chat_history.json."""
+        if not os.path.exists(file_path):
+            return 0
+        with self._lock:
+            if self._index or self._writer.tell():
+                logger.warning(f"Файл {file_path} не перенесен: журнал {self.log_path} не пуст")
+                return 0
+        with open(file_path, 'r', encoding='utf-8') as file:
+            chat_history = json.load(file)
+        migrated = 0
+        for user_id, entries in chat_history.items():
+            for entry in entries:
+                self.append(int(user_id), entry['message'], entry['role'], timestamp=entry.get('timestamp'))
+                migrated += 1
+        os.replace(file_path, file_path + '.migrated')
+        logger.info(f"Перенесено {migrated} сообщений из {file_path} в {self.log_path}")
+        return migrated
+
+    def import_from_log(self, file_path, owns):
+        """Однократно копирует из общего журнала записи пользователей, для которых owns(user_id) истинно.
+
+        Используется при переходе на шарды: у каждого шарда свой журнал. Строки
+        копируются как есть, поэтому номера seq сохраняются. Непустой журнал шарда
+        не перестраивается, поэтому при смене числа шардов пользователи, попавшие
+        на другой шард, не увидят прежней истории. Перед сменой SHARD_COUNT журналы
+        шардов нужно объединить в общий журнал и удалить - каждый шард заново
+        импортирует своих пользователей.
+        """
+        if not os.path.exists(file_path) or os.path.abspath(file_path) == os.path.abspath(self.log_path):
+            return 0
+        with self._lock:
+            if self._index or self._writer.tell():
+                return 0
+            imported = 0
+            with open(file_path, 'rb') as source:
+                for line in source:
+                    if line.endswith(b'\n') and owns(json.loads(line)['user_id']):
+                        self._writer.write(line)
+                        imported += 1
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._build_index()
+        logger.info(f"Импортировано {imported} записей из {file_path} в {self.log_path}")
+        return imported
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            self._reader.close()
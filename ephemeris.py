@@ -0,0 +1,225 @@
+import logging
+import os
+import tempfile
+from datetime import datetime, timezone
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Порядок тел в таблице
+BODIES = ('sun', 'moon', 'mercury', 'venus', 'mars', 'jupiter', 'saturn', 'uranus', 'neptune', 'pluto')
+
+# Юлианская дата 2000-01-00 0h UT - начало отсчета дней в элементах орбит
+_EPOCH_JD = 2451543.5
+# Долгота хранится в uint16: 65536 делений на круг, около 20 угловых секунд
+_SCALE = 65536 / 360.0
+
+# Элементы орбит (N, i, w, a, e, M) как пары (значение на эпоху, изменение за сутки)
+_ORBITS = {
+    'mercury': ((48.3313, 3.24587e-5), (7.0047, 5.00e-8), (29.1241, 1.01444e-5), (0.387098, 0.0),
+                (0.205635, 5.59e-10), (168.6562, 4.0923344368)),
+    'venus': ((76.6799, 2.46590e-5), (3.3946, 2.75e-8), (54.8910, 1.38374e-5), (0.723330, 0.0),
+              (0.006773, -1.302e-9), (48.0052, 1.6021302244)),
+    'mars': ((49.5574, 2.11081e-5), (1.8497, -1.78e-8), (286.5016, 2.92961e-5), (1.523688, 0.0),
+             (0.093405, 2.516e-9), (18.6021, 0.5240207766)),
+    'jupiter': ((100.4542, 2.76854e-5), (1.3030, -1.557e-7), (273.8777, 1.64505e-5), (5.20256, 0.0),
+                (0.048498, 4.469e-9), (19.8950, 0.0830853001)),
+    'saturn': ((113.6634, 2.38980e-5), (2.4886, -1.081e-7), (339.3939, 2.97661e-5), (9.55475, 0.0),
+               (0.055546, -9.499e-9), (316.9670, 0.0334442282)),
+    'uranus': ((74.0005, 1.3978e-5), (0.7733, 1.9e-8), (96.6612, 3.0565e-5), (19.18171, -1.55e-8),
+               (0.047318, 7.45e-9), (142.5905, 0.011725806)),
+    'neptune': ((131.7806, 3.0173e-5), (1.7700, -2.55e-7), (272.8461, -6.027e-6), (30.05826, 3.313e-8),
+                (0.008606, 2.15e-9), (260.2471, 0.005995147)),
+}
+
+
+def julian_day(moment):
+    """Юлианская дата для datetime в UTC (наивный datetime считается UTC)."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return (moment - datetime(2000, 1, 1, 12)).total_seconds() / 86400.0 + 2451545.0
+
+
+def _sin(degrees):
+    return np.sin(np.radians(degrees))
+
+
+def _cos(degrees):
+    return np.cos(np.radians(degrees))
+
+
+def _elements(body, d):
+    return [value + rate * d for value, rate in _ORBITS[body]]
+
+
+def _eccentric_anomaly(M, e):
+    M = np.radians(M % 360.0)
+    E = M + e * np.sin(M) * (1.0 + e * np.cos(M))
+    for _ in range(5):
+        E = E - (E - e * np.sin(E) - M) / (1.0 - e * np.cos(E))
+    return E
+
+
+def _orbit_xyz(N, i, w, a, e, M):
+    """Прямоугольные эклиптические координаты тела по элементам орбиты."""
+    E = _eccentric_anomaly(M, e)
+    xv = a * (np.cos(E) - e)
+    yv = a * np.sqrt(1.0 - e * e) * np.sin(E)
+    v = np.degrees(np.arctan2(yv, xv))
+    r = np.hypot(xv, yv)
+    x = r * (_cos(N) * _cos(v + w) - _sin(N) * _sin(v + w) * _cos(i))
+    y = r * (_sin(N) * _cos(v + w) + _cos(N) * _sin(v + w) * _cos(i))
+    z = r * _sin(v + w) * _sin(i)
+    return x, y, z
+
+
+def _rotate_longitude(x, y, z, delta):
+    """Поворачивает точку вокруг оси эклиптики на delta градусов (поправка долготы)."""
+    longitude = np.degrees(np.arctan2(y, x)) + delta
+    radius = np.hypot(x, y)
+    return radius * _cos(longitude), radius * _sin(longitude), z
+
+
+def compute_longitudes(jd):
+    """Геоцентрические эклиптические долготы тел BODIES (градусы, равноденствие даты).
+
+    Аналитическая теория низкой точности (элементы орбит с вековыми членами и
+    главные возмущения Луны, Юпитера, Сатурна и Урана): ошибка порядка угловых
+    минут для планет и десятых долей градуса для Луны - достаточно для знаков,
+    домов и аспектов. Векторизовано по массиву юлианских дат.
+    """
+    d = np.asarray(jd, dtype=np.float64) - _EPOCH_JD
+    result = np.empty(d.shape + (len(BODIES),))
+
+    # Солнце
+    w_sun = 282.9404 + 4.70935e-5 * d
+    e_sun = 0.016709 - 1.151e-9 * d
+    M_sun = 356.0470 + 0.9856002585 * d
+    E = _eccentric_anomaly(M_sun, e_sun)
+    xv = np.cos(E) - e_sun
+    yv = np.sqrt(1.0 - e_sun * e_sun) * np.sin(E)
+    sun_longitude = np.degrees(np.arctan2(yv, xv)) + w_sun
+    sun_distance = np.hypot(xv, yv)
+    x_sun, y_sun = sun_distance * _cos(sun_longitude), sun_distance * _sin(sun_longitude)
+    result[..., 0] = sun_longitude
+
+    # Луна: элементы геоцентрической орбиты и главные периодические поправки
+    N_moon = 125.1228 - 0.0529538083 * d
+    w_moon = 318.0634 + 0.1643573223 * d
+    M_moon = 115.3654 + 13.0649929509 * d
+    x, y, _ = _orbit_xyz(N_moon, 5.1454, w_moon, 60.2666, 0.054900, M_moon)
+    mean_sun = M_sun + w_sun
+    mean_moon = M_moon + w_moon + N_moon
+    D = mean_moon - mean_sun
+    F = mean_moon - N_moon
+    result[..., 1] = (np.degrees(np.arctan2(y, x))
+                      - 1.274 * _sin(M_moon - 2 * D) + 0.658 * _sin(2 * D) - 0.186 * _sin(M_sun)
+                      - 0.059 * _sin(2 * M_moon - 2 * D) - 0.057 * _sin(M_moon - 2 * D + M_sun)
+                      + 0.053 * _sin(M_moon + 2 * D) + 0.046 * _sin(2 * D - M_sun) + 0.041 * _sin(M_moon - M_sun)
+                      - 0.035 * _sin(D) - 0.031 * _sin(M_moon + M_sun) - 0.015 * _sin(2 * F - 2 * D)
+                      + 0.011 * _sin(M_moon - 4 * D))
+
+    # Планеты: гелиоцентрическое положение плюс вектор Земля-Солнце
+    M_jupiter = _elements('jupiter', d)[5]
+    M_saturn = _elements('saturn', d)[5]
+    M_uranus = _elements('uranus', d)[5]
+    perturbations = {
+        'jupiter': (-0.332 * _sin(2 * M_jupiter - 5 * M_saturn - 67.6) - 0.056 * _sin(2 * M_jupiter - 2 * M_saturn + 21)
+                    + 0.042 * _sin(3 * M_jupiter - 5 * M_saturn + 21) - 0.036 * _sin(M_jupiter - 2 * M_saturn)
+                    + 0.022 * _cos(M_jupiter - M_saturn) + 0.023 * _sin(2 * M_jupiter - 3 * M_saturn + 52)
+                    - 0.016 * _sin(M_jupiter - 5 * M_saturn - 69)),
+        'saturn': (0.812 * _sin(2 * M_jupiter - 5 * M_saturn - 67.6) - 0.229 * _cos(2 * M_jupiter - 4 * M_saturn - 2)
+                   + 0.119 * _sin(M_jupiter - 2 * M_saturn - 3) + 0.046 * _sin(2 * M_jupiter - 6 * M_saturn - 69)
+                   + 0.014 * _sin(M_jupiter - 3 * M_saturn + 32)),
+        'uranus': (0.040 * _sin(M_saturn - 2 * M_uranus + 6) + 0.035 * _sin(M_saturn - 3 * M_uranus + 33)
+                   - 0.015 * _sin(M_jupiter - M_uranus + 20)),
+    }
+    for index, body in enumerate(BODIES[2:9], start=2):
+        x, y, z = _orbit_xyz(*_elements(body, d))
+        if body in perturbations:
+            x, y, z = _rotate_longitude(x, y, z, perturbations[body])
+        result[..., index] = np.degrees(np.arctan2(y + y_sun, x + x_sun))
+
+    # Плутон: отдельная аппроксимация, верная для 1885-2099 годов
+    S = 50.03 + 0.033459652 * d
+    P = 238.95 + 0.003968789 * d
+    longitude = (238.9508 + 0.00400703 * d
+                 - 19.799 * _sin(P) + 19.848 * _cos(P) + 0.897 * _sin(2 * P) - 4.956 * _cos(2 * P)
+                 + 0.610 * _sin(3 * P) + 1.211 * _cos(3 * P) - 0.341 * _sin(4 * P) - 0.190 * _cos(4 * P)
+                 + 0.128 * _sin(5 * P) - 0.034 * _cos(5 * P) - 0.038 * _sin(6 * P) + 0.031 * _cos(6 * P)
+                 + 0.020 * _sin(S - P) - 0.010 * _cos(S - P))
+    latitude = (-3.9082 - 5.453 * _sin(P) - 14.975 * _cos(P) + 3.527 * _sin(2 * P) + 2.157 * _cos(2 * P)
+                - 1.276 * _sin(3 * P) + 0.580 * _cos(3 * P) + 0.140 * _sin(4 * P) + 0.015 * _cos(4 * P)
+                - 0.050 * _sin(5 * P) - 0.044 * _cos(5 * P) + 0.020 * _sin(6 * P) + 0.015 * _cos(6 * P))
+    distance = (40.72 + 6.68 * _sin(P) + 6.90 * _cos(P) - 1.18 * _sin(2 * P) - 0.03 * _cos(2 * P)
+                + 0.15 * _sin(3 * P) - 0.14 * _cos(3 * P))
+    projected = distance * _cos(latitude)
+    result[..., 9] = np.degrees(np.arctan2(projected * _sin(longitude) + y_sun, projected * _cos(longitude) + x_sun))
+    return result % 360.0
+
+
+class Ephemeris:
+    """Таблица суточных долгот тел BODIES на 0h UT за годы start_year..end_year.
+
+    Таблица хранится в .npy как uint16 (около 1.5 МБ на 200 лет) и открывается
+    через np.load(mmap_mode='r'): процессы-шарды делят страницы файла через кэш
+    ОС. Если файла нет или он не совпадает по размеру, таблица рассчитывается
+    заново (доли секунды) и атомарно записывается. Положение на произвольный
+    момент - линейная интерполяция между соседними сутками.
+    """
+
+    def __init__(self, path, start_year=1900, end_year=2100):
+        self.path = path
+        self.start_jd = julian_day(datetime(start_year, 1, 1))
+        self.days = int(julian_day(datetime(end_year + 1, 1, 1)) - self.start_jd) + 1
+        self._table = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = self._load()
+        return self._table
+
+    def _load(self):
+        if os.path.exists(self.path):
+            table = np.load(self.path, mmap_mode='r')
+            if table.shape == (self.days, len(BODIES)) and table.dtype == np.uint16:
+                return table
+            logger.warning(f"Таблица эфемерид {self.path} не совпадает с диапазоном лет и будет пересчитана")
+        self.build()
+        return np.load(self.path, mmap_mode='r')
+
+    def build(self):
+        """Рассчитывает таблицу и атомарно записывает ее в path."""
+        longitudes = compute_longitudes(self.start_jd + np.arange(self.days))
+        table = np.round(longitudes * _SCALE).astype(np.int64) % 65536
+        # Свой временный файл у каждого процесса: шарды, одновременно строящие таблицу, не пишут в один файл
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.save(file, table.astype(np.uint16))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        logger.info(f"Таблица эфемерид рассчитана: {self.days} суток, {os.path.getsize(self.path)} байт")
+
+    def covers(self, jd):
+        jd = np.asarray(jd, dtype=np.float64)
+        return (jd >= self.start_jd) & (jd < self.start_jd + self.days - 1)
+
+    def positions(self, jd):
+        """Долготы (градусы) и суточные скорости тел для массива юлианских дат формы (n,) -> (n, len(BODIES)).
+
+        Отрицательная скорость означает попятное (ретроградное) движение.
+        """
+        offset = np.asarray(jd, dtype=np.float64) - self.start_jd
+        index = np.floor(offset).astype(np.int64)
+        fraction = (offset - index)[..., None]
+        table = self.table
+        current = table[index].astype(np.float64) / _SCALE
+        following = table[index + 1].astype(np.float64) / _SCALE
+        # Разность через границу 0/360 приводится к (-180, 180]
+        speed = (following - current + 180.0) % 360.0 - 180.0
+        return (current + fraction * speed) % 360.0, speed
@@ -0,0 +1,146 @@
+"""Локальные заглушки Telegram Bot API и OpenAI-совместимого API для нагрузочных прогонов.
+
+Обе заглушки - приложения aiohttp с настраиваемой задержкой. Они считают
+запросы по методам, чтобы отчет показывал, сколько обращений к внешним API
+стоит одно обновление.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Бот', 'username': 'fake_bot'}
+
+REPLY_WORDS = ("карты показывают перемены в ближайшее время важно довериться интуиции и не спешить с решением "
+               "звезды благоприятствуют новым начинаниям энергия месяца поможет раскрыть потенциал").split()
+
+
+class LatencyModel:
+    """Задержка ответа: base секунд плюс равномерный разброс до jitter секунд."""
+
+    def __init__(self, base=0.0, jitter=0.0, rng=None):
+        self.base = base
+        self.jitter = jitter
+        self.rng = rng or random.Random(0)
+
+    async def wait(self):
+        delay = self.base + self.rng.random() * self.jitter
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: отвечает на методы, которые вызывает бот, и отдает голосовые файлы.
+
+    Все пользователи считаются подписанными на каналы. Содержимое голосового
+    файла задается voice_bytes.
+    """
+
+    def __init__(self, latency=None, voice_bytes=b''):
+        self.latency = latency or LatencyModel()
+        self.voice_bytes = voice_bytes
+        self.calls = Counter()
+        self._message_id = 0
+        self.app = web.Application()
+        self.app.router.add_route('*', '/bot{token}/{method}', self._handle_method)
+        self.app.router.add_get('/file/bot{token}/{path:.+}', self._handle_file)
+
+    def _message(self, chat_id, text=None):
+        self._message_id += 1
+        chat_id = int(chat_id)
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': text or '',
+        }
+
+    async def _handle_method(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if not params:
+            body = await request.read()
+            params = json.loads(body) if body else {}
+        await self.latency.wait()
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'sendMessage':
+            result = self._message(params['chat_id'], params.get('text'))
+        elif method == 'editMessageText':
+            result = self._message(params.get('chat_id') or 0, params.get('text'))
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'U'}}
+        elif method == 'getFile':
+            file_id = params['file_id']
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.voice_bytes),
+                      'file_path': f'voice/{file_id}.ogg'}
+        else:
+            # deleteMessage, answerCallbackQuery и прочие методы без содержательного ответа
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _handle_file(self, request):
+        self.calls['downloadFile'] += 1
+        await self.latency.wait()
+        return web.Response(body=self.voice_bytes, content_type='audio/ogg')
+
+
+class FakeLLMServer:
+    """Заглушка OpenAI-совместимого /chat/completions с обычным ответом и SSE-потоком.
+
+    latency - задержка до первого токена, chunk_delay - пауза между фрагментами
+    потока, completion_tokens - длина ответа в словах.
+    """
+
+    def __init__(self, latency=None, chunk_delay=0.02, completion_tokens=120, seed=0):
+        self.latency = latency or LatencyModel()
+        self.chunk_delay = chunk_delay
+        self.completion_tokens = completion_tokens
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.app = web.Application()
+        self.app.router.add_post('/{path:.*}', self._handle_completion)
+
+    def _reply_words(self):
+        return [self.rng.choice(REPLY_WORDS) for _ in range(self.completion_tokens)]
+
+    async def _handle_completion(self, request):
+        data = await request.json()
+        prompt_tokens = sum(len(message['content'].split()) for message in data['messages'])
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': self.completion_tokens,
+                 'total_tokens': prompt_tokens + self.completion_tokens}
+        await self.latency.wait()
+
+        if not data.get('stream'):
+            self.calls['complete'] += 1
+            return web.json_response({'choices': [{'message': {'role': 'assistant', 'content': ' '.join(self._reply_words())}}],
+                                      'usage': usage})
+
+        self.calls['stream'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        words = self._reply_words()
+        for start in range(0, len(words), 10):
+            chunk = {'choices': [{'delta': {'content': ' '.join(words[start:start + 10]) + ' '}}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+async def start_server(app, host='127.0.0.1', port=0):
+    """Запускает приложение aiohttp и возвращает (runner, фактический порт)."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
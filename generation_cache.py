@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Знаки зодиака: (месяц, день начала знака, название), по порядку от начала года
+ZODIAC_SIGNS = (
+    (1, 20, 'Водолей'), (2, 19, 'Рыбы'), (3, 21, 'Овен'), (4, 20, 'Телец'),
+    (5, 21, 'Близнецы'), (6, 21, 'Рак'), (7, 23, 'Лев'), (8, 23, 'Дева'),
+    (9, 23, 'Весы'), (10, 23, 'Скорпион'), (11, 22, 'Стрелец'), (12, 22, 'Козерог'),
+)
+
+
+def zodiac_sign(date_of_birth):
+    """Солнечный знак по дате рождения в формате ДД.ММ.ГГГГ."""
+    day, month = (int(part) for part in date_of_birth.split('.')[:2])
+    sign = 'Козерог'
+    for sign_month, sign_day, name in ZODIAC_SIGNS:
+        if (month, day) >= (sign_month, sign_day):
+            sign = name
+    return sign
+
+
+def normalize_place(place):
+    """Приводит место рождения к виду для сравнения: регистр, ё/е, пунктуация, пробелы."""
+    place = place.casefold().replace('ё', 'е')
+    place = re.sub(r'[^\w]+', ' ', place)
+    return ' '.join(place.split())
+
+
+def time_bucket(time_of_birth, minutes=60):
+    """Округляет время ЧЧ:ММ вниз до интервала в minutes минут."""
+    try:
+        hours, mins = (int(part) for part in time_of_birth.split(':'))
+    except ValueError:
+        return time_of_birth.strip()
+    total = (hours * 60 + mins) // minutes * minutes
+    return f"{total // 60:02d}:{total % 60:02d}"
+
+
+def horoscope_signature(date_of_birth, time_of_birth, place_of_birth, target, by_sign=False, bucket_minutes=60):
+    """Ключ кэша гороскопа по нормализованным данным рождения и целевой дате."""
+    if by_sign:
+        return f"sign|{zodiac_sign(date_of_birth)}|{target}"
+    return (f"natal|{date_of_birth.strip()}|{time_bucket(time_of_birth, bucket_minutes)}|"
+            f"{normalize_place(place_of_birth)}|{target}")
+
+
+class GenerationCache:
+    """Кэш сгенерированных LLM текстов с LRU в памяти, TTL и хранением в SQLite.
+
+    Одновременные запросы одного ключа ждут одну генерацию.
+    """
+
+    def __init__(self, db_path, ttl=36 * 60 * 60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generation_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_generation_cache_created_at ON generation_cache (created_at)")
+
+    def get(self, key):
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is None:
+            with self._lock:
+                row = self._conn.execute("SELECT value, created_at FROM generation_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                entry = (row[0], row[1])
+                self._remember(key, entry)
+        if entry is None or now - entry[1] > self.ttl:
+            return None
+        self._memory.move_to_end(key)
+        return entry[0]
+
+    async def put(self, key, value):
+        """Кладет текст в память сразу, а на диск - в отдельном потоке."""
+        entry = (value, time.time())
+        self._remember(key, entry)
+        await asyncio.to_thread(self._save, key, entry)
+
+    def _save(self, key, entry):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO generation_cache (key, value, created_at) VALUES (?, ?, ?)",
+                               (key, entry[0], entry[1]))
+
+    async def get_or_generate(self, key, generate):
+        """Возвращает текст из кэша или вызывает корутину generate() и кэширует результат."""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.hits += 1
+            return await asyncio.shield(task)
+        self.misses += 1
+        task = asyncio.ensure_future(generate())
+        self._in_flight[key] = task
+        try:
+            value = await asyncio.shield(task)
+        finally:
+            self._in_flight.pop(key, None)
+        await self.put(key, value)
+        return value
+
+    def purge(self):
+        """Удаляет с диска просроченные записи и записи сверх max_entries."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM generation_cache WHERE created_at < ?", (time.time() - self.ttl,))
+            self._conn.execute(
+                "DELETE FROM generation_cache WHERE key NOT IN "
+                "(SELECT key FROM generation_cache ORDER BY created_at DESC LIMIT ?)", (self.max_entries,)
+            )
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate, 'entries': len(self._memory)}
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def prompt_key(messages):
+    """Ключ пула по содержимому промпта: изменение текста промпта дает новый пул."""
+    return hashlib.sha256(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResponsePool:
+    """Пул заранее сгенерированных ответов на неизменные промпты.
+
+    На каждый промпт хранится до pool_size вариантов, пользователю отдается
+    случайный. Недостающие и устаревшие (старше ttl) варианты догенерируются в
+    фоне, устаревший вариант отдается, пока не готов новый. Ждать генерации
+    приходится только при пустом пуле. Варианты хранятся в SQLite.
+
+    generate(messages) - корутина, возвращающая текст ответа LLM.
+    """
+
+    def __init__(self, db_path, generate, pool_size=3, ttl=7 * 24 * 60 * 60):
+        self.generate = generate
+        self.pool_size = pool_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._pools = {}
+        self._refreshing = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_pool ("
+            "key TEXT NOT NULL, slot INTEGER NOT NULL, value TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (key, slot))"
+        )
+
+    def _pool(self, key):
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                rows = self._conn.execute("SELECT slot, value, created_at FROM response_pool WHERE key = ? ORDER BY slot",
+                                          (key,)).fetchall()
+            pool = self._pools[key] = {slot: (value, created_at) for slot, value, created_at in rows if slot < self.pool_size}
+        return pool
+
+    async def get(self, messages):
+        """Возвращает один из вариантов ответа на messages."""
+        key = prompt_key(messages)
+        pool = self._pool(key)
+        if pool:
+            self.hits += 1
+            self.refresh(messages)
+            return random.choice(list(pool.values()))[0]
+        self.misses += 1
+        # Пул пуст: ждем первый готовый вариант, остальные догенерируются в фоне
+        pending = set(self.refresh(messages))
+        while not pool and pending:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if not pool:
+            raise RuntimeError("Не удалось сгенерировать ответ для пула")
+        return random.choice(list(pool.values()))[0]
+
+    def refresh(self, messages):
+        """Запускает фоновую генерацию пустых и устаревших вариантов. Возвращает задачи генерации."""
+        key = prompt_key(messages)
+        tasks = self._refreshing.get(key)
+        if tasks is None:
+            pool = self._pool(key)
+            now = time.time()
+            slots = [slot for slot in range(self.pool_size) if slot not in pool or now - pool[slot][1] > self.ttl]
+            if not slots:
+                return []
+            tasks = self._refreshing[key] = [asyncio.ensure_future(self._fill(key, messages, slot)) for slot in slots]
+            remaining = set(tasks)
+
+            def on_done(task):
+                remaining.discard(task)
+                if not remaining:
+                    self._refreshing.pop(key, None)
+
+            for task in tasks:
+                task.add_done_callback(on_done)
+        return tasks
+
+    async def _fill(self, key, messages, slot):
+        try:
+            value = await self.generate(messages)
+        except Exception as e:
+            logger.error(f"Не удалось пополнить пул ответов: {e}")
+            return
+        entry = (value, time.time())
+        self._pools[key][slot] = entry
+        await asyncio.to_thread(self._save, key, slot, entry)
+
+    def _save(self, key, slot, entry):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO response_pool (key, slot, value, created_at) VALUES (?, ?, ?, ?)",
+                               (key, slot, entry[0], entry[1]))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'prompts': len(self._pools)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+from typing import NamedTuple, Optional
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class LLMResponse(NamedTuple):
+    text: str
+    # Число токенов из поля usage ответа API (None, если прокси его не вернул)
+    prompt_tokens: Optional[int]
+    completion_tokens: Optional[int]
+
+
+class LLMResponseError(Exception):
+    """Прокси ответил 200, но в ответе нет текста модели."""
+
+
+def to_messages(prompt):
+    """Строку промпта превращает в одно сообщение пользователя, список messages оставляет как есть."""
+    if isinstance(prompt, str):
+        return [{'role': 'user', 'content': prompt}]
+    return prompt
+
+
+class LLMClient:
+    """Асинхронный клиент к OpenAI-совместимому прокси с пулом keep-alive соединений."""
+
+    def __init__(self, api_url, api_key, model, max_tokens, timeout=60.0, connect_timeout=10.0,
+                 max_concurrency=20, max_connections=20, keepalive_expiry=30.0):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.model = model
+        self.max_tokens = max_tokens
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        # Ограничение числа одновременных запросов к прокси
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Клиент создается лениво, внутри работающего цикла событий
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self.limits,
+                headers={
+                    'Authorization': f'Bearer {self.api_key}',
+                    'Content-Type': 'application/json'
+                }
+            )
+        return self._client
+
+    async def complete(self, prompt, max_tokens: int = None, model: str = None) -> LLMResponse:
+        """Отправляет запрос к модели и возвращает текст ответа вместе с расходом токенов.
+
+        prompt - строка или готовый список messages. Ответ с кодом 4xx/5xx
+        поднимает httpx.HTTPStatusError, ответ без текста - LLMResponseError.
+        """
+        data = {
+            'model': model or self.model,
+            'messages': to_messages(prompt),
+            'max_tokens': max_tokens or self.max_tokens
+        }
+        async with self._semaphore:
+            response = await self._get_client().post(self.api_url, json=data)
+        if response.status_code >= 400:
+            raise httpx.HTTPStatusError(f"Ошибка LLM API {response.status_code}: {response.text}",
+                                        request=response.request, response=response)
+        try:
+            response_data = response.json()
+            content = response_data['choices'][0]['message']['content']
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise LLMResponseError(f"Некорректный ответ LLM API: {response.text[:200]}") from e
+        if not isinstance(content, str):
+            raise LLMResponseError("Ответ LLM API без текста")
+        usage = response_data.get('usage') or {}
+        return LLMResponse(content, usage.get('prompt_tokens'), usage.get('completion_tokens'))
+
+    async def stream_complete(self, prompt, on_delta, max_tokens: int = None, model: str = None) -> LLMResponse:
+        """Запрашивает ответ в режиме SSE-потока.
+
+        После каждого фрагмента вызывает await on_delta(text) с накопленным текстом
+        и в конце возвращает полный ответ вместе с расходом токенов. Поток без
+        единого фрагмента текста, как и в complete, поднимает LLMResponseError.
+        """
+        data = {
+            'model': model or self.model,
+            'messages': to_messages(prompt),
+            'max_tokens': max_tokens or self.max_tokens,
+            'stream': True,
+            'stream_options': {'include_usage': True}
+        }
+        parts = []
+        usage = {}
+        async with self._semaphore:
+            async with self._get_client().stream('POST', self.api_url, json=data) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    raise httpx.HTTPStatusError(f"Ошибка LLM API {response.status_code}: {response.text}",
+                                                request=response.request, response=response)
+                async for line in response.aiter_lines():
+                    if not line.startswith('data:'):
+                        continue
+                    payload = line[len('data:'):].strip()
+                    if payload == '[DONE]':
+                        break
+                    chunk = json.loads(payload)
+                    if chunk.get('usage'):
+                        usage = chunk['usage']
+                    for choice in chunk.get('choices') or []:
+                        delta = (choice.get('delta') or {}).get('content')
+                        if delta:
+                            parts.append(delta)
+                            await on_delta(''.join(parts))
+        if not parts:
+            raise LLMResponseError("Ответ LLM API без текста")
+        return LLMResponse(''.join(parts), usage.get('prompt_tokens'), usage.get('completion_tokens'))
+
+    async def aclose(self) -> None:
+        """Закрывает пул соединений."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+import httpx
+
+from llm_client import LLMResponseError
+
+logger = logging.getLogger(__name__)
+
+# Коды ответа, после которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class LLMUnavailable(Exception):
+    """LLM недоступна: цепь разомкнута или все попытки и запасные модели исчерпаны."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUSES
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def retry_after_seconds(error):
+    """Значение заголовка Retry-After ответа 429/503 в секундах (None, если его нет)."""
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            return float(error.response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+class CircuitBreaker:
+    """Размыкатель цепи для прокси LLM.
+
+    После failure_threshold ошибок подряд цепь размыкается на reset_timeout
+    секунд, и запросы сразу отклоняются. Затем пропускается один пробный
+    запрос: успех замыкает цепь, ошибка снова размыкает ее.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0.0
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self._probe:
+            self._probe = True
+            return True
+        return False
+
+    def release_probe(self):
+        """Пробный запрос завершился без результата (отменен): следующий вызов сможет выполнить новую пробу."""
+        self._probe = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probe or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._probe:
+                logger.warning(f"Цепь LLM разомкнута на {self.reset_timeout:.0f} с после {self.failures} ошибок подряд")
+            self.opened_at = time.monotonic()
+            self._probe = False
+
+
+class LatencyWindow:
+    """Длительности последних window успешных запросов для оценки перцентилей."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, q):
+        """q-й перцентиль (0..1) или None, пока замеров меньше min_samples."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class LLMGateway:
+    """Надежный вызов LLM поверх LLMClient.
+
+    - у каждой попытки свой срок attempt_timeout, у всего вызова - total_timeout;
+    - ошибки соединения, таймауты и ответы 429/5xx повторяются с экспоненциальной
+      задержкой со случайным разбросом (с учетом Retry-After);
+    - при hedge=True второй запрос отправляется, если первый не ответил за p95
+      недавних запросов, и берется тот ответ, что пришел раньше;
+    - при недоступности модели запрос уходит следующей модели из models;
+    - общий CircuitBreaker отклоняет запросы сразу, пока прокси лежит.
+
+    Потоковые запросы повторяются только до первого фрагмента ответа: то, что
+    уже показано пользователю, переиграть нельзя. Дублирующие запросы для потока
+    не отправляются.
+    """
+
+    def __init__(self, client, models, attempt_timeout=30.0, total_timeout=90.0, max_attempts=3,
+                 backoff_base=0.5, backoff_max=8.0, hedge=False, hedge_min_delay=1.0, breaker=None,
+                 metrics=None):
+        self.client = client
+        self.models = [model for model in models if model]
+        self.attempt_timeout = attempt_timeout
+        self.total_timeout = total_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics
+        self.latency = LatencyWindow()
+
+    def _inc(self, name, **labels):
+        if self.metrics is not None:
+            self.metrics.inc(name, **labels)
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = retry_after_seconds(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    async def complete(self, prompt, max_tokens=None):
+        return await self._call(lambda model, timeout: self._hedged(prompt, max_tokens, model, timeout))
+
+    async def stream_complete(self, prompt, on_delta, max_tokens=None):
+        return await self._call(lambda model, timeout: self._stream_attempt(prompt, on_delta, max_tokens, model, timeout))
+
+    async def _call(self, attempt_call):
+        deadline = time.monotonic() + self.total_timeout
+        last_error = None
+        for model_index, model in enumerate(self.models):
+            if model_index:
+                self._inc('llm_fallbacks_total', model=model)
+                logger.warning(f"Запрос к LLM переключен на запасную модель {model}: {last_error!r}")
+            for attempt in range(self.max_attempts):
+                if not self.breaker.allow():
+                    self._inc('llm_circuit_rejections_total')
+                    raise LLMUnavailable("Цепь LLM разомкнута", retry_after=self.breaker.retry_after())
+                timeout = min(self.attempt_timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    raise LLMUnavailable(f"Истек общий срок запроса к LLM: {last_error!r}")
+                try:
+                    response = await attempt_call(model, timeout)
+                except _StreamStarted as e:
+                    # Часть ответа уже показана - повтор невозможен
+                    self.breaker.record_failure()
+                    raise e.error
+                except Exception as e:
+                    last_error = e
+                    if not is_retryable(e):
+                        if not isinstance(e, (httpx.HTTPStatusError, LLMResponseError)):
+                            self.breaker.record_failure()
+                            raise
+                        # Прокси отвечает, но эта модель запрос не принимает (400/404, пустой ответ) - пробуем следующую
+                        self.breaker.record_success()
+                        break
+                    if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
+                        # 429 говорит о лимите модели, а не о недоступности прокси
+                        self.breaker.record_success()
+                    else:
+                        self.breaker.record_failure()
+                    self._inc('llm_retries_total', model=model)
+                    delay = self._backoff(attempt, e)
+                    if attempt + 1 >= self.max_attempts or time.monotonic() + delay >= deadline:
+                        break
+                    logger.debug(f"Повтор запроса к LLM {model} через {delay:.1f} с: {e}")
+                    await asyncio.sleep(delay)
+                    continue
+                except BaseException:
+                    # Отмена (CancelledError) ничего не говорит о прокси, но пробный запрос нужно освободить
+                    self.breaker.release_probe()
+                    raise
+                self.breaker.record_success()
+                return response
+        if last_error is not None and not is_retryable(last_error):
+            # Последняя модель отвергла сам запрос - это не перегрузка, отдаем исходную ошибку
+            raise last_error
+        raise LLMUnavailable(f"Все попытки запроса к LLM исчерпаны: {last_error!r}",
+                             retry_after=retry_after_seconds(last_error))
+
+    async def _attempt(self, prompt, max_tokens, model, timeout):
+        started = time.monotonic()
+        response = await asyncio.wait_for(self.client.complete(prompt, max_tokens=max_tokens, model=model), timeout)
+        self.latency.add(time.monotonic() - started)
+        return response
+
+    async def _hedged(self, prompt, max_tokens, model, timeout):
+        p95 = self.latency.percentile(0.95) if self.hedge else None
+        if p95 is None or self.breaker.state != 'closed':
+            return await self._attempt(prompt, max_tokens, model, timeout)
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        tasks = {loop.create_task(self._attempt(prompt, max_tokens, model, timeout))}
+        hedge_delay = max(p95, self.hedge_min_delay)
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done and hedge_delay < timeout:
+                self._inc('llm_hedged_total', model=model)
+                remaining = timeout - (time.monotonic() - started)
+                tasks.add(loop.create_task(self._attempt(prompt, max_tokens, model, remaining)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _stream_attempt(self, prompt, on_delta, max_tokens, model, timeout):
+        first_delta = asyncio.Event()
+
+        async def delta(text):
+            first_delta.set()
+            await on_delta(text)
+
+        loop = asyncio.get_running_loop()
+        stream = loop.create_task(self.client.stream_complete(prompt, delta, max_tokens=max_tokens, model=model))
+        waiter = loop.create_task(first_delta.wait())
+        try:
+            # Срок попытки ограничивает ожидание первого фрагмента, дальше поток ограничен таймаутом чтения
+            await asyncio.wait({stream, waiter}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not stream.done() and not first_delta.is_set():
+                stream.cancel()
+                raise asyncio.TimeoutError(f"Нет ответа от {model} за {timeout:.1f} с")
+            try:
+                return await stream
+            except Exception as e:
+                if first_delta.is_set():
+                    raise _StreamStarted(e)
+                raise
+        finally:
+            waiter.cancel()
+            if not stream.done():
+                stream.cancel()
+
+
+class _StreamStarted(Exception):
+    """Поток оборвался после первого фрагмента - повтор невозможен."""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
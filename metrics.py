@@ -0,0 +1,182 @@
+import contextvars
+import functools
+import json
+import logging
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger('trace')
+
+# Границы корзин гистограммы длительности этапов, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Этапы текущего обновления для трассировки: список (этап, секунды) или None
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class _Span:
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class Metrics:
+    """Счетчики и гистограммы длительности этапов в формате Prometheus.
+
+    Этапы замеряются через with metrics.span('этап'). Внутри обработчика,
+    обернутого metrics.traced, длительности этапов собираются в трассировку
+    обновления, которая пишется одной строкой в логгер trace (если включен).
+    """
+
+    def __init__(self, prefix='bot', buckets=DEFAULT_BUCKETS, trace_enabled=False):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.trace_enabled = trace_enabled
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, stage, seconds):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = _Histogram(len(self.buckets))
+        index = bisect_left(self.buckets, seconds)
+        if index < len(self.buckets):
+            histogram.counts[index] += 1
+        histogram.sum += seconds
+        histogram.count += 1
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.append((stage, seconds))
+
+    def span(self, stage):
+        """Замер длительности этапа: with metrics.span('llm_call'): ..."""
+        return _Span(self, stage)
+
+    def gauge(self, name, callback, help_text=None):
+        """Значение, которое читается вызовом callback() в момент выгрузки метрик."""
+        self._gauges[name] = callback
+        if help_text:
+            self._help[name] = help_text
+
+    def traced(self, handler_name):
+        """Декоратор обработчика: замер всего обработчика и трассировка его этапов."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                self.inc('updates_total', handler=handler_name)
+                # Вложенный обработчик (голос -> текст) пишет этапы в трассировку внешнего
+                token = _current_trace.set([]) if self.trace_enabled and _current_trace.get() is None else None
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - started
+                    if token is not None:
+                        stages = _current_trace.get()
+                        _current_trace.reset(token)
+                        self._log_trace(handler_name, args, elapsed, stages)
+                    self.observe(f'handler_{handler_name}', elapsed)
+            return wrapper
+        return decorator
+
+    def _log_trace(self, handler_name, args, elapsed, stages):
+        update = args[0] if args else None
+        record = {
+            'handler': handler_name,
+            'update_id': getattr(update, 'update_id', None),
+            'user_id': getattr(getattr(update, 'effective_user', None), 'id', None),
+            'total_ms': round(elapsed * 1000, 1),
+            'stages': [[stage, round(seconds * 1000, 1)] for stage, seconds in stages],
+        }
+        trace_logger.info(json.dumps(record, ensure_ascii=False))
+
+    def render(self):
+        """Текст метрик в формате Prometheus exposition."""
+        lines = []
+        counters_by_name = {}
+        for (name, key), value in self._counters.items():
+            counters_by_name.setdefault(name, []).append((key, value))
+        for name, series in sorted(counters_by_name.items()):
+            full_name = f'{self.prefix}_{name}'
+            lines.append(f'# TYPE {full_name} counter')
+            for key, value in sorted(series):
+                lines.append(f'{full_name}{_format_labels(key)} {value}')
+
+        full_name = f'{self.prefix}_stage_seconds'
+        lines.append(f'# TYPE {full_name} histogram')
+        for stage, histogram in sorted(self._histograms.items()):
+            key = (('stage', stage),)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{full_name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{full_name}_bucket{_format_labels(key, [("le", "+Inf")])} {histogram.count}')
+            lines.append(f'{full_name}_sum{_format_labels(key)} {histogram.sum:.6f}')
+            lines.append(f'{full_name}_count{_format_labels(key)} {histogram.count}')
+
+        for name, callback in sorted(self._gauges.items()):
+            full_name = f'{self.prefix}_{name}'
+            try:
+                value = callback()
+            except Exception as e:
+                logger.error(f"Не удалось получить значение метрики {full_name}: {e}")
+                continue
+            if name in self._help:
+                lines.append(f'# HELP {full_name} {self._help[name]}')
+            lines.append(f'# TYPE {full_name} gauge')
+            lines.append(f'{full_name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+async def start_metrics_server(metrics, host, port):
+    """Поднимает HTTP-сервер с GET /metrics. Возвращает runner для остановки."""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,147 @@
+import functools
+import re
+from datetime import date, datetime
+from typing import NamedTuple, Optional
+
+DATE_FORMAT = '%d.%m.%Y'
+MIN_BIRTH_YEAR = 1900
+# Мастер-числа при сворачивании не сокращаются до одной цифры
+MASTER_NUMBERS = (11, 22, 33)
+
+# Краткие толкования чисел для ответов без обращения к LLM
+NUMBER_MEANINGS = {
+    1: "лидерство, независимость, воля к первенству. Вам важно прокладывать собственный путь и брать инициативу.",
+    2: "дипломатия, партнерство, чуткость. Ваша сила - в сотрудничестве и умении слышать других.",
+    3: "творчество, общение, оптимизм. Вам дано вдохновлять людей словом и идеями.",
+    4: "надежность, порядок, трудолюбие. Вы строите прочный фундамент шаг за шагом.",
+    5: "свобода, перемены, любознательность. Вас ведут новый опыт, путешествия и смелые решения.",
+    6: "забота, ответственность, гармония. Семья, дом и помощь близким - ваша опора.",
+    7: "анализ, мудрость, поиск истины. Вам важны глубина, уединение и духовный рост.",
+    8: "сила, материальный успех, управление. Вы умеете добиваться результата и распоряжаться ресурсами.",
+    9: "гуманизм, служение, завершение циклов. Ваш путь - щедрость и помощь миру.",
+    11: "мастер-число интуиции и вдохновения. Высокая чувствительность и способность вести за собой.",
+    22: "мастер-число созидателя. Умение воплощать большие замыслы в реальные дела.",
+    33: "мастер-число учителя. Любовь, сострадание и служение людям.",
+}
+
+PERSONAL_YEAR_MEANINGS = {
+    1: "год начинаний: время запускать новые проекты и закладывать основу на девять лет вперед.",
+    2: "год терпения и партнерства: укрепляйте отношения, не торопите события.",
+    3: "год самовыражения: общение, творчество и новые знакомства.",
+    4: "год труда: дисциплина, порядок в делах и финансах.",
+    5: "год перемен: переезды, новые возможности, свобода выбора.",
+    6: "год семьи и ответственности: дом, близкие, забота о здоровье.",
+    7: "год осмысления: учеба, анализ, работа над собой.",
+    8: "год результатов: карьера, деньги, признание усилий.",
+    9: "год завершения: отпускайте старое и подводите итоги цикла.",
+}
+
+
+class NumerologyProfile(NamedTuple):
+    date_of_birth: str
+    life_path: int
+    soul: int
+    # Рабочие числа и счетчики цифр 1-9 квадрата Пифагора
+    working_numbers: tuple
+    matrix: tuple
+
+
+def parse_birth_date(text) -> Optional[date]:
+    """Дата рождения из строки ДД.ММ.ГГГГ. None - если формат неверен, даты нет в календаре или она в будущем."""
+    text = text.strip()
+    if not re.match(r'^\d{2}\.\d{2}\.\d{4}$', text):
+        return None
+    try:
+        birth_date = datetime.strptime(text, DATE_FORMAT).date()
+    except ValueError:
+        return None
+    if birth_date.year < MIN_BIRTH_YEAR or birth_date > date.today():
+        return None
+    return birth_date
+
+
+def digit_sum(number):
+    return sum(int(digit) for digit in str(number))
+
+
+def reduce_number(number, keep_master=True):
+    """Сворачивает число суммой цифр до одной цифры (мастер-числа 11, 22, 33 сохраняются)."""
+    while number > 9 and not (keep_master and number in MASTER_NUMBERS):
+        number = digit_sum(number)
+    return number
+
+
+@functools.lru_cache(maxsize=65536)
+def profile(date_of_birth) -> NumerologyProfile:
+    """Основные числа для даты ДД.ММ.ГГГГ. Результат кэшируется по дате."""
+    day, month, year = (int(part) for part in date_of_birth.split('.'))
+    # Число судьбы (жизненного пути): день, месяц и год сворачиваются по отдельности
+    life_path = reduce_number(reduce_number(day) + reduce_number(month) + reduce_number(year))
+    soul = reduce_number(day)
+
+    # Квадрат Пифагора: рабочие числа по классической схеме, для рожденных после 2000 года - с поправкой +19
+    digits = date_of_birth.replace('.', '')
+    first = digit_sum(digits)
+    second = digit_sum(first)
+    if year < 2000:
+        third = first - 2 * int(str(day)[0])
+    else:
+        third = first + 19
+    fourth = digit_sum(third)
+    working = (first, second, third, fourth)
+    all_digits = digits + ''.join(str(number) for number in working)
+    matrix = tuple(all_digits.count(str(digit)) for digit in range(1, 10))
+    return NumerologyProfile(date_of_birth, life_path, soul, working, matrix)
+
+
+@functools.lru_cache(maxsize=65536)
+def personal_year(date_of_birth, year):
+    day, month, _ = (int(part) for part in date_of_birth.split('.'))
+    return reduce_number(reduce_number(day) + reduce_number(month) + reduce_number(year), keep_master=False)
+
+
+def format_for_prompt(date_of_birth, today=None):
+    """Рассчитанные числа одной строкой для промпта."""
+    numbers = profile(date_of_birth)
+    year = (today or date.today()).year
+    matrix = ', '.join(f"{digit}: {str(digit) * count or '-'}" for digit, count in enumerate(numbers.matrix, 1))
+    return (f"число судьбы (жизненного пути) {numbers.life_path}; число души {numbers.soul}; "
+            f"личный год {year} - {personal_year(date_of_birth, year)}; "
+            f"рабочие числа {'.'.join(map(str, numbers.working_numbers))}; квадрат Пифагора [{matrix}]")
+
+
+# Частые вопросы, на которые отвечаем готовым толкованием: шаблон вопроса -> тема
+COMMON_QUESTIONS = (
+    (re.compile(r'(число|цифр\w*) (моей |моего )?(судьбы|жизненного пути)'), 'life_path'),
+    (re.compile(r'(число|цифр\w*) (моей )?души'), 'soul'),
+    (re.compile(r'личн\w* год'), 'personal_year'),
+)
+# Длинные вопросы с подробностями отдаем LLM, даже если в них упомянута тема
+CANNED_MAX_WORDS = 10
+
+
+def canned_answer(date_of_birth, question, today=None):
+    """Готовый ответ на частый вопрос о числах пользователя (None, если вопрос не из частых)."""
+    words = re.findall(r'\w+', question.lower().replace('ё', 'е'))
+    if len(words) > CANNED_MAX_WORDS:
+        return None
+    normalized = ' '.join(words)
+    topics = [topic for pattern, topic in COMMON_QUESTIONS if pattern.search(normalized)]
+    if len(topics) != 1:
+        return None
+    numbers = profile(date_of_birth)
+    if topics[0] == 'life_path':
+        return f"🔢 Ваше число судьбы (жизненного пути) - {numbers.life_path}: {NUMBER_MEANINGS[numbers.life_path]}"
+    if topics[0] == 'soul':
+        return f"🔢 Ваше число души - {numbers.soul}: {NUMBER_MEANINGS[numbers.soul]}"
+    year = (today or date.today()).year
+    number = personal_year(date_of_birth, year)
+    return f"🔢 {year} год для вас - личный год {number}, {PERSONAL_YEAR_MEANINGS[number]}"
+
+
+def summary(date_of_birth):
+    """Краткая справка по числам сразу после ввода даты рождения."""
+    numbers = profile(date_of_birth)
+    return (f"🔢 Ваши числа:\n"
+            f"• Число судьбы (жизненного пути) - {numbers.life_path}: {NUMBER_MEANINGS[numbers.life_path]}\n"
+            f"• Число души - {numbers.soul}: {NUMBER_MEANINGS[numbers.soul]}")
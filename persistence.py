@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPersistence(BasePersistence):
+    """Хранение user_data, chat_data и bot_data приложения в SessionStore.
+
+    Данные пользователей и чатов не загружаются при запуске: сессия читается
+    из базы при первом обновлении от пользователя (refresh_user_data), а если
+    ее там нет - собирается из seed(user_id), например из данных рождения,
+    уже сохраненных в записи пользователя. Application раз в update_interval
+    секунд передает изменившиеся данные, и все они пишутся одной транзакцией.
+    У user_data сохраняются только поля SESSION_FIELDS.
+
+    Чтение из базы выполняется в отдельном потоке, отметки о загруженных
+    пользователях и чатах хранятся для max_entries последних.
+    """
+
+    def __init__(self, store, seed=None, update_interval=60, max_entries=10000):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.store = store
+        self.seed = seed
+        self.max_entries = max_entries
+        # Ключ -> задача загрузки: параллельные обновления одного пользователя ждут одну загрузку
+        self._hydrated_users = OrderedDict()
+        self._hydrated_chats = OrderedDict()
+        self._pending_users = {}
+        self._pending_chats = {}
+        self._pending_bot_data = None
+        self._write_task = None
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return await asyncio.to_thread(self.store.load_data, 'bot') or {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Только при первом обращении: дальше актуальна копия в памяти, в том числе удаленные из нее поля
+        await self._hydrate_once(self._hydrated_users, user_id, lambda: self._hydrate_user(user_id, user_data))
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._hydrate_once(self._hydrated_chats, chat_id, lambda: self._hydrate_chat(chat_id, chat_data))
+
+    async def _hydrate_once(self, hydrated, key, hydrate):
+        task = hydrated.get(key)
+        if task is None:
+            task = asyncio.ensure_future(hydrate())
+            hydrated[key] = task
+        hydrated.move_to_end(key)
+        while len(hydrated) > self.max_entries:
+            hydrated.popitem(last=False)
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            # Следующее обновление попробует загрузить данные снова
+            if hydrated.get(key) is task:
+                del hydrated[key]
+            raise
+
+    async def _hydrate_user(self, user_id, user_data):
+        if not self.store.is_cached(user_id):
+            await asyncio.to_thread(self.store.get, user_id)
+        self.store.hydrate(user_id, user_data, self.seed(user_id) if self.seed else None)
+
+    async def _hydrate_chat(self, chat_id, chat_data):
+        for key, value in (await asyncio.to_thread(self.store.load_data, 'chat', chat_id) or {}).items():
+            chat_data.setdefault(key, value)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        self._pending_users[user_id] = dict(data)
+        await self._write_pending()
+
+    async def update_chat_data(self, chat_id, data):
+        self._pending_chats[chat_id] = dict(data)
+        await self._write_pending()
+
+    async def update_bot_data(self, data):
+        self._pending_bot_data = dict(data)
+        await self._write_pending()
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._pending_users.pop(user_id, None)
+        self._hydrated_users.pop(user_id, None)
+        await asyncio.to_thread(self.store.delete, user_id)
+
+    async def drop_chat_data(self, chat_id):
+        self._pending_chats.pop(chat_id, None)
+        self._hydrated_chats.pop(chat_id, None)
+        await asyncio.to_thread(self.store.delete_data, 'chat', chat_id)
+
+    async def flush(self):
+        if self._write_task is not None:
+            await asyncio.shield(self._write_task)
+        self._write_batch(*self._take_pending())
+
+    async def _write_pending(self):
+        # Application вызывает update_* для всех изменившихся пользователей и чатов одновременно:
+        # первый вызов запускает запись, остальные успевают добавить свои данные и ждут ту же транзакцию
+        if self._write_task is None:
+            self._write_task = asyncio.get_running_loop().create_task(self._write())
+        await asyncio.shield(self._write_task)
+
+    async def _write(self):
+        await asyncio.sleep(0)
+        self._write_task = None
+        await asyncio.to_thread(self._write_batch, *self._take_pending())
+
+    def _take_pending(self):
+        users, self._pending_users = self._pending_users, {}
+        chats, self._pending_chats = self._pending_chats, {}
+        bot_data, self._pending_bot_data = self._pending_bot_data, None
+        return users, chats, bot_data
+
+    def _write_batch(self, users, chats, bot_data):
+        written = self.store.save_many(users) if users else 0
+        if chats:
+            self.store.save_data('chat', chats)
+        if bot_data is not None:
+            self.store.save_data('bot', {0: bot_data})
+        if written:
+            logger.debug(f"Сохранено сессий пользователей: {written}")
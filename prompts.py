@@ -0,0 +1,223 @@
+import functools
+from dataclasses import dataclass
+from typing import Optional
+
+from token_usage import count_tokens
+
+SAFETY_INSTRUCTION = ("Анализируй каждый запрос на предмет содержания. Если запрос "
+                      "содержит неадекватные, аморальные, пошлые, агрессивные, деструктивные элементы, ответь "
+                      "следующим образом: 'Извините, я не могу отвечать на подобные вопросы. Пожалуйста, направьте "
+                      "ваши запросы в безопасное и конструктивное русло.'")
+
+# Сводка ранних реплик разговора, которые не попадают в окно истории
+SUMMARY_FACTS = "Краткое содержание предыдущего разговора: {summary}"
+
+# Примерные накладные расходы формата chat completions на одно сообщение
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@dataclass(frozen=True)
+class RoleSpec:
+    """Описание роли: промпты для LLM и тексты для пользователя."""
+    title: str
+    # Неизменный системный промпт роли - общий префикс для всех пользователей
+    system: str
+    # Текст сообщения-заглушки, пока готовится ответ
+    waiting_text: str
+    # Приветствие при выборе роли
+    welcome: Optional[str] = None
+    # Сведения о пользователе, которые идут отдельным системным сообщением после префикса
+    facts: Optional[str] = None
+    # Обертка первого вопроса, когда истории общения еще нет
+    first_message: str = "{message}"
+    # Первое сообщение от имени пользователя, если роль сама начинает диалог
+    opener: Optional[str] = None
+
+
+ROLES = {
+    'tarot': RoleSpec(
+        title="Таро",
+        system="Ты - гадалка на картах ТАРО. Давай меньше воды, теории и больше интерпретации. Рассказывай так, "
+               "чтобы читателю было интересно и создавалось впечатление, что человек на реальном приеме у гадалки.",
+        waiting_text="🔮Толкую карты...🔮",
+        # Карты раскладывает бот, модель их только толкует
+        facts="Расклад «{spread_title}», выложенный на первый вопрос пользователя (позиция: карта - значение):\n{cards}\n"
+              "Пользователь уже видит карты - не перечисляй их заново, а сразу толкуй применительно к вопросу. "
+              "Уточняющие вопросы толкуй по этому же раскладу.",
+        first_message="Дай предсказание по раскладу на вопрос: {message}",
+        welcome=(
+            "✨ Добро пожаловать в мир ТАРО! ✨\n\n"
+            "🃏 Карты Таро могут помочь вам раскрыть скрытые аспекты вашей жизни, получить ценные советы и посмотреть на ситуацию с новой стороны.\n\n"
+            "1. Задайте любой вопрос, который у вас на сердце — это может быть вопрос о любви, карьере, здоровье или будущем.\n"
+            "2. Постарайтесь быть конкретным в своём вопросе, чтобы карты могли дать вам наиболее точный ответ.\n\n"
+            "🔮 Примеры вопросов:\n"
+            "- Какие шаги мне следует предпринять для карьерного роста?\n"
+            "- Какое решение будет наилучшим в текущей ситуации?\n"
+            "- Как бы я хотела выстроить эти отношения?\n\n"
+            "Не стесняйтесь, задайте свой вопрос, и пусть карты ТАРО откроют вам свою мудрость!\n\n"
+            "Уточняющие вопросы толкуются по тем же картам. Чтобы разложить карты заново, нажмите /tarot."
+        ),
+    ),
+    'astrology': RoleSpec(
+        title="Астролог",
+        system="Ты - астролог. Общайся так, чтобы казалось, что человек на реальном приеме у профессионального "
+               "астролога. В ответах давай меньше воды и больше полезной информации и интерпретаций. Не говори о том, "
+               "что ты не можешь рассчитать что-то и тем более не нужно рекомендовать посетить какие-то сайты.",
+        waiting_text="🌘Составляю карту планет...🌘",
+        # Положения планет считает бот, модель их только толкует
+        facts="Дата рождения пользователя {date_of_birth}, время рождения {time_of_birth}, место рождения {place_of_birth}. "
+              "Натальная карта (рассчитана точно, не пересчитывай): {chart}",
+        first_message="Дай мне ответ как астролог на основе моей натальной карты на мой вопрос: {message}",
+        welcome=(
+            "Астролог\n\n"
+            "Добро пожаловать в мир астрологии! ✨\n\n"
+            "Как астролог, я помогу вам понять, как звезды и планеты могут влиять на вашу жизнь.\n\n"
+            "Мне понадобятся данные о вашей дате, времени и месте рождения, чтобы я мог составить ваш персональный гороскоп и поделиться с вами удивительными астрологическими прогнозами.\n\n"
+            "Вот несколько примеров вопросов, которые вы можете задать:\n"
+            "- Что говорит мой солнечный знак обо мне?\n"
+            "- Какие планеты влияют на мою карьеру и отношения?\n"
+            "- Как лунные фазы могут повлиять на мое настроение и энергию?\n\n"
+            "Но, возможно, у вас есть свой вопрос, который больше вас интересует. Жду вашего запроса и готов помочь вам раскрыть тайны вашего астрологического пути.\n\n"
+            "Введите вашу дату рождения в формате ДД.ММ.ГГГГ (Например: 01.01.1995):"
+        ),
+    ),
+    'numerology': RoleSpec(
+        title="Нумеролог",
+        system="Ты - нумеролог. В ответах давай меньше воды и вступительных слов, а больше полезной информации и интерпретаций.",
+        waiting_text="🔢Считаю цифры...🔢",
+        # Числа считает бот, модель их только толкует
+        facts="Дата рождения пользователя {date_of_birth}. Рассчитанные числа (расчет верный, не пересчитывай их): "
+              "{numbers}.",
+        first_message="Я пришел к тебе на прием впервые, поэтому возьми инициативу по диалогу на себя. Дай прогноз "
+                      "на мой вопрос: {message}. Или предложи мне несколько популярных вопросов, с которых мы можем начать.",
+        welcome=(
+            "Нумеролог\n\n"
+            "Добро пожаловать в мир нумерологии! 🌟\n\n"
+            "Как нумеролог, я помогу вам раскрыть тайны чисел, которые могут пролить свет на вашу личность, судьбу и жизненные пути.\n\n"
+            "Мне понадобится дата вашего рождения, чтобы я мог провести анализ и поделиться с вами удивительными инсайтами о вашем жизненном пути и предназначении.\n\n"
+            "Не стесняйтесь задавать вопросы о том, как числа могут влиять на вашу жизнь и как использовать эту информацию для личного роста и развития. Вот несколько примеров вопросов, которые вы можете задать:\n"
+            "- Какое значение имеет мое число судьбы?\n"
+            "- Как числа влияют на мою карьеру и личные отношения?\n\n"
+            "Или можете задать любой другой вопрос, а я постараюсь помочь вам узнать больше о себе через призму чисел.\n\n"
+            "Для продолжения введите свою дату рождения в формате ДД.ММ.ГГГГ (например: 01.01.1995):"
+        ),
+    ),
+    'self_development_coach': RoleSpec(
+        title="Коуч по саморазвитию",
+        system="Ты - коуч по саморазвитию. Разговор должен быть интерактивным, вовлекающим.",
+        waiting_text="💪Составляю ответ...💪",
+        opener="Я впервые на приеме у коуча по саморазвитию, поэтому возьми инициативу по диалогу в свои руки.",
+    ),
+    'psychologist': RoleSpec(
+        title="Психолог",
+        system="Ты - психолог. Держи ответы неформальными, но точными. Используй технические термины и концепции "
+               "свободно — считай, что собеседник в теме. Будь прямым. Избавься от вежливых формальностей и лишней "
+               "вежливости. Приводи примеры только когда уместно. Подстраивай глубину и длину ответов под контекст. "
+               "Сначала точность, но без лишней воды. Короткие, четкие фразы — нормально. Дай своей личности "
+               "проявиться, но не затми суть. Не старайся быть «супер-помощником» в каждом предложении.",
+        waiting_text="🧠Составляю ответ...🧠",
+        facts="Ты работаешь по методике {method_text}.",
+        welcome="Вы выбрали роль психолога. Выберите методику терапии или нажмите 'не разбираюсь':",
+    ),
+    'career_consultant': RoleSpec(
+        title="Карьерный консультант",
+        system="Ты - опытный карьерный консультант. Веди интерактивный диалог.",
+        waiting_text="💼Составляю ответ...💼",
+        first_message="Я пришел к тебе на прием впервые. Ответь на вопрос: {message}",
+        welcome=(
+            "Карьерный консультант\n\n"
+            "💼 Добро пожаловать к Карьерному консультанту!\n\n"
+            "Я могу помочь вам с профессиональными советами, планированием карьеры и достижением ваших карьерных целей.\n\n"
+            "❓ **Как это работает:**\n"
+            "1. Опишите вашу текущую профессиональную ситуацию или задайте конкретный вопрос о карьере.\n"
+            "2. Я дам вам рекомендации и советы, чтобы помочь вам продвинуться в вашей карьере.\n\n"
+            "🔮 **Примеры вопросов:**\n"
+            "- Как мне улучшить свои навыки для повышения?\n"
+            "- Как подготовиться к собеседованию на новую работу?\n"
+            "- Как достичь баланса между работой и личной жизнью?\n\n"
+            "Не стесняйтесь, задайте свой вопрос, и я помогу вам найти наилучшее решение!"
+        ),
+    ),
+}
+
+# Методики психолога: callback_data -> (надпись на кнопке, название в промпте)
+PSYCHOLOGY_METHODS = {
+    "cbt": ("Когнитивно-поведенческая", "когнитивно-поведенческая"),
+    "psychodynamic": ("Психодинамическая", "психодинамическая"),
+    "gestalt": ("Гештальт-терапия", "гештальт-терапия"),
+    "unsure": ("Не разбираюсь", "которая будет эффективна в моем случае"),
+}
+
+# Первые сообщения для методик, с которых психолог начинает сам
+PSYCHOLOGY_OPENERS = {
+    "gestalt": "Если у вас есть конкретные вопросы или темы, которые вы хотите обсудить в контексте гештальт-терапии, пожалуйста, дайте знать. Я здесь, чтобы помочь!",
+    "unsure": (
+        "Похоже, что вы хотите начать терапевтический процесс, но не уверены, с чего начать. Позвольте мне предложить несколько известных методик терапии, чтобы помочь вам выбрать подходящую для вас:\n\n"
+        "1. Когнитивно-поведенческая терапия (КПТ) фокусируется на изменении деструктивных мыслей и поведения. Подходит при тревожности, депрессии и фобиях.\n\n"
+        "2. Гуманистическая терапия - акцент на самопознании и самореализации.\n\n"
+        "3. Терапия, основанная на осознании (майндфулнесс): включает практики медитации и внимательности, помогает снизить уровень стресса и повысить эмоциональную устойчивость.\n\n"
+        "4. Психоаналитическая терапия  исследует бессознательные процессы и их влияние на поведение.\n\n"
+        "Вы можете выбрать ту методику, которая вам подходит больше всего. Или же напишите, о чем вы хотели бы поговорить?"
+    ),
+}
+
+
+# Запросы недостающих данных рождения
+ASK_TIME_OF_BIRTH = "Введите время рождения в формате ЧЧ:ММ (например 07:20 или 19:00):"
+ASK_PLACE_OF_BIRTH = "Введите место рождения в свободной форме (Например: Казань или Выборг, Ленинградская обл. и тд):"
+
+
+def psychology_method_text(method):
+    return PSYCHOLOGY_METHODS.get(method, PSYCHOLOGY_METHODS["unsure"])[1]
+
+
+@functools.lru_cache(maxsize=4096)
+def _message_tokens(text):
+    # История повторяется из запроса в запрос, поэтому токены сообщений кэшируются
+    return count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+
+class PromptBuilder:
+    """Собирает messages для chat completions в пределах бюджета токенов.
+
+    Порядок: стабильный системный промпт роли, сведения о пользователе, сводка
+    ранних реплик, история (от новых к старым, пока хватает бюджета) и текущее
+    сообщение.
+    """
+
+    def __init__(self, token_budget=3000):
+        self.token_budget = token_budget
+
+    def system_prompt(self, role):
+        return f"{ROLES[role].system} {SAFETY_INSTRUCTION}"
+
+    def build(self, role, history, message, summary=None, **facts):
+        spec = ROLES[role]
+        head = [{'role': 'system', 'content': self.system_prompt(role)}]
+        if spec.facts:
+            head.append({'role': 'system', 'content': spec.facts.format(**facts)})
+        if summary:
+            head.append({'role': 'system', 'content': SUMMARY_FACTS.format(summary=summary)})
+        if not history and not summary:
+            message = spec.first_message.format(message=message)
+        tail = [{'role': 'user', 'content': message}]
+
+        budget = self.token_budget - sum(_message_tokens(item['content']) for item in head + tail)
+        kept = []
+        for entry in reversed(history):
+            cost = _message_tokens(entry['message'])
+            if cost > budget:
+                break
+            budget -= cost
+            kept.append({'role': 'assistant' if entry['role'] == 'bot' else 'user', 'content': entry['message']})
+        kept.reverse()
+        return head + kept + tail
+
+    def build_opener(self, role, opener=None, **facts):
+        """Сообщения для первой реплики, когда роль сама начинает диалог."""
+        spec = ROLES[role]
+        messages = [{'role': 'system', 'content': self.system_prompt(role)}]
+        if spec.facts:
+            messages.append({'role': 'system', 'content': spec.facts.format(**facts)})
+        messages.append({'role': 'user', 'content': opener or spec.opener})
+        return messages
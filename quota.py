@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+WINDOW_DAILY = 'daily'
+WINDOW_SLIDING = 'sliding'
+# Общий для всех ролей счетчик, если для роли нет отдельного лимита
+ALL_ROLES = '*'
+
+
+class QuotaDecision(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    # Через сколько секунд освободится квота (для скользящего окна), иначе None
+    retry_after: Optional[float] = None
+
+
+def parse_limits(spec):
+    """Разбирает строку вида "free:*=5,free:psychologist=10,premium:*=50" в словарь."""
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        scope, _, value = item.partition('=')
+        tier, _, role = scope.strip().partition(':')
+        limits[(tier or ALL_ROLES, role or ALL_ROLES)] = int(value)
+    return limits
+
+
+class QuotaLimiter:
+    """Лимиты запросов пользователей с атомарной проверкой и учетом.
+
+    Лимит ищется по (тариф, роль), затем (тариф, *), (*, роль) и default_limit;
+    отрицательный лимит - без ограничений. Если для роли задан свой лимит,
+    запросы к ней считаются отдельно, иначе в общем счетчике пользователя.
+
+    Окно daily - календарный день в часовом поясе пользователя, sliding -
+    последние window_seconds секунд. Счетчики живут в памяти (проверка не
+    трогает диск), снимок пишется в файл вызовом save.
+    """
+
+    def __init__(self, snapshot_path, limits=None, default_limit=5, window=WINDOW_DAILY, window_seconds=24 * 60 * 60,
+                 timezone=None, tier_of=None, timezone_of=None):
+        if window not in (WINDOW_DAILY, WINDOW_SLIDING):
+            raise ValueError(f"Неизвестный тип окна квоты: {window}")
+        self.snapshot_path = snapshot_path
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.window = window
+        self.window_seconds = window_seconds
+        self.timezone = timezone
+        self.tier_of = tier_of or (lambda user_id: ALL_ROLES)
+        self.timezone_of = timezone_of or (lambda user_id: None)
+        # daily: (user_id, role) -> [дата, счетчик]; sliding: (user_id, role) -> deque времен запросов
+        self._counters = {}
+        self._dirty = False
+        self._save_lock = asyncio.Lock()
+
+    def limit_for(self, user_id, role):
+        """Возвращает (лимит, счетчик роли) для пользователя."""
+        tier = self.tier_of(user_id)
+        for key in ((tier, role), (tier, ALL_ROLES), (ALL_ROLES, role)):
+            if key in self.limits:
+                return self.limits[key], role if key[1] != ALL_ROLES else ALL_ROLES
+        return self.default_limit, ALL_ROLES
+
+    def consume(self, user_id, role=None):
+        """Проверяет лимит и сразу учитывает запрос, если он разрешен."""
+        limit, counter_role = self.limit_for(user_id, role or ALL_ROLES)
+        if limit < 0:
+            return QuotaDecision(True, limit, -1)
+        key = (user_id, counter_role)
+        if self.window == WINDOW_DAILY:
+            today = self._today(user_id)
+            counter = self._counters.get(key)
+            if counter is None or counter[0] != today:
+                counter = self._counters[key] = [today, 0]
+            if counter[1] >= limit:
+                return QuotaDecision(False, limit, 0)
+            counter[1] += 1
+            used = counter[1]
+        else:
+            now = time.time()
+            events = self._counters.setdefault(key, deque())
+            while events and events[0] <= now - self.window_seconds:
+                events.popleft()
+            if len(events) >= limit:
+                return QuotaDecision(False, limit, 0, events[0] + self.window_seconds - now)
+            events.append(now)
+            used = len(events)
+        self._dirty = True
+        return QuotaDecision(True, limit, limit - used)
+
+    def refund(self, user_id, role=None):
+        """Возвращает запрос в квоту (например, если ответ не удалось получить)."""
+        _, counter_role = self.limit_for(user_id, role or ALL_ROLES)
+        counter = self._counters.get((user_id, counter_role))
+        if not counter:
+            return
+        if self.window == WINDOW_DAILY:
+            counter[1] = max(counter[1] - 1, 0)
+        else:
+            counter.pop()
+        self._dirty = True
+
+    def seed_daily(self, user_id, date, count):
+        """Переносит счетчик за день из старых полей daily_requests/last_request_date."""
+        if self.window == WINDOW_DAILY and (user_id, ALL_ROLES) not in self._counters:
+            self._counters[(user_id, ALL_ROLES)] = [date, count]
+
+    def _today(self, user_id):
+        return datetime.now(self.timezone_of(user_id) or self.timezone).strftime('%Y-%m-%d')
+
+    def load(self):
+        """Загружает снимок счетчиков, если он сделан для того же типа окна."""
+        if not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать снимок квот {self.snapshot_path}: {e}")
+            return False
+        if snapshot.get('window') != self.window:
+            return False
+        for user_id, role, value in snapshot['counters']:
+            self._counters[(user_id, role)] = list(value) if self.window == WINDOW_DAILY else deque(value)
+        return True
+
+    def _snapshot(self):
+        if self.window == WINDOW_DAILY:
+            counters = [[user_id, role, counter] for (user_id, role), counter in self._counters.items()]
+        else:
+            min_time = time.time() - self.window_seconds
+            counters = [[user_id, role, [event for event in events if event > min_time]]
+                        for (user_id, role), events in self._counters.items() if events and events[-1] > min_time]
+        return {'window': self.window, 'counters': counters}
+
+    def _write(self, snapshot):
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def save(self):
+        """Пишет снимок счетчиков на диск, если они менялись."""
+        async with self._save_lock:
+            if not self._dirty:
+                return False
+            self._dirty = False
+            try:
+                await asyncio.to_thread(self._write, self._snapshot())
+            except Exception:
+                self._dirty = True
+                raise
+            return True
+
+
+class TokenBudgetExceeded(Exception):
+    """Общий бюджет токенов в минуту исчерпан."""
+
+
+class TokenBudget:
+    """Общий для всех запросов бюджет токенов LLM на скользящую минуту.
+
+    Перед запросом резервируется оценка токенов, после ответа резерв
+    уточняется фактическим расходом. tokens_per_minute <= 0 отключает бюджет.
+    """
+
+    def __init__(self, tokens_per_minute, max_wait=10.0, period=60.0):
+        self.tokens_per_minute = tokens_per_minute
+        self.max_wait = max_wait
+        self.period = period
+        self._events = deque()
+        self._used = 0
+
+    def _expire(self, now):
+        while self._events and self._events[0][0] <= now - self.period:
+            self._used -= self._events.popleft()[1]
+
+    async def acquire(self, tokens):
+        """Резервирует tokens, ожидая не дольше max_wait. Иначе TokenBudgetExceeded."""
+        if self.tokens_per_minute <= 0:
+            return
+        # Запрос больше всего бюджета пропускаем в пустую минуту, иначе он не пройдет никогда
+        tokens = min(tokens, self.tokens_per_minute)
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            now = time.monotonic()
+            self._expire(now)
+            if self._used + tokens <= self.tokens_per_minute:
+                self._events.append((now, tokens))
+                self._used += tokens
+                return
+            wait = self._events[0][0] + self.period - now
+            if now + wait > deadline:
+                raise TokenBudgetExceeded(f"Бюджет {self.tokens_per_minute} токенов в минуту исчерпан")
+            await asyncio.sleep(wait)
+
+    def adjust(self, delta):
+        """Поправка резерва на разницу между фактическим расходом и оценкой."""
+        if self.tokens_per_minute <= 0 or not delta:
+            return
+        self._events.append((time.monotonic(), delta))
+        self._used += delta
+
+    @property
+    def used(self):
+        self._expire(time.monotonic())
+        return self._used
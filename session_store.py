@@ -0,0 +1,124 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Поля context.user_data, которые переживают перезапуск и переход пользователя на другой шард
+SESSION_FIELDS = ('role', 'psychology_method', 'date_of_birth', 'time_of_birth', 'place_of_birth',
+                  'tarot_spread', 'tarot_seed')
+
+
+class SessionStore:
+    """Состояние диалога пользователя (роль, методика, данные рождения, текущий расклад Таро) в SQLite.
+
+    При первом обращении к пользователю hydrate дополняет context.user_data
+    сохраненными полями, save_many пишет изменившиеся сессии одной транзакцией.
+    В той же базе лежат chat_data и bot_data. База общая для всех процессов,
+    поэтому любой шард восстанавливает сессию пользователя. В памяти держатся
+    max_entries последних использованных сессий.
+    """
+
+    def __init__(self, db_path, max_entries=10000):
+        self.max_entries = max_entries
+        self._known = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS persistent_data ("
+            "scope TEXT NOT NULL, key INTEGER NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (scope, key))"
+        )
+
+    def get(self, user_id):
+        """Сохраненные поля сессии пользователя (пустой словарь, если сессии нет)."""
+        session = self._known.get(user_id)
+        if session is None:
+            with self._lock:
+                row = self._conn.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            session = json.loads(row[0]) if row else {}
+        self._remember(user_id, session)
+        return session
+
+    def is_cached(self, user_id):
+        """Сессия есть в памяти, и get не обратится к базе."""
+        return user_id in self._known
+
+    def _remember(self, user_id, session):
+        self._known[user_id] = session
+        self._known.move_to_end(user_id)
+        while len(self._known) > self.max_entries:
+            self._known.popitem(last=False)
+
+    def hydrate(self, user_id, user_data, seed=None):
+        """Дополняет user_data сохраненными полями, которых в нем еще нет.
+
+        Если сессии в базе нет, поля берутся из seed (например, данные рождения из записи пользователя).
+        """
+        session = self.get(user_id) or self.snapshot(seed or {})
+        for field, value in session.items():
+            if value is not None and field not in user_data:
+                user_data[field] = value
+
+    def snapshot(self, user_data):
+        return {field: user_data.get(field) for field in SESSION_FIELDS if user_data.get(field) is not None}
+
+    def save_many(self, sessions):
+        """Записывает изменившиеся сессии {user_id: user_data} одной транзакцией. Возвращает число записанных."""
+        changed = {}
+        for user_id, user_data in sessions.items():
+            session = self.snapshot(user_data)
+            if session != self.get(user_id):
+                changed[user_id] = session
+        if not changed:
+            return 0
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+                                   [(user_id, json.dumps(session, ensure_ascii=False), now)
+                                    for user_id, session in changed.items()])
+        for user_id, session in changed.items():
+            self._remember(user_id, session)
+        return len(changed)
+
+    def delete(self, user_id):
+        self._remember(user_id, {})
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def load_data(self, scope, key=0):
+        """Сохраненные chat_data (scope='chat') или bot_data (scope='bot', key=0); None, если их нет."""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM persistent_data WHERE scope = ? AND key = ?",
+                                     (scope, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_data(self, scope, items):
+        """Записывает словари {key: data} одной транзакцией. Несериализуемые в JSON пропускаются."""
+        rows = []
+        now = time.time()
+        for key, data in items.items():
+            try:
+                rows.append((scope, key, json.dumps(data, ensure_ascii=False), now))
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Данные {scope} {key} не сохранены: {e}")
+        if rows:
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO persistent_data (scope, key, data, updated_at) VALUES (?, ?, ?, ?)", rows)
+
+    def delete_data(self, scope, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM persistent_data WHERE scope = ? AND key = ?", (scope, key))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Виды обновлений, в которых есть поле from с автором
+_UPDATE_KINDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                 'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+                 'chat_join_request', 'message_reaction')
+
+
+def shard_of(user_id, shard_count):
+    return user_id % shard_count
+
+
+def update_user_id(data):
+    """user_id автора обновления из его JSON (None, если автора нет, например у постов каналов)."""
+    for kind in _UPDATE_KINDS:
+        payload = data.get(kind)
+        if payload:
+            author = payload.get('from') or payload.get('user')
+            if author:
+                return author['id']
+            chat = payload.get('chat')
+            return chat['id'] if chat else None
+    return None
+
+
+def shard_path(path, shard_index):
+    """Путь к файлу шарда: chat_history.log -> chat_history.shard2.log. Без шарда - исходный путь."""
+    if shard_index is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_index}{ext}"
+
+
+class JobLease:
+    """Аренда задачи в общей SQLite: из нескольких процессов задачу выполняет один.
+
+    Аренду получает процесс, если ее нет, она уже принадлежит ему или истекла.
+    """
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute("CREATE TABLE IF NOT EXISTS job_leases ("
+                           "name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def try_acquire(self, name, owner, ttl):
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE сразу берет блокировку записи, чтобы два процесса не прочитали одно и то же
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute("SELECT owner, expires_at FROM job_leases WHERE name = ?", (name,)).fetchone()
+                if row and row[0] != str(owner) and row[1] > now:
+                    self._conn.execute('ROLLBACK')
+                    return False
+                self._conn.execute("INSERT OR REPLACE INTO job_leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                                   (name, str(owner), now + ttl))
+                self._conn.execute('COMMIT')
+                return True
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ShardDispatcher:
+    """Распределяет обновления по процессам-шардам по user_id.
+
+    Каждый шард - отдельный процесс, запущенный как target(updates_queue) с
+    переменными окружения SHARD_INDEX и SHARD_COUNT. У каждого пользователя один
+    шард-владелец, поэтому его обновления обрабатываются по порядку в одном
+    процессе. Обновления без автора идут в шард 0.
+    """
+
+    def __init__(self, shard_count, target, max_queue=1000):
+        self.shard_count = shard_count
+        self.target = target
+        self.max_queue = max_queue
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = []
+        self._processes = []
+
+    def start(self):
+        for index in range(self.shard_count):
+            updates = self._context.Queue(self.max_queue)
+            os.environ['SHARD_INDEX'] = str(index)
+            os.environ['SHARD_COUNT'] = str(self.shard_count)
+            process = self._context.Process(target=self.target, args=(updates,), name=f'shard-{index}')
+            process.start()
+            self._queues.append(updates)
+            self._processes.append(process)
+        os.environ.pop('SHARD_INDEX', None)
+        logger.info(f"Запущено {self.shard_count} шардов")
+
+    def route(self, data):
+        """Передает JSON обновления шарду-владельцу. Возвращает False, если очередь шарда заполнена."""
+        user_id = update_user_id(data)
+        index = shard_of(user_id, self.shard_count) if user_id is not None else 0
+        try:
+            self._queues[index].put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    async def poll(self, bot, timeout=30):
+        """Получает обновления через getUpdates и раздает их шардам до отмены задачи."""
+        await bot.delete_webhook()
+        offset = None
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=[],
+                                                    read_timeout=timeout + 10)
+                except Exception as e:
+                    logger.error(f"Ошибка getUpdates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    data = update.to_dict()
+                    if not self.route(data):
+                        # Шард не успевает - ждем места в его очереди, не теряя обновление
+                        user_id = update_user_id(data)
+                        index = shard_of(user_id, self.shard_count) if user_id is not None else 0
+                        await loop.run_in_executor(None, self._queues[index].put, data)
+                    offset = update.update_id + 1
+        finally:
+            if offset is not None:
+                # Подтверждаем розданные обновления, чтобы после перезапуска они не пришли повторно
+                try:
+                    await bot.get_updates(offset=offset, timeout=0)
+                except Exception as e:
+                    logger.warning(f"Не удалось подтвердить обновления до {offset}: {e}")
+
+    def stop(self, timeout=60):
+        """Просит шарды доработать очереди и завершиться."""
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Шард {process.name} не завершился за {timeout} с, останавливаем принудительно")
+                process.terminate()
+
+
+async def run_shard_worker(application, updates, drain=None, drain_timeout=30.0):
+    """Цикл процесса-шарда: читает JSON обновлений из очереди диспетчера до None."""
+    from telegram import Update
+
+    # Ctrl+C получает вся группа процессов - шард останавливается только по команде диспетчера
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        if drain is not None:
+            try:
+                await asyncio.wait_for(drain(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не все обработчики шарда завершились за {drain_timeout} с")
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,134 @@
+import logging
+import os
+import re
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Латинские буквы и цифры, похожие на кириллические
+HOMOGLYPHS = str.maketrans({
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м', 'o': 'о',
+    'p': 'р', 't': 'т', 'x': 'х', 'y': 'у', 'u': 'и', 'n': 'п', 'r': 'г',
+    '0': 'о', '3': 'з', '4': 'ч', '6': 'б', '@': 'а', '$': 'с',
+})
+
+# Все, кроме букв и цифр, считается разделителем (пробелы, пунктуация, невидимые символы)
+SEPARATORS = re.compile(r'[\W_]+')
+
+
+def normalize_text(text):
+    """Приводит текст к виду для поиска.
+
+    Регистр и ё→е выравниваются, похожие латинские буквы заменяются кириллицей,
+    разделители сводятся к одному пробелу, а буквы, разнесенные через разделители
+    ("у б и л", "у.б.и.л"), склеиваются в одно слово.
+    """
+    text = text.casefold().replace('ё', 'е').translate(HOMOGLYPHS)
+    words = []
+    letters = []
+    for word in SEPARATORS.split(text):
+        if len(word) == 1:
+            letters.append(word)
+            continue
+        if letters:
+            words.append(''.join(letters))
+            letters = []
+        if word:
+            words.append(word)
+    if letters:
+        words.append(''.join(letters))
+    return ' '.join(words)
+
+
+class AhoCorasick:
+    """Автомат Ахо-Корасик: поиск всех шаблонов за один линейный проход по тексту."""
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build_failure_links()
+
+    def _add(self, pattern):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = next_state
+        if self._output[state] is None:
+            self._output[state] = pattern
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                # Совпадение по суффиксу тоже считается найденным шаблоном
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def search(self, text):
+        """Возвращает первый найденный шаблон или None."""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class StopWordsFilter:
+    """Проверка сообщений на стоп-слова с автоматической перезагрузкой файла при изменении.
+
+    Файл проверяется не чаще раза в check_interval секунд.
+    """
+
+    def __init__(self, file_path, check_interval=5.0):
+        self.file_path = file_path
+        self.check_interval = check_interval
+        self._mtime = None
+        self._checked_at = 0.0
+        self._matcher = AhoCorasick([])
+        self.reload()
+
+    def reload(self):
+        mtime = os.stat(self.file_path).st_mtime
+        with open(self.file_path, 'r', encoding='utf-8') as file:
+            patterns = {normalize_text(line) for line in file}
+        patterns.discard('')
+        self._matcher = AhoCorasick(patterns)
+        self._mtime = mtime
+        logger.info(f"Загружено {len(patterns)} стоп-слов из {self.file_path}")
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            if os.stat(self.file_path).st_mtime != self._mtime:
+                self.reload()
+        except OSError as e:
+            # При ошибке чтения продолжаем работать со старым списком
+            logger.error(f"Не удалось перезагрузить стоп-слова из {self.file_path}: {e}")
+
+    def find(self, message):
+        """Возвращает найденное стоп-слово (в нормализованном виде) или None."""
+        self._reload_if_changed()
+        return self._matcher.search(normalize_text(message))
@@ -0,0 +1,60 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Делит длинный текст на части не длиннее limit, по возможности по переводу строки."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        parts.append(text)
+    return parts
+
+
+class MessageStreamer:
+    """Постепенно обновляет сообщение-заглушку текстом, приходящим из потока LLM.
+
+    Сообщение редактируется не чаще раза в interval секунд и только если
+    с прошлого обновления добавилось не меньше min_chars символов.
+    """
+
+    def __init__(self, message, interval=1.0, min_chars=20):
+        self.message = message
+        self.interval = interval
+        self.min_chars = min_chars
+        self._shown = ''
+        self._last_edit = 0.0
+
+    async def update(self, text):
+        if time.monotonic() - self._last_edit < self.interval or len(text) - len(self._shown) < self.min_chars:
+            return
+        # Пока идет генерация, показываем только то, что помещается в одно сообщение
+        await self._edit(text[:TELEGRAM_MESSAGE_LIMIT])
+
+    async def finish(self, text):
+        """Показывает окончательный текст; не поместившееся продолжается новыми сообщениями."""
+        parts = split_message(text) or ['...']
+        await self._edit(parts[0])
+        for part in parts[1:]:
+            await self.message.reply_text(part)
+
+    async def _edit(self, text):
+        if text == self._shown:
+            return
+        try:
+            await self.message.edit_text(text)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сообщение {self.message.message_id}: {e}")
+            return
+        self._shown = text
+        self._last_edit = time.monotonic()
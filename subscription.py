@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+class SubscriptionChecker:
+    """Проверка подписки пользователя хотя бы на один из каналов.
+
+    Каналы опрашиваются параллельно, ответ возвращается по первому каналу с
+    подпиской. Результат кэшируется на пользователя: положительный на
+    positive_ttl секунд, отрицательный на negative_ttl секунд.
+    """
+
+    def __init__(self, channel_ids, positive_ttl=3600, negative_ttl=30, max_entries=100000):
+        self.channel_ids = [channel_id.strip() for channel_id in channel_ids if channel_id.strip()]
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._cache = {}
+        self._in_flight = {}
+
+    async def is_subscribed(self, bot, user_id: int) -> bool:
+        cached = self._cache.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        # Одновременные проверки одного пользователя используют один запрос
+        task = self._in_flight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._check_channels(bot, user_id))
+            self._in_flight[user_id] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(user_id, None))
+        result = await asyncio.shield(task)
+
+        ttl = self.positive_ttl if result else self.negative_ttl
+        if len(self._cache) >= self.max_entries:
+            self._evict_expired()
+        self._cache[user_id] = (result, time.monotonic() + ttl)
+        return result
+
+    def invalidate(self, user_id: int) -> None:
+        self._cache.pop(user_id, None)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for user_id in [user_id for user_id, (_, expires) in self._cache.items() if expires <= now]:
+            del self._cache[user_id]
+        if len(self._cache) >= self.max_entries:
+            self._cache.clear()
+
+    async def _check_channels(self, bot, user_id: int) -> bool:
+        tasks = [asyncio.ensure_future(self._check_channel(bot, user_id, channel_id)) for channel_id in self.channel_ids]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                if await next_done:
+                    return True
+            return False
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _check_channel(self, bot, user_id: int, channel_id: str) -> bool:
+        try:
+            member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+        except Exception as e:
+            logger.warning(f"Не удалось проверить подписку пользователя {user_id} на канал {channel_id}: {e}")
+            return False
+        return member.status in SUBSCRIBED_STATUSES
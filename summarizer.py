@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INSTRUCTION = ("Ты ведешь краткую сводку разговора пользователя с ботом. Дополни сводку новыми репликами. "
+                       "Сохрани важные факты о пользователе, его вопросы, полученные ответы и договоренности. "
+                       "Пиши сжато, от третьего лица, не больше 150 слов. В ответе верни только обновленную сводку.")
+
+
+class ConversationSummarizer:
+    """Скользящая сводка старых реплик разговора пользователя.
+
+    Сводка общая для всех ролей, как и журнал истории: номер covered_seq
+    относится к единой нумерации записей пользователя.
+
+    В промпт идут сводка и короткое окно последних реплик. Когда несведенных
+    реплик становится больше threshold, все кроме keep_recent последних
+    сворачиваются в сводку фоновой задачей, не задерживая ответ пользователю.
+    Сводка хранится в SQLite вместе с номером (seq) последней учтенной записи
+    из ChatHistoryStore, в памяти держатся max_entries последних использованных.
+
+    summarize(messages, user_id) - корутина, возвращающая текст ответа LLM.
+    """
+
+    def __init__(self, db_path, history_store, summarize, threshold=16, keep_recent=6, max_batch=40,
+                 max_entries=10000):
+        self.history_store = history_store
+        self.summarize = summarize
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.max_batch = max_batch
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # Сводки по паре (пользователь, роль) учитывали реплики всех ролей - такие сводки не переносятся
+        self._conn.execute("DROP TABLE IF EXISTS conversation_summaries")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_summaries ("
+            "user_id INTEGER PRIMARY KEY, summary TEXT NOT NULL, covered_seq INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def get(self, user_id):
+        """Возвращает (сводка или None, seq последней учтенной в сводке записи)."""
+        entry = self._memory.get(user_id)
+        if entry is None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT summary, covered_seq FROM user_summaries WHERE user_id = ?", (user_id,)
+                ).fetchone()
+            entry = (row[0], row[1]) if row else (None, 0)
+        self._remember(user_id, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def recent(self, user_id, limit=10):
+        """Сводка и записи истории после нее (не больше limit последних)."""
+        summary, covered_seq = self.get(user_id)
+        return summary, self.history_store.since(user_id, covered_seq, limit)
+
+    def maybe_summarize(self, user_id):
+        """Запускает фоновое обновление сводки, если несведенных реплик накопилось слишком много."""
+        if user_id in self._in_flight:
+            return
+        _, covered_seq = self.get(user_id)
+        if self.history_store.last_seq(user_id) - covered_seq <= self.threshold:
+            return
+        task = asyncio.get_running_loop().create_task(self._summarize(user_id))
+        self._in_flight[user_id] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(user_id, None))
+
+    async def _summarize(self, user_id):
+        summary, covered_seq = self.get(user_id)
+        up_to_seq = self.history_store.last_seq(user_id) - self.keep_recent
+        entries = self.history_store.between(user_id, covered_seq, up_to_seq)[:self.max_batch]
+        if not entries:
+            return
+        dialogue = '\n'.join(f"{'Бот' if entry['role'] == 'bot' else 'Пользователь'}: {entry['message']}"
+                             for entry in entries)
+        messages = [
+            {'role': 'system', 'content': SUMMARY_INSTRUCTION},
+            {'role': 'user', 'content': f"Текущая сводка: {summary or 'пока нет'}\n\nНовые реплики:\n{dialogue}"},
+        ]
+        started = time.monotonic()
+        try:
+            new_summary = (await self.summarize(messages, user_id)).strip()
+        except Exception as e:
+            logger.error(f"Не удалось обновить сводку разговора пользователя {user_id}: {e}")
+            return
+        if not new_summary:
+            return
+        if self.get(user_id) != (summary, covered_seq):
+            # Пока шла генерация, сводку сбросили - результат устарел
+            return
+        entry = (new_summary, entries[-1]['seq'])
+        self._remember(user_id, entry)
+        await asyncio.to_thread(self._save, user_id, entry)
+        logger.debug(f"Сводка разговора пользователя {user_id} обновлена: "
+                     f"{len(entries)} реплик за {time.monotonic() - started:.1f} с")
+
+    def _save(self, user_id, entry):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_summaries (user_id, summary, covered_seq, updated_at) "
+                "VALUES (?, ?, ?, ?)", (user_id, entry[0], entry[1], time.time())
+            )
+
+    def invalidate(self, user_id):
+        """Удаляет сводку пользователя (например, после удаления его данных)."""
+        self._memory.pop(user_id, None)
+        task = self._in_flight.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM user_summaries WHERE user_id = ?", (user_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
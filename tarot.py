@@ -0,0 +1,176 @@
+import hashlib
+import random
+import re
+from typing import NamedTuple
+
+# Старшие арканы: название, прямое и перевернутое значение
+MAJOR_ARCANA = (
+    ("Шут", "новое начало, спонтанность, свобода", "безрассудство, риск, наивность"),
+    ("Маг", "воля, мастерство, ресурсы под рукой", "манипуляция, нереализованный потенциал"),
+    ("Верховная Жрица", "интуиция, тайное знание", "скрытые мотивы, отрыв от интуиции"),
+    ("Императрица", "изобилие, забота, плодородие", "зависимость, застой, гиперопека"),
+    ("Император", "порядок, власть, структура", "жесткость, контроль, тирания"),
+    ("Иерофант", "традиции, наставник, правила", "бунт против устоев, догматизм"),
+    ("Влюбленные", "союз, выбор сердцем, гармония", "разлад, неверный выбор"),
+    ("Колесница", "движение вперед, победа воли", "потеря направления, агрессия"),
+    ("Сила", "мужество, терпение, самообладание", "неуверенность, слабость, вспыльчивость"),
+    ("Отшельник", "уединение, поиск истины", "изоляция, одиночество"),
+    ("Колесо Фортуны", "перемены, удача, поворот судьбы", "невезение, сопротивление переменам"),
+    ("Справедливость", "честность, равновесие, последствия", "несправедливость, уход от ответственности"),
+    ("Повешенный", "пауза, новый взгляд, жертва", "напрасная жертва, промедление"),
+    ("Смерть", "завершение, трансформация", "страх перемен, застревание в прошлом"),
+    ("Умеренность", "баланс, мера, терпение", "крайности, дисбаланс"),
+    ("Дьявол", "зависимость, искушение, материальное", "освобождение, разрыв оков"),
+    ("Башня", "внезапный крах, откровение", "отсроченная катастрофа, страх перемен"),
+    ("Звезда", "надежда, вдохновение, исцеление", "разочарование, потеря веры"),
+    ("Луна", "иллюзии, страхи, подсознание", "прояснение, уход тревоги"),
+    ("Солнце", "радость, успех, ясность", "временное уныние, излишний оптимизм"),
+    ("Суд", "пробуждение, итог, призвание", "сомнения в себе, самокритика"),
+    ("Мир", "завершенность, целостность, достижение", "незавершенность, отсутствие финала"),
+)
+
+MINOR_RANKS = ("Туз", "Двойка", "Тройка", "Четверка", "Пятерка", "Шестерка", "Семерка", "Восьмерка",
+               "Девятка", "Десятка", "Паж", "Рыцарь", "Королева", "Король")
+
+# Младшие арканы по мастям в порядке MINOR_RANKS: прямое и перевернутое значение
+MINOR_ARCANA = {
+    "Жезлов": (
+        ("вдохновение, новый замысел", "задержки, потеря запала"),
+        ("планирование, выбор пути", "страх неизвестности, нерешительность"),
+        ("расширение, первые результаты", "препятствия, задержки в планах"),
+        ("праздник, стабильность, дом", "нестабильность, напряжение в доме"),
+        ("соперничество, споры", "избегание конфликта, внутренняя борьба"),
+        ("признание, победа", "самонадеянность, падение репутации"),
+        ("отстаивание позиций, стойкость", "усталость, сдача позиций"),
+        ("стремительность, новости", "суета, задержки, спешка"),
+        ("упорство, последний рубеж", "истощение, паранойя"),
+        ("перегрузка, ответственность", "сброс лишнего груза, выгорание"),
+        ("энтузиазм, новые идеи", "поверхностность, отсутствие направления"),
+        ("энергия, смелые действия", "импульсивность, спешка"),
+        ("уверенность, харизма", "ревность, неуверенность"),
+        ("лидерство, видение", "властность, нетерпимость"),
+    ),
+    "Кубков": (
+        ("новые чувства, любовь", "эмоциональная пустота, закрытость"),
+        ("партнерство, взаимность", "разлад, дисбаланс в отношениях"),
+        ("дружба, радость, праздник", "излишества, сплетни"),
+        ("апатия, упущенные возможности", "пробуждение интереса"),
+        ("потеря, сожаление", "принятие, прощение"),
+        ("ностальгия, детство", "жизнь прошлым"),
+        ("иллюзии, множество вариантов", "ясность, реалистичный выбор"),
+        ("уход, поиск глубинного смысла", "страх перемен, метания"),
+        ("исполнение желаний, довольство", "самодовольство, неудовлетворенность"),
+        ("семейное счастье, гармония", "разлад в семье"),
+        ("чувствительность, творческая весть", "эмоциональная незрелость"),
+        ("романтика, предложение", "разочарование, капризы"),
+        ("сострадание, забота", "эмоциональная зависимость"),
+        ("эмоциональная зрелость, дипломатия", "манипуляции, холодность"),
+    ),
+    "Мечей": (
+        ("ясность, прорыв, истина", "путаница, неверные решения"),
+        ("тупик, трудный выбор", "информационная перегрузка, нерешительность"),
+        ("боль, разбитое сердце", "исцеление, прощение"),
+        ("отдых, восстановление", "беспокойство, выгорание"),
+        ("конфликт, победа любой ценой", "примирение, сожаление"),
+        ("переход, уход от проблем", "незавершенные дела, сопротивление"),
+        ("хитрость, стратегия", "разоблачение, признание"),
+        ("ограничения, ловушка мыслей", "освобождение, новый взгляд"),
+        ("тревога, бессонница", "надежда, выход из кризиса"),
+        ("болезненный финал, дно", "восстановление, худшее позади"),
+        ("любопытство, бдительность", "сплетни, поспешные слова"),
+        ("напор, решительность", "безрассудство, агрессия"),
+        ("независимость, прямота", "резкость, холодность"),
+        ("интеллект, авторитет, справедливость", "злоупотребление властью, жестокость"),
+    ),
+    "Пентаклей": (
+        ("новая возможность, достаток", "упущенный шанс, недостаток планирования"),
+        ("баланс, гибкость", "перегрузка, неорганизованность"),
+        ("мастерство, командная работа", "разобщенность, низкое качество"),
+        ("накопление, контроль", "жадность, страх потерь"),
+        ("нужда, трудности", "восстановление, помощь"),
+        ("щедрость, обмен", "долги, неравенство"),
+        ("терпение, долгосрочные вложения", "нетерпение, малая отдача"),
+        ("усердие, обучение ремеслу", "перфекционизм, рутина"),
+        ("самодостаточность, комфорт", "зависимость от других, показная роскошь"),
+        ("богатство, наследие, семья", "финансовые потери, споры о наследстве"),
+        ("новое дело, учеба", "отсутствие прогресса, лень"),
+        ("надежность, методичность", "застой, скука"),
+        ("практичность, домашний уют", "дисбаланс работы и дома"),
+        ("изобилие, безопасность, успех", "жадность, материализм"),
+    ),
+}
+
+# Полная колода из 78 карт: (название, прямое значение, перевернутое значение)
+DECK = MAJOR_ARCANA + tuple(
+    (f"{rank} {suit}", upright, reversed_)
+    for suit, meanings in MINOR_ARCANA.items()
+    for rank, (upright, reversed_) in zip(MINOR_RANKS, meanings)
+)
+
+# Расклады: название и позиции карт
+SPREADS = {
+    'one': ("Карта дня", ("Ответ",)),
+    'three': ("Прошлое, настоящее, будущее", ("Прошлое", "Настоящее", "Будущее")),
+    'celtic_cross': ("Кельтский крест", (
+        "Ситуация", "Препятствие", "Основа", "Прошлое", "Сознательная цель", "Ближайшее будущее",
+        "Сам человек", "Окружение", "Надежды и страхи", "Итог",
+    )),
+}
+
+
+class DrawnCard(NamedTuple):
+    position: str
+    name: str
+    reversed: bool
+    meaning: str
+
+
+class Reading(NamedTuple):
+    spread: str
+    seed: int
+    cards: tuple
+
+
+def normalize_question(question):
+    """Приводит вопрос к виду, по которому считается зерно: регистр, пунктуация и пробелы не важны."""
+    return ' '.join(re.findall(r'\w+', question.lower().replace('ё', 'е')))
+
+
+def reading_seed(user_id, question):
+    digest = hashlib.sha256(f"{user_id}:{normalize_question(question)}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def draw(user_id, question, spread='three', seed=None):
+    """Раскладывает карты для вопроса пользователя.
+
+    Зерно генератора зависит только от пользователя и текста вопроса, поэтому
+    тот же вопрос того же пользователя дает тот же расклад, а по seed расклад
+    можно воспроизвести.
+    """
+    _, positions = SPREADS[spread]
+    seed = reading_seed(user_id, question) if seed is None else seed
+    rng = random.Random(seed)
+    cards = []
+    for position, index in zip(positions, rng.sample(range(len(DECK)), len(positions))):
+        name, upright, reversed_meaning = DECK[index]
+        is_reversed = rng.random() < 0.5
+        cards.append(DrawnCard(position, name, is_reversed, reversed_meaning if is_reversed else upright))
+    return Reading(spread, seed, tuple(cards))
+
+
+def card_title(card):
+    return f"{card.name} (перевернута)" if card.reversed else card.name
+
+
+def format_cards(reading):
+    """Расклад для пользователя: позиции и карты без толкований."""
+    title, _ = SPREADS[reading.spread]
+    lines = [f"🃏 {title}"]
+    lines += [f"{number}. {card.position}: {card_title(card)}" for number, card in enumerate(reading.cards, 1)]
+    return '\n'.join(lines)
+
+
+def format_for_prompt(reading):
+    """Расклад для промпта: позиция, карта и ее краткое значение, по строке на карту."""
+    return '\n'.join(f"{card.position}: {card_title(card)} - {card.meaning}" for card in reading.cards)
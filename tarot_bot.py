@@ -1,27 +1,51 @@
 import logging
-import requests
 import re
-import json
 import os
 import asyncio
-from datetime import datetime
+import signal
+from datetime import datetime, time as dt_time
+import pytz
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters, CallbackContext, ConversationHandler
 from help_handler import help_command
+from llm_client import LLMClient
+from llm_gateway import LLMGateway, CircuitBreaker, LLMUnavailable
+from stop_words import StopWordsFilter
+from prompts import (PromptBuilder, ROLES, PSYCHOLOGY_METHODS, PSYCHOLOGY_OPENERS, ASK_TIME_OF_BIRTH, ASK_PLACE_OF_BIRTH,
+                     psychology_method_text)
+from user_store import UserStore
+from user_cache import UserCache
+from token_usage import TokenUsage, count_tokens
+from subscription import SubscriptionChecker
+from streaming import MessageStreamer
+from generation_cache import GenerationCache, ResponsePool, horoscope_signature, prompt_key, time_bucket, zodiac_sign
+from broadcast import HoroscopeBroadcaster, BroadcastProgress, DryRunBot
+from transcription import (TranscriptionPipeline, RECOGNIZERS, TranscriptionBusy, AudioTooLong, AudioDecodeError,
+                           SpeechNotRecognized, RecognizerUnavailable)
+from chat_history_store import ChatHistoryStore
+import tarot
+import numerology
+from ephemeris import Ephemeris
+from astro_chart import ChartEngine
+from summarizer import ConversationSummarizer
+from user_queue import UserUpdateQueue
+from metrics import Metrics, start_metrics_server
+from webhook import WebhookServer, PendingUpdatesProcessor, run_webhook
+from quota import QuotaLimiter, TokenBudget, TokenBudgetExceeded, parse_limits
+from session_store import SessionStore
+from persistence import SessionPersistence
+from sharding import ShardDispatcher, JobLease, run_shard_worker, shard_of, shard_path
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-import tiktoken
-import speech_recognition as sr
 from telegram import File
-import io
-from pydub import AudioSegment
 
 # Загрузка переменных из .env файла
 load_dotenv()
 
 # Настройка логирования
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=os.getenv('LOG_LEVEL', 'INFO').upper())
+# httpx пишет строку на каждый запрос к Bot API и LLM - оставляем только предупреждения
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Настройка токенов
@@ -29,88 +53,239 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 PROXY_API_KEY = os.getenv('PROXY_API_KEY')
 PROXY_API_URL = os.getenv('PROXY_API_URL')
 USER_DATA_FILE = 'user_data.json'
+USER_DB_FILE = os.getenv('USER_DB_FILE', 'bot_data.db')
+# Период сброса кэша пользователей на диск (секунды) и размер одной пачки записи
+USER_CACHE_FLUSH_INTERVAL = int(os.getenv('USER_CACHE_FLUSH_INTERVAL', '30'))
+USER_CACHE_FLUSH_BATCH = int(os.getenv('USER_CACHE_FLUSH_BATCH', '500'))
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
 CHAT_HISTORY_FILE = 'user_chat_history.json'
+CHAT_HISTORY_LOG_FILE = os.getenv('CHAT_HISTORY_LOG_FILE', 'chat_history.log')
+# Сколько последних сообщений хранить на пользователя и сколько дней (0 - без ограничения)
+CHAT_HISTORY_RETENTION = int(os.getenv('CHAT_HISTORY_RETENTION', '200'))
+CHAT_HISTORY_MAX_AGE_DAYS = int(os.getenv('CHAT_HISTORY_MAX_AGE_DAYS', '0'))
+# Скользящая сводка разговора: после скольких несведенных реплик сворачивать и сколько последних оставлять
+SUMMARY_THRESHOLD = int(os.getenv('SUMMARY_THRESHOLD', '16'))
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', '6'))
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '400'))
 CHANNEL_IDS = os.getenv('CHANNEL_IDS').split(',')
+# Время жизни кэша проверки подписки (секунды) для подписанных и неподписанных пользователей
+SUBSCRIPTION_POSITIVE_TTL = int(os.getenv('SUBSCRIPTION_POSITIVE_TTL', '3600'))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '30'))
+
+# Настройки распознавания голосовых сообщений
+VOICE_RECOGNIZER = os.getenv('VOICE_RECOGNIZER', 'google')
+VOICE_WORKERS = int(os.getenv('VOICE_WORKERS', '2'))
+VOICE_USE_PROCESSES = os.getenv('VOICE_USE_PROCESSES', 'false').lower() == 'true'
+VOICE_MAX_QUEUE = int(os.getenv('VOICE_MAX_QUEUE', '20'))
+VOICE_MAX_PER_USER = int(os.getenv('VOICE_MAX_PER_USER', '1'))
+VOICE_MAX_DURATION = int(os.getenv('VOICE_MAX_DURATION', '120'))
 
 # Настройки модели
 MODEL_NAME = os.getenv('MODEL_NAME')
 MAX_TOKENS = int(os.getenv('MAX_TOKENS'))
 TEMPERATURE = float(os.getenv('TEMPERATURE'))
 
-def load_stop_words(file_path):
-    """Загружает стоп-слова из файла и возвращает их в виде множества."""
-    with open(file_path, 'r', encoding='utf-8') as file:
-        stop_words = {line.strip() for line in file}
-    return stop_words
-
-def create_stop_words_regex(stop_words):
-    """Создает регулярное выражение для поиска стоп-слов в сообщении."""
-    # Объединяем стоп-слова в одну строку, разделяя их символом "|" (или)
-    stop_words_pattern = '|'.join(map(re.escape, stop_words))
-    # Создаем регулярное выражение для поиска стоп-слов в любом месте сообщения
-    return re.compile(stop_words_pattern, re.IGNORECASE)
-
-def validate_message(message, stop_words_regex):
+# Настройки клиента LLM
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '10'))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '20'))
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '20'))
+# Повторы, дублирующие запросы и запасные модели
+LLM_FALLBACK_MODELS = [model.strip() for model in os.getenv('LLM_FALLBACK_MODELS', '').split(',') if model.strip()]
+LLM_ATTEMPT_TIMEOUT = float(os.getenv('LLM_ATTEMPT_TIMEOUT', '30'))
+LLM_TOTAL_TIMEOUT = float(os.getenv('LLM_TOTAL_TIMEOUT', '90'))
+LLM_MAX_ATTEMPTS = int(os.getenv('LLM_MAX_ATTEMPTS', '3'))
+LLM_HEDGE = os.getenv('LLM_HEDGE', 'false').lower() == 'true'
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '1.0'))
+LLM_CIRCUIT_FAILURES = int(os.getenv('LLM_CIRCUIT_FAILURES', '5'))
+LLM_CIRCUIT_RESET = float(os.getenv('LLM_CIRCUIT_RESET', '30'))
+# Потоковая выдача ответа с постепенным редактированием сообщения-заглушки
+LLM_STREAMING = os.getenv('LLM_STREAMING', 'true').lower() == 'true'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_EDIT_MIN_CHARS = int(os.getenv('STREAM_EDIT_MIN_CHARS', '20'))
+# Расклад Таро: one, three или celtic_cross
+TAROT_SPREAD = os.getenv('TAROT_SPREAD', 'three')
+if TAROT_SPREAD not in tarot.SPREADS:
+    raise RuntimeError(f"Неизвестный расклад TAROT_SPREAD={TAROT_SPREAD}, допустимы: {', '.join(tarot.SPREADS)}")
+# Настройки ежедневной рассылки гороскопов
+BROADCAST_TIME = os.getenv('BROADCAST_TIME', '09:00')
+BROADCAST_TIMEZONE = pytz.timezone(os.getenv('BROADCAST_TIMEZONE', 'Europe/Moscow'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '5'))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_PROGRESS_FILE = os.getenv('BROADCAST_PROGRESS_FILE', 'broadcast_progress.jsonl')
+BROADCAST_DRY_RUN = os.getenv('BROADCAST_DRY_RUN', 'false').lower() == 'true'
+# Через сколько секунд повторить рассылку тем, кому она не ушла из-за временных ошибок
+BROADCAST_RETRY_DELAY = int(os.getenv('BROADCAST_RETRY_DELAY', '600'))
+# Кэш астрологических генераций по данным рождения
+GENERATION_CACHE_TTL = int(os.getenv('GENERATION_CACHE_TTL', str(36 * 60 * 60)))
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv('GENERATION_CACHE_MAX_ENTRIES', '10000'))
+HOROSCOPE_TIME_BUCKET_MINUTES = int(os.getenv('HOROSCOPE_TIME_BUCKET_MINUTES', '60'))
+HOROSCOPE_CACHE_BY_SIGN = os.getenv('HOROSCOPE_CACHE_BY_SIGN', 'false').lower() == 'true'
+# Таблица эфемерид для локального расчета натальных карт и транзитов
+EPHEMERIS_FILE = os.getenv('EPHEMERIS_FILE', 'ephemeris.npy')
+EPHEMERIS_START_YEAR = int(os.getenv('EPHEMERIS_START_YEAR', '1900'))
+EPHEMERIS_END_YEAR = int(os.getenv('EPHEMERIS_END_YEAR', '2100'))
+# Бюджет токенов на промпт: системный промпт, история и текущее сообщение
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '3000'))
+# Пул готовых ответов на неизменные первые сообщения ролей: число вариантов и срок их жизни (секунды)
+OPENER_POOL_SIZE = int(os.getenv('OPENER_POOL_SIZE', '3'))
+OPENER_POOL_TTL = int(os.getenv('OPENER_POOL_TTL', str(7 * 24 * 60 * 60)))
+# Число обновлений, которые бот обрабатывает одновременно
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+# Лимиты запросов: окно daily (календарный день) или sliding (последние QUOTA_WINDOW_SECONDS секунд)
+QUOTA_WINDOW = os.getenv('QUOTA_WINDOW', 'daily')
+QUOTA_WINDOW_SECONDS = int(os.getenv('QUOTA_WINDOW_SECONDS', str(24 * 60 * 60)))
+QUOTA_DEFAULT_LIMIT = int(os.getenv('QUOTA_DEFAULT_LIMIT', '5'))
+# Лимиты по тарифам и ролям, например "premium:*=50,free:psychologist=3" (-1 - без ограничений)
+QUOTA_LIMITS = parse_limits(os.getenv('QUOTA_LIMITS', ''))
+QUOTA_TIMEZONE = pytz.timezone(os.getenv('QUOTA_TIMEZONE', 'Europe/Moscow'))
+QUOTA_SNAPSHOT_FILE = os.getenv('QUOTA_SNAPSHOT_FILE', 'quota_snapshot.json')
+QUOTA_SNAPSHOT_INTERVAL = int(os.getenv('QUOTA_SNAPSHOT_INTERVAL', '30'))
+PREMIUM_USER_IDS = {int(user_id) for user_id in os.getenv('PREMIUM_USER_IDS', '').split(',') if user_id.strip()}
+# Общий бюджет токенов LLM в минуту для защиты прокси (0 - без ограничения)
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '0'))
+LLM_TOKEN_BUDGET_MAX_WAIT = float(os.getenv('LLM_TOKEN_BUDGET_MAX_WAIT', '10'))
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Публичный адрес, на который Telegram шлет обновления (без пути), и параметры встроенного сервера
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_MAX_QUEUE = int(os.getenv('WEBHOOK_MAX_QUEUE', '1000'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Число процессов-шардов (1 - без шардирования). SHARD_INDEX задает диспетчер при запуске шарда
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+SHARD_INDEX = int(os.getenv('SHARD_INDEX')) if os.getenv('SHARD_INDEX') else None
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', '1000'))
+# Интервал пакетной записи user_data, chat_data и bot_data (секунды)
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '60'))
+# Метрики: порт HTTP-эндпоинта /metrics (0 - выключен) и трассировка каждого обновления в логгер trace
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+TRACE_UPDATES = os.getenv('TRACE_UPDATES', 'false').lower() == 'true'
+# Склейка сообщений, присланных пользователем подряд: пауза между ними и максимальное ожидание (секунды)
+MESSAGE_COALESCE_WINDOW = float(os.getenv('MESSAGE_COALESCE_WINDOW', '1.0'))
+MESSAGE_COALESCE_MAX_WAIT = float(os.getenv('MESSAGE_COALESCE_MAX_WAIT', '4.0'))
+
+# Замеры этапов обработки и счетчики
+metrics = Metrics(trace_enabled=TRACE_UPDATES)
+metrics_runner = None
+
+# Обновления одного пользователя обрабатываются по очереди, разных - параллельно
+user_queue = UserUpdateQueue(coalesce_window=MESSAGE_COALESCE_WINDOW, max_wait=MESSAGE_COALESCE_MAX_WAIT)
+
+# Пользователь принадлежит этому процессу (без шардирования - все пользователи)
+def owns_user(user_id):
+    return SHARD_INDEX is None or shard_of(user_id, SHARD_COUNT) == SHARD_INDEX
+
+# Сборка промптов для всех ролей
+prompt_builder = PromptBuilder(PROMPT_TOKEN_BUDGET)
+
+# Общий для всех обработчиков клиент LLM
+llm_client = LLMClient(PROXY_API_URL, PROXY_API_KEY, MODEL_NAME, MAX_TOKENS,
+                       timeout=LLM_TIMEOUT, connect_timeout=LLM_CONNECT_TIMEOUT,
+                       max_concurrency=LLM_MAX_CONCURRENCY, max_connections=LLM_MAX_CONNECTIONS)
+# Повторы, дублирующие запросы, запасные модели и размыкатель цепи поверх клиента
+llm_gateway = LLMGateway(llm_client, [MODEL_NAME] + LLM_FALLBACK_MODELS,
+                         attempt_timeout=LLM_ATTEMPT_TIMEOUT, total_timeout=LLM_TOTAL_TIMEOUT,
+                         max_attempts=LLM_MAX_ATTEMPTS, hedge=LLM_HEDGE, hedge_min_delay=LLM_HEDGE_MIN_DELAY,
+                         breaker=CircuitBreaker(LLM_CIRCUIT_FAILURES, LLM_CIRCUIT_RESET), metrics=metrics)
+
+def validate_message(message, stop_words_filter):
     """Проверяет, содержит ли сообщение стоп-слова."""
-    # Ищем стоп-слова в сообщении
-    if stop_words_regex.search(message):
+    # Ищем стоп-слова в нормализованном сообщении за один проход
+    if stop_words_filter.find(message):
         return False
     return True
 
 stop_words_file = 'stop_words.txt'  # Путь к файлу со стоп-словами
-stop_words = load_stop_words(stop_words_file)
-stop_words_regex = create_stop_words_regex(stop_words)
-
-# Функция для загрузки данных из JSON-файла
-def load_user_data():
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, 'r', encoding='utf-8') as file:
-            return [json.loads(line) for line in file]
-    return []
-
-# Функция для сохранения всех данных в JSON-файл
-def save_user_data(user_data):
-    with open(USER_DATA_FILE, 'w', encoding='utf-8') as file:
-        for user in user_data:
-            json.dump(user, file, ensure_ascii=False)
-            file.write('\n')
+# Файл перечитывается автоматически после изменения
+stop_words_filter = StopWordsFilter(stop_words_file)
+
+# Хранилище пользователей (при первом запуске переносит данные из user_data.json)
+user_store = UserStore(USER_DB_FILE)
+user_store.migrate_from_jsonl(USER_DATA_FILE)
+# Записи пользователей читаются и изменяются в памяти, на диск пишутся пачками
+user_cache = UserCache(user_store, max_batch=USER_CACHE_FLUSH_BATCH)
+user_cache.load(owns_user)
+# Счетчики токенов по пользователям и ролям
+token_usage = TokenUsage(user_store)
+# Общие для пользователей с одинаковыми данными рождения генерации
+generation_cache = GenerationCache(USER_DB_FILE, ttl=GENERATION_CACHE_TTL, max_entries=GENERATION_CACHE_MAX_ENTRIES)
+
+# Лимиты запросов пользователей: счетчики в памяти, снимок в файле
+quota_limiter = QuotaLimiter(shard_path(QUOTA_SNAPSHOT_FILE, SHARD_INDEX), limits=QUOTA_LIMITS, default_limit=QUOTA_DEFAULT_LIMIT,
+                             window=QUOTA_WINDOW, window_seconds=QUOTA_WINDOW_SECONDS, timezone=QUOTA_TIMEZONE,
+                             tier_of=lambda user_id: 'premium' if user_id in PREMIUM_USER_IDS else 'free')
+if not quota_limiter.load():
+    # Первый запуск: переносим сегодняшние счетчики из записей пользователей
+    _today = datetime.now().strftime('%d-%m-%Y')
+    for _user in user_cache.all_users():
+        if _user.get('last_request_date') == _today and _user.get('daily_requests'):
+            quota_limiter.seed_daily(_user['user_id'], datetime.now(QUOTA_TIMEZONE).strftime('%Y-%m-%d'),
+                                     _user['daily_requests'])
+# Общий бюджет токенов LLM (делится между шардами поровну)
+token_budget = TokenBudget(LLM_TOKENS_PER_MINUTE // SHARD_COUNT if SHARD_INDEX is not None else LLM_TOKENS_PER_MINUTE,
+                           max_wait=LLM_TOKEN_BUDGET_MAX_WAIT)
+# Заранее сгенерированные ответы на неизменные первые сообщения ролей
+opener_pool = ResponsePool(USER_DB_FILE, lambda messages: send_openai_request(messages, role='opener'),
+                           pool_size=OPENER_POOL_SIZE, ttl=OPENER_POOL_TTL)
+
+# Натальные карты и транзиты считаются локально, модель получает готовые положения
+chart_engine = ChartEngine(Ephemeris(EPHEMERIS_FILE, EPHEMERIS_START_YEAR, EPHEMERIS_END_YEAR),
+                           default_timezone=BROADCAST_TIMEZONE.zone)
+
+# История чатов (при первом запуске переносит данные из user_chat_history.json)
+# У каждого шарда свой журнал; при первом запуске шарда в него копируются его пользователи из общего
+# (журналы не перестраиваются при смене SHARD_COUNT, см. ChatHistoryStore.import_from_log)
+chat_history_store = ChatHistoryStore(shard_path(CHAT_HISTORY_LOG_FILE, SHARD_INDEX))
+if SHARD_INDEX is None:
+    chat_history_store.migrate_from_json(CHAT_HISTORY_FILE)
+else:
+    chat_history_store.import_from_log(CHAT_HISTORY_LOG_FILE, owns_user)
+# Сводки ранних реплик, чтобы размер промпта не рос с длиной разговора
+summarizer = ConversationSummarizer(
+    USER_DB_FILE, chat_history_store,
+    lambda messages, user_id: send_openai_request(messages, max_tokens=SUMMARY_MAX_TOKENS, user_id=user_id, role='summary'),
+    threshold=SUMMARY_THRESHOLD, keep_recent=SUMMARY_KEEP_RECENT,
+)
+# Роль, методика и данные рождения из context.user_data переживают перезапуск и смену шарда
+session_store = SessionStore(USER_DB_FILE)
+# Сессия без сохраненной копии заполняется данными рождения из записи пользователя
+session_persistence = SessionPersistence(session_store, seed=user_cache.get, update_interval=SESSION_FLUSH_INTERVAL)
+# Аренды фоновых задач, которые должен выполнять только один шард
+job_lease = JobLease(USER_DB_FILE)
+
+def is_job_leader(name, ttl):
+    return SHARD_INDEX is None or job_lease.try_acquire(name, f'shard{SHARD_INDEX}', ttl)
 
 
 # Функция для отправки уведомлений администратору
 async def notify_admin(context: CallbackContext, message: str):
     await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=message)
 
-def load_chat_history(user_id, limit=10):
-    if os.path.exists(CHAT_HISTORY_FILE):
-        with open(CHAT_HISTORY_FILE, 'r', encoding='utf-8') as file:
-            chat_history = json.load(file)
-        return chat_history.get(str(user_id), [])[-limit:]
-    return []
-
 # Функция для добавления нового пользователя или обновления данных существующего
-def add_or_update_user(user_data, user_id, username, context: CallbackContext, tokens_used=0, date_of_birth=None,
+def add_or_update_user(user_id, username, context: CallbackContext, tokens_used=0, date_of_birth=None,
                        time_of_birth=None, place_of_birth=None):
-    user_found = False
-    for user in user_data:
-        if isinstance(user, dict) and user['user_id'] == user_id:
-            user['username'] = username
-            user['last_active'] = datetime.now().strftime('%d-%m-%Y')
-            user['tokens_used'] = user.get('tokens_used', 0) + tokens_used
-            if date_of_birth:
-                user['date_of_birth'] = date_of_birth
-            if time_of_birth:
-                user['time_of_birth'] = time_of_birth
-            if place_of_birth:
-                user['place_of_birth'] = place_of_birth
-            if 'subscribe' not in user:
-                user['subscribe'] = True
-            user['daily_requests'] = user.get('daily_requests', 0)
-            user['last_request_date'] = user.get('last_request_date', datetime.now().strftime('%d-%m-%Y'))
-            user_found = True
-            break
-
-    if not user_found:
+    user = user_cache.get(user_id)
+    if user:
+        # Меняем только эти поля: остальные (например, subscribe) мог изменить другой шард
+        fields = {
+            'username': username,
+            'last_active': datetime.now().strftime('%d-%m-%Y'),
+            'tokens_used': (user.get('tokens_used') or 0) + tokens_used,
+            'last_request_date': user.get('last_request_date') or datetime.now().strftime('%d-%m-%Y'),
+        }
+        if date_of_birth:
+            fields['date_of_birth'] = date_of_birth
+        if time_of_birth:
+            fields['time_of_birth'] = time_of_birth
+        if place_of_birth:
+            fields['place_of_birth'] = place_of_birth
+        user_cache.update(user_id, **fields)
+    else:
         new_user = {
             'user_id': user_id,
             'username': username,
@@ -124,95 +299,129 @@ def add_or_update_user(user_data, user_id, username, context: CallbackContext, t
             'daily_requests': 0,
             'last_request_date': datetime.now().strftime('%d-%m-%Y')
         }
-        user_data.append(new_user)
+        user_cache.put(new_user)
         context.application.create_task(notify_admin(context, f"Новый пользователь: {username} (ID: {user_id})"))
 
-    save_user_data(user_data)  # Сохраняем все данные после любого изменения
-
 
 async def unsubscribe(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id  # Оставляем user_id в виде числа
-    user_data = load_user_data()
 
-    user_found = False
-    for user in user_data:
-        if user['user_id'] == user_id:
-            user['subscribe'] = False
-            user_found = True
-            break
-
-    if user_found:
-        save_user_data(user_data)
+    if user_cache.update(user_id, subscribe=False):
         await update.message.reply_text("Вы успешно отписались от ежедневной рассылки гороскопов.")
     else:
         await update.message.reply_text("Пользователь не найден.")
 
 # Функция для сохранения истории чатов в отдельный файл
 def save_chat_history(user_id, message, role):
-    chat_history = {}
-    if os.path.exists(CHAT_HISTORY_FILE):
-        with open(CHAT_HISTORY_FILE, 'r', encoding='utf-8') as file:
-            chat_history = json.load(file)
-
-    if str(user_id) not in chat_history:
-        chat_history[str(user_id)] = []
-
-    chat_history[str(user_id)].append({
-        'timestamp': datetime.now().strftime('%d-%m-%Y %H:%M:%S'),
-        'message': message,
-        'role': role
-    })
-
-    with open(CHAT_HISTORY_FILE, 'w', encoding='utf-8') as file:
-        json.dump(chat_history, file, ensure_ascii=False, indent=4)
-
-
-# Функция для подсчета токенов
-def count_tokens(text):
-    encoding = tiktoken.encoding_for_model("gpt-4o-mini")
-    tokens = encoding.encode(text)
-    return len(tokens)
+    with metrics.span('history_write'):
+        chat_history_store.append(user_id, message, role)
+
+# Периодический сброс кэша пользователей на диск
+async def flush_user_cache(context: CallbackContext) -> None:
+    await user_cache.flush()
+    await token_usage.flush()
+
+# Периодический снимок счетчиков квот
+async def save_quota_snapshot(context: CallbackContext) -> None:
+    await quota_limiter.save()
+
+# Периодическое компактирование журнала истории чатов
+async def compact_chat_history(context: CallbackContext) -> None:
+    await asyncio.to_thread(chat_history_store.compact,
+                            retention=CHAT_HISTORY_RETENTION or None,
+                            max_age_days=CHAT_HISTORY_MAX_AGE_DAYS or None)
+
+
+# Генерация ежедневного прогноза для одного подписчика
+# Текст кэшируется по сигнатуре данных рождения, поэтому в промпт попадает время с точностью до интервала.
+# Если для пользователя рассчитаны транзиты, промпт содержит только их и кэшируется по своему тексту
+async def generate_daily_horoscope(user, today_date):
+    date_of_birth = user['date_of_birth']
+    time_of_birth = time_bucket(user['time_of_birth'], HOROSCOPE_TIME_BUCKET_MINUTES)
+    place_of_birth = user['place_of_birth']
+    if user.get('transits'):
+        prompt = f"Представь, что ты астролог. Моя натальная карта: {user['natal_brief']}. Транзиты на {today_date} (рассчитаны точно): {user['transits']}. Дай мне астрологический прогноз на этот день по этим транзитам. В ответе давай меньше теории и воды, дай только выжимку самой важной интерпретации прогноза - для каких дел день благоприятный, чего стоит опасаться, какие есть рекомендации."
+        return await generation_cache.get_or_generate(
+            prompt_key([{'role': 'user', 'content': prompt}]),
+            lambda: send_openai_request(prompt, user_id=user['user_id'], role='daily_horoscope'))
+    if HOROSCOPE_CACHE_BY_SIGN:
+        prompt = f"Представь, что ты астролог. Мой знак зодиака {zodiac_sign(date_of_birth)}. Дай мне астрологический прогноз на {today_date}. В ответе давай меньше теории и воды, дай только выжимку самой важной интерпретации прогноза - для каких дел день благоприятный, чего стоит опасаться, какие есть рекомендации."
+    else:
+        prompt = f"Представь, что ты астролог. Моя дата рождения {date_of_birth}, время рождения {time_of_birth}, место рождения {place_of_birth}. Дай мне астрологический прогноз на {today_date}. В ответе давай меньше теории и воды, дай только выжимку самой важной интерпретации прогноза - для каких дел день благоприятный, чего стоит опасаться, какие есть рекомендации."
+    key = horoscope_signature(date_of_birth, user['time_of_birth'], place_of_birth, today_date,
+                              by_sign=HOROSCOPE_CACHE_BY_SIGN, bucket_minutes=HOROSCOPE_TIME_BUCKET_MINUTES)
+    return await generation_cache.get_or_generate(
+        key, lambda: send_openai_request(prompt, user_id=user['user_id'], role='daily_horoscope'))
+
+# Пользователь заблокировал бота - отписываем его от рассылки
+def unsubscribe_blocked_user(user_id):
+    if not user_cache.update(user_id, subscribe=False):
+        # Пользователь другого шарда - пишем сразу в хранилище
+        user_store.update(user_id, subscribe=False)
+
+horoscope_broadcaster = HoroscopeBroadcaster(generate_daily_horoscope, BROADCAST_PROGRESS_FILE,
+                                             concurrency=BROADCAST_CONCURRENCY, global_rate=BROADCAST_RATE,
+                                             on_blocked=unsubscribe_blocked_user)
 
 # Обертка для передачи контекста
 async def send_daily_horoscopes(context: CallbackContext):
-    user_data = load_user_data()
-    today_date = datetime.now().strftime('%Y-%m-%d')  # Получаем сегодняшнюю дату в формате ГГГГ-ММ-ДД
-    for user in user_data:
-        if user.get('subscribe') and all(user.get(k) for k in ('date_of_birth', 'time_of_birth', 'place_of_birth')):
-            user_id = user['user_id']
-            date_of_birth = user['date_of_birth']
-            time_of_birth = user['time_of_birth']
-            place_of_birth = user['place_of_birth']
-            prompt = f"Представь, что ты астролог. Моя дата рождения {date_of_birth}, время рождения {time_of_birth}, место рождения {place_of_birth}. Дай мне астрологический прогноз на {today_date}. В ответе давай меньше теории и воды, дай только выжимку самой важной интерпретации прогноза - для каких дел день благоприятный, чего стоит опасаться, какие есть рекомендации."
-            try:
-                response = send_openai_request(prompt)
-                await context.bot.send_message(chat_id=user_id, text=response)
-            except Exception as e:
-                logger.error(f"Error generating astrology forecast for user {user_id}: {e}")
-
-# Функция проверки подписки
-async def check_subscription(user_id: int, bot_token: str, channel_id: str) -> bool:
-    url = f"https://api.telegram.org/bot{bot_token}/getChatMember?chat_id={channel_id}&user_id={user_id}"
-    logger.info(f"Проверка подписки пользователя {user_id} на канал {channel_id}")
-    response = requests.get(url)
-    logger.info(f"Ответ от API: {response.text}")
-    result = response.json()
-    status = result.get("result", {}).get("status", "")
-    logger.info(f"Статус подписки: {status}")
-    return status in ["member", "administrator", "creator"]
-
-# Функция проверки подписки на один из нескольких каналов
-async def check_subscription_multiple(user_id: int, bot_token: str, channel_ids: list) -> bool:
-    for channel_id in channel_ids:
-        if await check_subscription(user_id, bot_token, channel_id):
-            return True
-    return False
+    today_date = datetime.now(BROADCAST_TIMEZONE).strftime('%Y-%m-%d')  # Получаем сегодняшнюю дату в формате ГГГГ-ММ-ДД
+    if context.job is not None and context.job.data and context.job.data != today_date:
+        # Повтор рассылки за прошедший день не выполняется
+        return
+    if not is_job_leader(f'broadcast:{today_date}', 24 * 60 * 60):
+        return
+    bot = DryRunBot() if BROADCAST_DRY_RUN else context.bot
+    if SHARD_INDEX is None:
+        users = user_cache.subscribed_users()
+    else:
+        # В кэше шарда только его пользователи - подписчиков читаем из общего хранилища
+        await user_cache.flush()
+        users = await asyncio.to_thread(user_store.subscribed_users)
+    if not HOROSCOPE_CACHE_BY_SIGN:
+        # Транзиты для всех подписчиков одним векторным расчетом
+        transits = await asyncio.to_thread(chart_engine.daily_transits, users, today_date, BROADCAST_TIMEZONE)
+        for user in users:
+            if user['user_id'] in transits:
+                user['natal_brief'], user['transits'] = transits[user['user_id']]
+    stats = await horoscope_broadcaster.run(bot, users, today_date, dry_run=BROADCAST_DRY_RUN)
+    if stats['retry']:
+        context.job_queue.run_once(send_daily_horoscopes, when=BROADCAST_RETRY_DELAY, data=today_date)
+    logger.info(f"Кэш генераций после рассылки: {generation_cache.stats()}")
+
+# Периодическая очистка кэша генераций
+async def purge_generation_cache(context: CallbackContext) -> None:
+    if not is_job_leader('purge_generation_cache', 2 * 24 * 60 * 60):
+        return
+    await asyncio.to_thread(generation_cache.purge)
+
+# Промпты, ответы на которые не зависят от пользователя
+def fixed_opener_prompts():
+    prompts = [prompt_builder.build_opener(role) for role, spec in ROLES.items() if spec.opener]
+    prompts += [prompt_builder.build_opener('psychologist', opener, method_text=psychology_method_text(method))
+                for method, opener in PSYCHOLOGY_OPENERS.items()]
+    return prompts
+
+# Заполнение и обновление пула готовых ответов
+async def refresh_opener_pool(context: CallbackContext) -> None:
+    if not is_job_leader('opener_pool', 2 * 60 * 60):
+        return
+    for messages in fixed_opener_prompts():
+        opener_pool.refresh(messages)
+
+# Проверка подписки на один из каналов с кэшированием результата
+subscription_checker = SubscriptionChecker(CHANNEL_IDS, positive_ttl=SUBSCRIPTION_POSITIVE_TTL,
+                                           negative_ttl=SUBSCRIPTION_NEGATIVE_TTL)
 
 # Функции для обработки команд
+@metrics.traced('start')
 async def start(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
     username = update.message.from_user.username
-    is_subscribed = await check_subscription_multiple(user_id, TELEGRAM_TOKEN, CHANNEL_IDS)
+    # /start - повторная проверка после подписки: не ждем истечения отрицательного кэша
+    subscription_checker.invalidate(user_id)
+    with metrics.span('subscription_check'):
+        is_subscribed = await subscription_checker.is_subscribed(context.bot, user_id)
     if not is_subscribed:
         await update.message.reply_text(
             "Данные бот работает для вас абсолютно бесплатно. Пожалуйста, подпишитесь на один из предложенных каналов, который может быть вам интересен и продолжите использование бота.\n\n"
@@ -223,8 +432,7 @@ async def start(update: Update, context: CallbackContext) -> None:
             parse_mode='Markdown'
         )
         return
-    user_data = load_user_data()
-    add_or_update_user(user_data, user_id, username, context)
+    add_or_update_user(user_id, username, context)
     keyboard = [
         [InlineKeyboardButton("🧠 Психолог", callback_data="psychologist")],
         [InlineKeyboardButton("💼 Карьерный консультант", callback_data="career_consultant")],
@@ -249,82 +457,66 @@ async def start(update: Update, context: CallbackContext) -> None:
         reply_markup=reply_markup
     )
 
-async def button_click(update: Update, context: CallbackContext, choice=None) -> None:
-    if update.callback_query:
-        query = update.callback_query
-        await query.answer()
-        choice = query.data
-    else:
-        query = update.message
-        choice = choice or query.text[1:]
-
-    if choice == "tarot":
-        context.user_data['role'] = 'tarot'
-        await query.edit_message_text(text="✨ Добро пожаловать к нашей мудрой гадалке на картах ТАРО! ✨\n\n"
-        "🃏 Карты Таро могут помочь вам раскрыть скрытые аспекты вашей жизни, получить ценные советы и найти ответы на волнующие вопросы.\n\n"
-        "❓ **Как это работает:**\n"
-        "1. Задайте любой вопрос, который у вас на сердце — это может быть вопрос о любви, карьере, здоровье или будущем.\n"
-        "2. Постарайтесь быть конкретным в своём вопросе, чтобы карты могли дать вам наиболее точный ответ.\n\n"
-        "🔮 **Примеры вопросов:**\n"
-        "- Что ждет меня в ближайшем будущем в отношениях?\n"
-        "- Какие шаги мне следует предпринять для карьерного роста?\n"
-        "- Какое решение будет наилучшим в текущей ситуации?\n\n"
-        "Не стесняйтесь, задайте свой вопрос, и пусть карты ТАРО откроют вам свою мудрость!")
-    elif choice == "astrology":
-        context.user_data['role'] = 'astrology'
+# Клавиатура выбора методики психолога
+def psychology_methods_keyboard():
+    methods = list(PSYCHOLOGY_METHODS.items())
+    keyboard = [[InlineKeyboardButton(label, callback_data=method) for method, (label, _) in methods[i:i + 2]]
+                for i in range(0, len(methods), 2)]
+    return InlineKeyboardMarkup(keyboard)
+
+# Выбор роли, общий для кнопок и команд. reply - правка сообщения с кнопками или новое сообщение
+async def select_role(update: Update, context: CallbackContext, choice: str, reply) -> None:
+    context.user_data['role'] = choice
+    # Выбор роли (в том числе повторный /tarot) начинает новый расклад Таро
+    context.user_data.pop('tarot_spread', None)
+    context.user_data.pop('tarot_seed', None)
+    spec = ROLES[choice]
+    if choice == "astrology":
         if 'date_of_birth' in context.user_data:
             if 'time_of_birth' in context.user_data:
                 if 'place_of_birth' in context.user_data:
-                    await query.edit_message_text(text="Все данные уже введены. Введите ваш вопрос для астролога:")
+                    await reply("Все данные уже введены. Введите ваш вопрос для астролога:")
                 else:
-                    await query.edit_message_text(text="Введите место рождения:")
+                    await reply(ASK_PLACE_OF_BIRTH)
             else:
-                await query.edit_message_text(text="Введите время рождения (в формате ЧЧ:ММ):")
+                await reply(ASK_TIME_OF_BIRTH)
         else:
-            await query.edit_message_text(text="Вы выбрали роль астролога. Введите вашу дату рождения (в формате ДД.ММ.ГГГГ):")
+            await reply(spec.welcome)
     elif choice == "numerology":
-        context.user_data['role'] = 'numerology'
         if 'date_of_birth' in context.user_data:
-            await query.edit_message_text(text="Дата рождения уже введена. Введите ваш вопрос для нумеролога:")
+            await reply("Дата рождения уже введена. Введите ваш вопрос для нумеролога:")
         else:
-            await query.edit_message_text(
-                text="Вы выбрали роль нумеролога. Введите свою дату рождения (в формате ДД.ММ.ГГГГ):")
-    elif choice == "self_development_coach":
-        context.user_data['role'] = 'self_development_coach'
-        prompt = "Представь, что ты коуч по саморазвитию, а я у тебя на приеме. Я впервые на приеме у коуча по саморазвитию, поэтому возьми инициативу по диалогу в свои руки. Разговор должен быть интерактивным, вовлекающим"
+            await reply(spec.welcome)
+    elif choice == "psychologist":
+        await reply(spec.welcome, reply_markup=psychology_methods_keyboard())
+    elif spec.opener:
+        # Роль сама начинает диалог
         try:
-            response = send_openai_request(prompt)
-            await query.edit_message_text(response)
+            response = await opener_pool.get(prompt_builder.build_opener(choice))
+            await reply(response)
         except Exception as e:
-            logger.error(f"Error generating self-development coach response: {e}")
-            await query.edit_message_text("Произошла ошибка при получении ответа. Попробуйте еще раз позже.")
-    elif choice == "psychologist":
-        context.user_data['role'] = 'psychologist'
-        keyboard = [
-            [InlineKeyboardButton("Когнитивно-поведенческая", callback_data="cbt"), InlineKeyboardButton("Психодинамическая", callback_data="psychodynamic")],
-            [InlineKeyboardButton("Гештальт-терапия", callback_data="gestalt"), InlineKeyboardButton("Не разбираюсь", callback_data="unsure")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text="Вы выбрали роль психолога. Выберите методику терапии или нажмите 'не разбираюсь':", reply_markup=reply_markup)
-    elif choice == "career_consultant":
-        context.user_data['role'] = 'career_consultant'
-        await query.edit_message_text(text="💼 Добро пожаловать к Карьерному консультанту!\n\n"
-                                           "Я могу помочь вам с профессиональными советами, планированием карьеры и достижением ваших карьерных целей.\n\n"
-                                           "❓ **Как это работает:**\n"
-                                           "1. Опишите вашу текущую профессиональную ситуацию или задайте конкретный вопрос о карьере.\n"
-                                           "2. Я дам вам рекомендации и советы, чтобы помочь вам продвинуться в вашей карьере.\n\n"
-                                           "🔮 **Примеры вопросов:**\n"
-                                           "- Как мне улучшить свои навыки для повышения?\n"
-                                           "- Как подготовиться к собеседованию на новую работу?\n"
-                                           "- Как достичь баланса между работой и личной жизнью?\n\n"
-                                           "Не стесняйтесь, задайте свой вопрос, и я помогу вам найти наилучшее решение!")
+            logger.error(f"Error generating {choice} opener: {e}")
+            await reply("Произошла ошибка при получении ответа. Попробуйте еще раз позже.")
+    else:
+        await reply(spec.welcome)
+
+async def button_click(update: Update, context: CallbackContext, choice=None) -> None:
+    if update.callback_query:
+        query = update.callback_query
+        await query.answer()
+        choice = query.data
+        reply = query.edit_message_text
+    else:
+        choice = choice or update.message.text[1:]
+        reply = update.message.reply_text
+    await select_role(update, context, choice, reply)
 
 async def handle_date_of_birth(update: Update, context: CallbackContext) -> bool:
-    date_of_birth = update.message.text
-    if not re.match(r'^\d{2}\.\d{2}\.\d{4}$', date_of_birth):
-        await update.message.reply_text("Неправильный формат даты. Введите дату рождения в формате ДД.ММ.ГГГГ:")
+    birth_date = numerology.parse_birth_date(update.message.text)
+    if birth_date is None:
+        await update.message.reply_text("Неправильная дата. Введите дату рождения в формате ДД.ММ.ГГГГ:")
         return False
-    context.user_data['date_of_birth'] = date_of_birth
+    context.user_data['date_of_birth'] = birth_date.strftime(numerology.DATE_FORMAT)
     return True
     await update.message.reply_text("Введите время вашего рождения (в формате ЧЧ:ММ):")
 
@@ -348,20 +540,26 @@ async def handle_place_of_birth(update: Update, context: CallbackContext) -> Non
     # Сохранение данных пользователя после обновления
     user_id = update.message.from_user.id
     username = update.message.from_user.username
-    user_data = load_user_data()
-    add_or_update_user(user_data, user_id, username, context, date_of_birth=context.user_data['date_of_birth'],
+    add_or_update_user(user_id, username, context, date_of_birth=context.user_data['date_of_birth'],
                        time_of_birth=context.user_data['time_of_birth'],
                        place_of_birth=place_of_birth)  # Обновление всех данных о рождении
 
-    prompt = f"Представь, что ты астролог. Моя дата рождения {date_of_birth}, время рождения {time_of_birth}, место рождения {place_of_birth}. Дай мне ответы на мои вопросы на основе моей натальной карты. Общайся так, чтобы казалось, что человек на реальном приеме у профессионального астролога. В ответах давай меньше воды и больше полезной информации и интерпретаций. Не говори о том, что ты не можешь рассчитать что-то и тем более не нужно рекомендовать посетить какие-то сайты."
+    # Первый ответ зависит только от данных рождения и рассчитанной карты и кэшируется по тексту промпта
+    messages = prompt_builder.build_opener('astrology', "Дай мне ответы на мои вопросы на основе моей натальной карты.",
+                                           date_of_birth=date_of_birth, time_of_birth=time_of_birth,
+                                           place_of_birth=place_of_birth,
+                                           chart=chart_engine.describe(date_of_birth, time_of_birth, place_of_birth))
+    key = prompt_key(messages)
 
     try:
-        response = send_openai_request(prompt)
+        response = await generation_cache.get_or_generate(
+            key, lambda: send_openai_request(messages, user_id=user_id, role='astrology'))
         await update.message.reply_text(response)
     except Exception as e:
         logger.error(f"Error generating astrology forecast for {date_of_birth}, {time_of_birth}, {place_of_birth}: {e}")
         await update.message.reply_text("Произошла ошибка при получении прогноза. Попробуйте еще раз позже.")
 
+@metrics.traced('psychology_method')
 async def handle_psychologist_choice(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     await query.answer()
@@ -382,206 +580,262 @@ async def handle_psychologist_choice(update: Update, context: CallbackContext) -
         await query.edit_message_text(text="Произошла ошибка. Попробуйте еще раз.")
         return
 
-    user_data = load_user_data()
-    tokens_used = count_tokens(message_text)
-    add_or_update_user(user_data, user_id, username, context, tokens_used)
+    add_or_update_user(user_id, username, context)
 
-    # Загрузка истории чатов
-    chat_history = load_chat_history(user_id, limit=10)
+    # Загрузка сводки и последних реплик
+    with metrics.span('history_read'):
+        summary, chat_history = summarizer.recent(user_id, limit=SUMMARY_KEEP_RECENT * 2)
 
     # Сохранение текущего сообщения в историю чатов
     save_chat_history(user_id, message_text, 'user')
 
-    # Формирование текста истории чатов
-    chat_history_text = "\n".join([f"{entry['role']}: {entry['message']}" for entry in chat_history])
-
-    method_text = {
-        "cbt": "когнитивно-поведенческая",
-        "psychodynamic": "психодинамическая",
-        "gestalt": "гештальт-терапия",
-        "unsure": "которая будет эффективна в моем случае"
-    }.get(method, "не разбираюсь")
-    if chat_history:
-        prompt = f"Ты - психолог, использующий методику {method_text}. Вот история общения:\n{chat_history_text}\nПользователь: {message_text}"
-    else:
-        if method == "gestalt":
-            prompt = "Если у вас есть конкретные вопросы или темы, которые вы хотите обсудить в контексте гештальт-терапии, пожалуйста, дайте знать. Я здесь, чтобы помочь!"
-        elif method == "unsure":
-            prompt = (
-                "Похоже, что вы хотите начать терапевтический процесс, но не уверены, с чего начать. Позвольте мне предложить несколько известных методик терапии, чтобы помочь вам выбрать подходящую для вас:\n\n"
-                "1. Когнитивно-поведенческая терапия (КПТ) фокусируется на изменении деструктивных мыслей и поведения. Подходит при тревожности, депрессии и фобиях.\n\n"
-                "2. Гуманистическая терапия - акцент на самопознании и самореализации.\n\n"
-                "3. Терапия, основанная на осознании (майндфулнесс): включает практики медитации и внимательности, помогает снизить уровень стресса и повысить эмоциональную устойчивость.\n\n"
-                "4. Психоаналитическая терапия  исследует бессознательные процессы и их влияние на поведение.\n\n"
-                "Вы можете выбрать ту методику, которая вам подходит больше всего. Или же напишите, о чем вы хотели бы поговорить?"
-            )
-        else:
-            prompt = f"Представь, что ты психолог, использующий методику {method_text}. Ответь на вопрос: {message_text}. Держи ответы неформальными, но точными. Используй технические термины и концепции свободно — считай, что собеседник в теме. Будь прямым. Избавься от вежливых формальностей и лишней вежливости.Приводи примеры только когда уместно.Подстраивай глубину и длину ответов под контекст. Сначала точность, но без лишней воды. Короткие, четкие фразы — нормально.Дай своей личности проявиться, но не затми суть.Не старайся быть «супер-помощником» в каждом предложении."
-
+    method_text = psychology_method_text(method)
     try:
-        response = send_openai_request(prompt)
+        if not chat_history and not summary and method in PSYCHOLOGY_OPENERS:
+            # Ответ на неизменный первый промпт методики берется из пула готовых
+            response = await opener_pool.get(
+                prompt_builder.build_opener('psychologist', PSYCHOLOGY_OPENERS[method], method_text=method_text))
+        else:
+            messages = prompt_builder.build('psychologist', chat_history, message_text, summary=summary, method_text=method_text)
+            response = await send_openai_request(messages, user_id=user_id, role='psychologist')
         await query.edit_message_text(response)
+        summarizer.maybe_summarize(user_id)
     except Exception as e:
         logger.error(f"Error generating psychology response for method {method_text}: {e}")
         await query.edit_message_text("Произошла ошибка при получении ответа. Попробуйте еще раз позже.")
 
 # Обработчик сообщений пользователя
+@metrics.traced('message')
 async def handle_message(update: Update, context: CallbackContext, recognized_text: str = None) -> None:
     # Если recognized_text передан, используем его, иначе берем текст из update.message.text
     message_text = recognized_text if recognized_text is not None else update.message.text
 
     user_id = update.message.from_user.id
     username = update.message.from_user.username
-    user_data = load_user_data()
-    tokens_used = count_tokens(message_text)
 
     # Проверка на наличие стоп-слов
-    if not validate_message(message_text, stop_words_regex):
+    with metrics.span('stop_words'):
+        is_valid = validate_message(message_text, stop_words_filter)
+    if not is_valid:
+        metrics.inc('stop_word_hits_total')
         await update.message.reply_text(
             "Извините, я не могу отвечать на подобные вопросы. Пожалуйста, направьте ваши запросы в безопасное и конструктивное русло.")
         return
 
-    addition_for_prompt = ("Анализируй каждый запрос на предмет содержания. Если запрос "
-                           "содержит неадекватные, аморальные, пошлые, агрессивные, деструктивные элементы, ответь "
-                           "следующим образом: 'Извините, я не могу отвечать на подобные вопросы. Пожалуйста, направьте "
-                           "ваши запросы в безопасное и конструктивное русло.'")
-    # Проверка ограничения запросов
-    for user in user_data:
-        if user['user_id'] == user_id:
-            today = datetime.now().strftime('%d-%m-%Y')
-            if user['last_request_date'] != today:
-                user['daily_requests'] = 0
-                user['last_request_date'] = today
-
-            if user['daily_requests'] >= 5:
-                await update.message.reply_text("Вы превысили лимит 5 запросов в день. Попробуйте завтра.")
-                return
-
-            user['daily_requests'] += 1
-            break
-
-    add_or_update_user(user_data, user_id, username, context, tokens_used)
-
-    # Загрузка истории чатов
-    chat_history = load_chat_history(user_id, limit=10)
-
     if 'role' in context.user_data:
         role = context.user_data['role']
     else:
         role = 'default'
 
+    # Проверка ограничения запросов
+    quota = quota_limiter.consume(user_id, role)
+    if not quota.allowed:
+        metrics.inc('quota_rejections_total', role=role)
+        if quota.retry_after is not None:
+            await update.message.reply_text(
+                f"Вы превысили лимит {quota.limit} запросов. Попробуйте через {int(quota.retry_after // 60) + 1} мин.")
+        else:
+            await update.message.reply_text(f"Вы превысили лимит {quota.limit} запросов в день. Попробуйте завтра.")
+        return
+
+    with metrics.span('user_store_write'):
+        add_or_update_user(user_id, username, context)
+
+    # Загрузка сводки и последних реплик, еще не попавших в сводку
+    with metrics.span('history_read'):
+        summary, chat_history = summarizer.recent(user_id, limit=SUMMARY_KEEP_RECENT * 2)
+
     # Сохранение текущего сообщения в историю чатов
     save_chat_history(user_id, message_text, role)
 
-    # Формирование текста истории чатов
-    chat_history_text = "\n".join([f"{entry['role']}: {entry['message']}" for entry in chat_history])
-
-    # Проверка на роль пользователя и создание промпта для OpenAI с учетом истории
+    # Сбор данных, нужных роли, и создание промпта для OpenAI с учетом истории
+    facts = {}
+    reading = None
     if role == 'tarot':
-        if chat_history:
-            prompt = f"Ты - гадалка на картах ТАРО. Вот история общения:\n{chat_history_text}\nПользователь: {message_text}"
+        # Карты выпадают локально и воспроизводимо, модель получает готовый расклад.
+        # Раскладываются они на первый вопрос, уточняющие вопросы толкуются по тем же картам
+        spread, seed = context.user_data.get('tarot_spread'), context.user_data.get('tarot_seed')
+        if seed is None or spread not in tarot.SPREADS:
+            reading = tarot.draw(user_id, message_text, TAROT_SPREAD)
+            context.user_data['tarot_spread'] = reading.spread
+            context.user_data['tarot_seed'] = reading.seed
+            logger.debug(f"Расклад для пользователя {user_id}: seed={reading.seed}")
+            spread_reading = reading
         else:
-            prompt = f"Представь, что ты гадалка на картах ТАРО. Выложи 3 карты и дай предсказание на вопрос: {message_text}. Давай меньше воды, теории и больше интерпретации. Рассказывай так, чтобы читателю было интересно и создавалось впечатление, что человек на реальном приеме у гадалки"
-        waiting_message = await update.message.reply_text("🔮Достаю карты...🔮", disable_notification=True)
+            spread_reading = tarot.draw(user_id, message_text, spread, seed=seed)
+        facts = {'spread_title': tarot.SPREADS[spread_reading.spread][0],
+                 'cards': tarot.format_for_prompt(spread_reading)}
     elif role == 'astrology':
         if 'date_of_birth' not in context.user_data:
             if not await handle_date_of_birth(update, context):
                 return
-            await update.message.reply_text("Введите время рождения (в формате ЧЧ:ММ):")
+            await update.message.reply_text(ASK_TIME_OF_BIRTH)
             return
         if 'time_of_birth' not in context.user_data:
             if not await handle_time_of_birth(update, context):
                 return
-            await update.message.reply_text("Введите место рождения:")
+            await update.message.reply_text(ASK_PLACE_OF_BIRTH)
             return
         if 'place_of_birth' not in context.user_data:
             await handle_place_of_birth(update, context)
             return
-        if chat_history:
-            prompt = f"Ты - астролог. Вот история общения:\n{chat_history_text}\nПользователь: {message_text}"
-        else:
-            if 'date_of_birth' not in context.user_data:
-                if not await handle_date_of_birth(update, context):
-                    return
-            prompt = f"Представь, что ты астролог. Моя дата рождения {context.user_data['date_of_birth']}, время рождения {context.user_data['time_of_birth']}, место рождения {context.user_data['place_of_birth']}. Дай мне ответ как астролог на основе моей натальной карты на мой вопрос: {message_text}. Общайся так, чтобы казалось, что человек на реальном приеме у профессионального астролога. В ответах давай меньше воды и больше полезной информации и интерпретаций. Не говори о том, что ты не можешь рассчитать что-то и тем более не нужно рекомендовать посетить какие-то сайты."
-        waiting_message = await update.message.reply_text("🌘Составляю карту планет...🌘", disable_notification=True)
+        facts = {key: context.user_data[key] for key in ('date_of_birth', 'time_of_birth', 'place_of_birth')}
+        with metrics.span('natal_chart'):
+            facts['chart'] = chart_engine.describe(facts['date_of_birth'], facts['time_of_birth'], facts['place_of_birth'])
     elif role == 'numerology':
         if 'date_of_birth' not in context.user_data:
             if not await handle_date_of_birth(update, context):
                 return
+            # Дата только что введена: основные числа считаются локально, без запроса к LLM
+            reply = f"{numerology.summary(context.user_data['date_of_birth'])}\n\nВведите ваш вопрос для нумеролога:"
         else:
-            await update.message.reply_text("Введите ваш вопрос для нумеролога:")
-        if chat_history:
-            prompt = f"Ты - Нумеролог. Вот история общения:\n{chat_history_text}\nПользователь: {message_text}"
-        else:
-            prompt = f"Представь, что ты нумеролог. Я пришел к тебе на прием. Моя дата рождения {context.user_data['date_of_birth']}. Я впервые у нумеролога, поэтому возьми инициативу по диалогу на себя. Дай прогноз на мой вопрос: {message_text}. Или предложи мне несколько популярных вопросов, с которых мы можем начать.В ответах давай меньше воды и вступительных слов, а больше полезной информации и интерпритаций."
-        waiting_message = await update.message.reply_text("🔢Считаю цифры...🔢", disable_notification=True)
-    elif role == 'self_development_coach':
-        if chat_history:
-            prompt = f"Ты - Коуч по саморазвитию. Вот история общения:\n{chat_history_text}\nПользователь: {message_text}"
-        else:
-            prompt = f"Представь, что ты коуч по саморазвитию. Ответь на вопрос: {message_text}."
-        waiting_message = await update.message.reply_text("💪Составляю ответ...💪", disable_notification=True)
+            reply = numerology.canned_answer(context.user_data['date_of_birth'], message_text)
+        if reply:
+            metrics.inc('numerology_canned_total')
+            quota_limiter.refund(user_id, role)
+            save_chat_history(user_id, reply, 'bot')
+            await update.message.reply_text(reply)
+            return
+        facts = {'date_of_birth': context.user_data['date_of_birth'],
+                 'numbers': numerology.format_for_prompt(context.user_data['date_of_birth'])}
     elif role == 'psychologist':
         method = context.user_data.get('psychology_method')
         if not method:
             await update.message.reply_text(
                 "Пожалуйста, выберите методику, нажав /start и выбрав роль психолога снова.")
             return
-        method_text = {
-            "cbt": "когнитивно-поведенческая",
-            "psychodynamic": "психодинамическая",
-            "gestalt": "гештальт-терапия",
-            "unsure": "которая будет эффективна в моем случае"
-        }.get(method, "которая будет эффективна в моем случае")
-        if chat_history:
-            prompt = f"Ты - Психолог, работающий по методике {method_text}. Вот история общения:\n{chat_history_text}\nПользователь: {message_text}"
-        else:
-            prompt = f"Представь, что ты психолог, использующий методику {method_text}. Ответь на вопрос: {message_text}. Держи ответы неформальными, но точными. Используй технические термины и концепции свободно — считай, что собеседник в теме. Будь прямым. Избавься от вежливых формальностей и лишней вежливости.Приводи примеры только когда уместно.Подстраивай глубину и длину ответов под контекст. Сначала точность, но без лишней воды. Короткие, четкие фразы — нормально.Дай своей личности проявиться, но не затми суть.Не старайся быть «супер-помощником» в каждом предложении."
-        waiting_message = await update.message.reply_text("🧠Составляю ответ...🧠", disable_notification=True)
-    elif role == 'career_consultant':
-        if chat_history:
-            prompt = f"Ты - карьерный консультант. Вот история общения:\n{chat_history_text}\nПользователь: {message_text}"
-        else:
-            prompt = f"Представь, что ты опытный карьерный консультант. Пользователь пришел к тебе на прием впервые, веди интерактивный диалог. Ответь на вопрос: {message_text}."
-        waiting_message = await update.message.reply_text("💼Составляю ответ...💼", disable_notification=True)
-    else:
+        facts = {'method_text': psychology_method_text(method)}
+    elif role not in ROLES:
         await update.message.reply_text("Пожалуйста, выберите роль, нажав /start")
         return
 
+    with metrics.span('prompt_build'):
+        messages = prompt_builder.build(role, chat_history, message_text, summary=summary, **facts)
+    with metrics.span('telegram_send'):
+        if reading:
+            await update.message.reply_text(tarot.format_cards(reading))
+        waiting_message = await update.message.reply_text(ROLES[role].waiting_text, disable_notification=True)
+
     try:
-        prompt += addition_for_prompt
-        response = send_openai_request(prompt)
-        await waiting_message.delete()
-        await update.message.reply_text(response)
-        save_chat_history(user_id, response, 'bot')  # Сохранение ответа бота в историю чатов
+        if LLM_STREAMING:
+            response = await stream_openai_request(messages, waiting_message, user_id=user_id, role=role)
+        else:
+            response = await send_openai_request(messages, user_id=user_id, role=role)
+            with metrics.span('telegram_send'):
+                await waiting_message.delete()
+                await update.message.reply_text(response)
+        # Сохранение ответа бота в историю чатов (для Таро - вместе с выпавшими картами)
+        save_chat_history(user_id, f"{tarot.format_cards(reading)}\n\n{response}" if reading else response, 'bot')
+        # Сворачивание старых реплик в сводку идет в фоне
+        summarizer.maybe_summarize(user_id)
+    except TokenBudgetExceeded:
+        metrics.inc('token_budget_rejections_total', role=role)
+        quota_limiter.refund(user_id, role)
+        await waiting_message.edit_text("Сейчас слишком много запросов. Попробуйте еще раз через минуту.")
+    except LLMUnavailable as e:
+        logger.warning(f"LLM недоступна для роли {role}: {e}")
+        quota_limiter.refund(user_id, role)
+        await waiting_message.edit_text("Сервис ответов сейчас перегружен. Попробуйте еще раз через пару минут.")
     except Exception as e:
         logger.error(f"Error generating response for role {role}: {e}")
+        quota_limiter.refund(user_id, role)
         await update.message.reply_text("Произошла ошибка при получении ответа. Попробуйте еще раз позже.")
 
 
+# Пользователь вводит данные рождения по шагам: такие сообщения не склеиваются
+def awaiting_birth_data(user_data):
+    role = user_data.get('role')
+    if role == 'astrology':
+        return any(key not in user_data for key in ('date_of_birth', 'time_of_birth', 'place_of_birth'))
+    return role == 'numerology' and 'date_of_birth' not in user_data
+
+# Точки входа обработчиков: ставят обновление в очередь пользователя
+async def queue_text_message(update: Update, context: CallbackContext) -> None:
+    await user_queue.run(update.message.from_user.id, handle_message, update, context, text=update.message.text,
+                         merge_if=lambda: not awaiting_birth_data(context.user_data))
+
+async def queue_voice_message(update: Update, context: CallbackContext) -> None:
+    await user_queue.run(update.message.from_user.id, handle_voice_message, update, context)
+
+async def queue_psychologist_choice(update: Update, context: CallbackContext) -> None:
+    await user_queue.run(update.effective_user.id, handle_psychologist_choice, update, context)
+
+
 # Функция для отправки запросов к OpenAI
-def send_openai_request(prompt: str, max_tokens: int = MAX_TOKENS) -> str:
-    headers = {
-        'Authorization': f'Bearer {PROXY_API_KEY}',
-        'Content-Type': 'application/json'
-    }
-    data = {
-        'model': MODEL_NAME,
-        'messages': [{'role': 'user', 'content': prompt}],
-        'max_tokens': MAX_TOKENS
-    }
-    response = requests.post(PROXY_API_URL, headers=headers, json=data)
-    response_data = response.json()
-    return response_data['choices'][0]['message']['content']
-# Подсчет токенов для ответа и обновление данных о пользователе
-    response_tokens_used = count_tokens(reply_text)
-    return reply_text, response_tokens_used
-    add_or_update_user(user_data, user_id, username, response_tokens_used)
+async def send_openai_request(prompt, max_tokens: int = MAX_TOKENS, user_id: int = None, role: str = None) -> str:
+    reserved = await reserve_tokens(prompt, max_tokens)
+    try:
+        with metrics.span('llm_call'):
+            response = await llm_gateway.complete(prompt, max_tokens=max_tokens)
+    except Exception:
+        metrics.inc('llm_errors_total', role=role or 'default')
+        raise
+    record_token_usage(user_id, role, prompt, response, reserved)
+    return response.text
+
+# Потоковый запрос к OpenAI: ответ появляется в сообщении-заглушке по мере генерации
+async def stream_openai_request(prompt, message, max_tokens: int = MAX_TOKENS, user_id: int = None, role: str = None) -> str:
+    reserved = await reserve_tokens(prompt, max_tokens)
+    streamer = MessageStreamer(message, interval=STREAM_EDIT_INTERVAL, min_chars=STREAM_EDIT_MIN_CHARS)
+    try:
+        # Включает промежуточные правки сообщения, которые идут по мере генерации
+        with metrics.span('llm_stream'):
+            response = await llm_gateway.stream_complete(prompt, streamer.update, max_tokens=max_tokens)
+    except Exception:
+        metrics.inc('llm_errors_total', role=role or 'default')
+        raise
+    with metrics.span('telegram_send'):
+        await streamer.finish(response.text)
+    record_token_usage(user_id, role, prompt, response, reserved)
+    return response.text
+
+# Резерв токенов в общем бюджете перед запросом к LLM (оценка: промпт плюс максимум ответа)
+async def reserve_tokens(prompt, max_tokens):
+    if token_budget.tokens_per_minute <= 0:
+        return 0
+    with metrics.span('token_count'):
+        reserved = count_tokens(prompt) + max_tokens
+    await token_budget.acquire(reserved)
+    return reserved
+
+# Подсчет токенов запроса и ответа и обновление данных о пользователе
+def record_token_usage(user_id, role, prompt, response, reserved=0):
+    # Данные из поля usage точнее локального подсчета, поэтому кодируем текст только без них
+    with metrics.span('token_count'):
+        prompt_tokens = response.prompt_tokens if response.prompt_tokens is not None else count_tokens(prompt)
+        completion_tokens = response.completion_tokens if response.completion_tokens is not None else count_tokens(response.text)
+    metrics.inc('llm_tokens_total', prompt_tokens, kind='prompt', role=role or 'default')
+    metrics.inc('llm_tokens_total', completion_tokens, kind='completion', role=role or 'default')
+    if reserved:
+        token_budget.adjust(prompt_tokens + completion_tokens - reserved)
+    if user_id is None:
+        return
+    token_usage.record(user_id, role, prompt_tokens, completion_tokens)
+    user = user_cache.get(user_id)
+    if user:
+        user_cache.update(user_id, tokens_used=(user.get('tokens_used') or 0) + prompt_tokens + completion_tokens)
+
+# Статистика расхода токенов по ролям (только для администратора)
+async def token_stats_command(update: Update, context: CallbackContext) -> None:
+    if str(update.message.from_user.id) != str(ADMIN_CHAT_ID):
+        return
+    totals = token_usage.totals_by_role()
+    if not totals:
+        await update.message.reply_text("Статистика по токенам пока пуста.")
+        return
+    lines = [f"{role}: запросов {stats['requests']}, токенов запроса {stats['prompt_tokens']}, ответа {stats['completion_tokens']}"
+             for role, stats in sorted(totals.items(), key=lambda item: -(item[1]['prompt_tokens'] + item[1]['completion_tokens']))]
+    cache_stats = generation_cache.stats()
+    lines.append(f"Кэш генераций: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']} "
+                 f"({cache_stats['hit_rate']:.0%})")
+    pool_stats = opener_pool.stats()
+    lines.append(f"Пул готовых ответов: попаданий {pool_stats['hits']}, промахов {pool_stats['misses']}")
+    await update.message.reply_text("Расход токенов по ролям:\n" + "\n".join(lines))
 
 async def check_subscription_and_handle_role(update: Update, context: CallbackContext, choice: str) -> None:
     user_id = update.message.from_user.id
-    is_subscribed = await check_subscription_multiple(user_id, TELEGRAM_TOKEN, CHANNEL_IDS)
+    with metrics.span('subscription_check'):
+        is_subscribed = await subscription_checker.is_subscribed(context.bot, user_id)
     if not is_subscribed:
         await update.message.reply_text("Вы не подписаны ни на 1 из каналов. Пожалуйста, подпишитесь на один из предложенных каналов, чтобы продолжить использование бота.")
         return
@@ -607,120 +861,51 @@ async def career_consultant_command(update: Update, context: CallbackContext) ->
 
 
 async def handle_role_selection(update: Update, context: CallbackContext, choice: str) -> None:
-    context.user_data['role'] = choice
-    if choice == "tarot":
-        await update.message.reply_text(
-            "🟨 /tarot\n\n"
-            "✨ Добро пожаловать в мир ТАРО! ✨\n\n"
-            "🃏 Карты Таро могут помочь вам раскрыть скрытые аспекты вашей жизни, получить ценные советы и посмотреть на ситуацию с новой стороны.\n\n"
-            "1. Задайте любой вопрос, который у вас на сердце — это может быть вопрос о любви, карьере, здоровье или будущем.\n"
-            "2. Постарайтесь быть конкретным в своём вопросе, чтобы карты могли дать вам наиболее точный ответ.\n\n"
-            "🔮 Примеры вопросов:\n"
-            "- Какие шаги мне следует предпринять для карьерного роста?\n"
-            "- Какое решение будет наилучшим в текущей ситуации?\n"
-            "- Как бы я хотела выстроить эти отношения?\n\n"
-            "Не стесняйтесь, задайте свой вопрос, и пусть карты ТАРО откроют вам свою мудрость!"
-        )
-    elif choice == "astrology":
-        if 'date_of_birth' in context.user_data:
-            if 'time_of_birth' in context.user_data:
-                if 'place_of_birth' in context.user_data:
-                    await update.message.reply_text("Все данные уже введены. Введите ваш вопрос для астролога:")
-                else:
-                    await update.message.reply_text("Введите место рождения в свободной форме (Например: Казань или Выборг, Ленинградская обл. и тд):")
-            else:
-                await update.message.reply_text("Введите время рождения в формате ЧЧ:ММ (например 07:20 или 19:00):")
-        else:
-            await update.message.reply_text(
-                "Астролог\n\n"
-                "Добро пожаловать в мир астрологии! ✨\n\n"
-                "Как астролог, я помогу вам понять, как звезды и планеты могут влиять на вашу жизнь.\n\n"
-                "Мне понадобятся данные о вашей дате, времени и месте рождения, чтобы я мог составить ваш персональный гороскоп и поделиться с вами удивительными астрологическими прогнозами.\n\n"
-                "Вот несколько примеров вопросов, которые вы можете задать:\n"
-                "- Что говорит мой солнечный знак обо мне?\n"
-                "- Какие планеты влияют на мою карьеру и отношения?\n"
-                "- Как лунные фазы могут повлиять на мое настроение и энергию?\n\n"
-                "Но, возможно, у вас есть свой вопрос, который больше вас интересует. Жду вашего запроса и готов помочь вам раскрыть тайны вашего астрологического пути.\n\n"
-                "Введите вашу дату рождения в формате ДД.ММ.ГГГГ (Например: 01.01.1995):"
-            )
-    elif choice == "numerology":
-        if 'date_of_birth' in context.user_data:
-            await update.message.reply_text("Дата рождения уже введена. Введите ваш вопрос для нумеролога:")
-        else:
-            await update.message.reply_text(
-                "Нумеролог\n\n"
-                "Добро пожаловать в мир нумерологии! 🌟\n\n"
-                "Как нумеролог, я помогу вам раскрыть тайны чисел, которые могут пролить свет на вашу личность, судьбу и жизненные пути.\n\n"
-                "Мне понадобится дата вашего рождения, чтобы я мог провести анализ и поделиться с вами удивительными инсайтами о вашем жизненном пути и предназначении.\n\n"
-                "Не стесняйтесь задавать вопросы о том, как числа могут влиять на вашу жизнь и как использовать эту информацию для личного роста и развития. Вот несколько примеров вопросов, которые вы можете задать:\n"
-                "- Какое значение имеет мое число судьбы?\n"
-                "- Как числа влияют на мою карьеру и личные отношения?\n\n"
-                "Или можете задать любой другой вопрос, а я постараюсь помочь вам узнать больше о себе через призму чисел.\n\n"
-                "Для продолжения введите свою дату рождения в формате ДД.ММ.ГГГГ (например: 01.01.1995):"
-            )
-    elif choice == "self_development_coach":
-        prompt = "Представь, что ты коуч по саморазвитию, а я у тебя на приеме. Я впервые на приеме у коуча по саморазвитию, поэтому возьми инициативу по диалогу в свои руки."
-        try:
-            response = send_openai_request(prompt)
-            await update.message.reply_text(response)
-        except Exception as e:
-            logger.error(f"Error generating self-development coach response: {e}")
-            await update.message.reply_text("Произошла ошибка при получении ответа. Попробуйте еще раз позже.")
-    elif choice == "psychologist":
-        keyboard = [
-            [InlineKeyboardButton("Когнитивно-поведенческая", callback_data="cbt"), InlineKeyboardButton("Психодинамическая", callback_data="psychodynamic")],
-            [InlineKeyboardButton("Гештальт-терапия", callback_data="gestalt"), InlineKeyboardButton("Не разбираюсь", callback_data="unsure")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Вы выбрали роль психолога. Выберите методику терапии или нажмите 'не разбираюсь':", reply_markup=reply_markup)
-    elif choice == "career_consultant":
-        await update.message.reply_text(
-            "Карьерный консультант\n\n"
-            "💼 Добро пожаловать к Карьерному консультанту!\n\n"
-            "Я могу помочь вам с профессиональными советами, планированием карьеры и достижением ваших карьерных целей.\n\n"
-            "❓ **Как это работает:**\n"
-            "1. Опишите вашу текущую профессиональную ситуацию или задайте конкретный вопрос о карьере.\n"
-            "2. Я дам вам рекомендации и советы, чтобы помочь вам продвинуться в вашей карьере.\n\n"
-            "🔮 **Примеры вопросов:**\n"
-            "- Как мне улучшить свои навыки для повышения?\n"
-            "- Как подготовиться к собеседованию на новую работу?\n"
-            "- Как достичь баланса между работой и личной жизнью?\n\n"
-            "Не стесняйтесь, задайте свой вопрос, и я помогу вам найти наилучшее решение!"
-        )
+    await select_role(update, context, choice, update.message.reply_text)
+
+# Конвейер распознавания голосовых сообщений в пуле воркеров
+transcription_pipeline = TranscriptionPipeline(RECOGNIZERS[VOICE_RECOGNIZER](), max_workers=VOICE_WORKERS,
+                                               max_queue=VOICE_MAX_QUEUE, max_per_user=VOICE_MAX_PER_USER,
+                                               max_duration=VOICE_MAX_DURATION, use_processes=VOICE_USE_PROCESSES)
 
 # Обработчик для голосовых сообщений
+@metrics.traced('voice')
 async def handle_voice_message(update: Update, context: CallbackContext) -> None:
-    waiting_message = await update.message.reply_text("Слушаю ваше голосовое сообщение, пожалуйста, дождитесь ответа.")
+    if update.message.voice.duration and update.message.voice.duration > VOICE_MAX_DURATION:
+        await update.message.reply_text(f"Голосовое сообщение слишком длинное. Максимальная длительность - {VOICE_MAX_DURATION} секунд.")
+        return
 
-    # Получаем голосовое сообщение
-    voice = await context.bot.get_file(update.message.voice.file_id)
+    waiting_message = await update.message.reply_text("Слушаю ваше голосовое сообщение, пожалуйста, дождитесь ответа.")
 
-    # Загрузка аудио файла в память
-    file = io.BytesIO(await voice.download_as_bytearray())
+    # Получаем голосовое сообщение и загружаем его в память
+    with metrics.span('voice_download'):
+        voice = await context.bot.get_file(update.message.voice.file_id)
+        data = bytes(await voice.download_as_bytearray())
 
-    # Конвертация OGG в WAV с помощью pydub
+    # Конвертация OGG в WAV и распознавание выполняются вне цикла событий
     try:
-        audio = AudioSegment.from_file(file, format="ogg")
-        wav_io = io.BytesIO()
-        audio.export(wav_io, format="wav")
-        wav_io.seek(0)
-    except Exception as e:
+        result = await transcription_pipeline.transcribe(update.message.from_user.id, data,
+                                                         duration_hint=update.message.voice.duration)
+    except TranscriptionBusy:
+        await update.message.reply_text("Сейчас обрабатывается слишком много голосовых сообщений. Попробуйте чуть позже.")
+        return
+    except AudioTooLong:
+        await update.message.reply_text(f"Голосовое сообщение слишком длинное. Максимальная длительность - {VOICE_MAX_DURATION} секунд.")
+        return
+    except AudioDecodeError:
         await update.message.reply_text("Ошибка при конвертации аудиофайла. Попробуйте снова.")
         return
-
-    recognizer = sr.Recognizer()
-
-    # Конвертация аудио в текст
-    try:
-        with sr.AudioFile(wav_io) as source:
-            audio_data = recognizer.record(source)
-            text = recognizer.recognize_google(audio_data, language="ru-RU")  # Выбор русского языка
-            await waiting_message.delete()
-            await handle_message(update, context, recognized_text=text)
-    except sr.UnknownValueError:
+    except SpeechNotRecognized:
         await update.message.reply_text("Не удалось распознать речь. Попробуйте снова.")
-    except sr.RequestError:
+        return
+    except RecognizerUnavailable:
         await update.message.reply_text("Ошибка сервиса распознавания речи. Попробуйте снова позже.")
+        return
+    metrics.observe('voice_decode', result.decode_seconds)
+    metrics.observe('voice_recognize', result.recognize_seconds)
+
+    await waiting_message.delete()
+    await handle_message(update, context, recognized_text=result.text)
 
 # Определяем состояния для разговора
 FEEDBACK = range(1)
@@ -749,18 +934,10 @@ async def cancel_feedback(update: Update, context: CallbackContext) -> None:
 
 async def clear_birth_data_command(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
-    user_data = load_user_data()
-    user_found = False
-    for user in user_data:
-        if user['user_id'] == user_id:
-            user.pop('date_of_birth', None)
-            user.pop('time_of_birth', None)
-            user.pop('place_of_birth', None)
-            user_found = True
-            break
-
-    if user_found:
-        save_user_data(user_data)
+
+    if user_cache.update(user_id, date_of_birth=None, time_of_birth=None, place_of_birth=None):
+        # Сводки разговоров могут содержать удаленные данные
+        summarizer.invalidate(user_id)
         context.user_data.pop('date_of_birth', None)
         context.user_data.pop('time_of_birth', None)
         context.user_data.pop('place_of_birth', None)
@@ -776,10 +953,53 @@ async def clear_birth_data_command(update: Update, context: CallbackContext) ->
     else:
         await update.message.reply_text("Ваши данные о рождении не найдены.")
 
-# Основная функция запуска бота
-def main() -> None:
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice_message))
+# Значения, которые читаются при каждой выгрузке метрик
+metrics.gauge('voice_queue_depth', lambda: transcription_pipeline.queue_depth, "Голосовые сообщения в очереди распознавания")
+metrics.gauge('user_cache_dirty', lambda: user_cache.dirty_count, "Записи пользователей, ожидающие записи на диск")
+metrics.gauge('user_queue_active_users', lambda: user_queue.active_users, "Пользователи с необработанными обновлениями")
+metrics.gauge('coalesced_messages', lambda: user_queue.coalesced, "Сообщения, склеенные с предыдущими с момента запуска")
+metrics.gauge('generation_cache_hit_rate', lambda: generation_cache.hit_rate, "Доля попаданий в кэш генераций")
+metrics.gauge('llm_circuit_open', lambda: int(llm_gateway.breaker.state != 'closed'), "Цепь LLM разомкнута (1) или замкнута (0)")
+metrics.gauge('token_budget_used', lambda: token_budget.used, "Токены LLM, израсходованные за последнюю минуту")
+
+# Запуск HTTP-эндпоинта метрик
+async def on_startup(application) -> None:
+    global metrics_runner
+    # Таблица эфемерид открывается (при первом запуске - рассчитывается) до первых обновлений
+    await asyncio.to_thread(lambda: chart_engine.ephemeris.table)
+    if METRICS_PORT:
+        # У шардов эндпоинты на соседних портах: METRICS_PORT + номер шарда
+        metrics_runner = await start_metrics_server(metrics, METRICS_HOST, METRICS_PORT + (SHARD_INDEX or 0))
+
+# Освобождение ресурсов при остановке бота
+async def on_shutdown(application) -> None:
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await llm_client.aclose()
+    transcription_pipeline.shutdown()
+    await user_cache.flush()
+    await token_usage.flush()
+    await quota_limiter.save()
+    user_store.close()
+    generation_cache.close()
+    opener_pool.close()
+    summarizer.close()
+    session_store.close()
+    job_lease.close()
+    chat_history_store.close()
+
+# Сборка приложения со всеми обработчиками и фоновыми задачами
+def build_application(builder=None, update_processor=None):
+    application = (
+        (builder or ApplicationBuilder())
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(update_processor or CONCURRENT_UPDATES)
+        .persistence(session_persistence)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    application.add_handler(MessageHandler(filters.VOICE, queue_voice_message))
 
     # Обработчики команд
     application.add_handler(CommandHandler('start', start))
@@ -792,6 +1012,7 @@ def main() -> None:
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("unsubscribe", unsubscribe))
     application.add_handler(CommandHandler("clear_birth_data", clear_birth_data_command))
+    application.add_handler(CommandHandler("token_stats", token_stats_command))
 
     feedback_handler = ConversationHandler(
         entry_points=[CommandHandler('feedback', feedback_command)],
@@ -804,10 +1025,91 @@ def main() -> None:
 
     # Обработчики нажатий кнопок
     application.add_handler(CallbackQueryHandler(button_click, pattern='^(tarot|astrology|numerology|self_development_coach|psychologist|career_consultant)$'))
-    application.add_handler(CallbackQueryHandler(handle_psychologist_choice, pattern='^(cbt|psychodynamic|gestalt|unsure)$'))
+    application.add_handler(CallbackQueryHandler(queue_psychologist_choice, pattern='^(cbt|psychodynamic|gestalt|unsure)$'))
 
     # Обработчики сообщений пользователя
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, queue_text_message))
+
+    # Фоновые задачи
+    hour, minute = map(int, BROADCAST_TIME.split(':'))
+    application.job_queue.run_daily(send_daily_horoscopes, time=dt_time(hour, minute, tzinfo=BROADCAST_TIMEZONE))
+    # Продолжение рассылки, прерванной перезапуском
+    progress = BroadcastProgress(BROADCAST_PROGRESS_FILE)
+    progress.load(datetime.now(BROADCAST_TIMEZONE).strftime('%Y-%m-%d'))
+    if progress.interrupted:
+        application.job_queue.run_once(send_daily_horoscopes, when=10)
+    application.job_queue.run_repeating(flush_user_cache, interval=USER_CACHE_FLUSH_INTERVAL, first=USER_CACHE_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(save_quota_snapshot, interval=QUOTA_SNAPSHOT_INTERVAL, first=QUOTA_SNAPSHOT_INTERVAL)
+    application.job_queue.run_repeating(purge_generation_cache, interval=24 * 60 * 60, first=120)
+    application.job_queue.run_repeating(refresh_opener_pool, interval=60 * 60, first=5)
+    application.job_queue.run_repeating(compact_chat_history, interval=24 * 60 * 60, first=60)
+    return application
+
+# Точка входа процесса-шарда: обновления приходят от диспетчера
+def run_shard(updates) -> None:
+    application = build_application()
+    asyncio.run(run_shard_worker(application, updates, drain=user_queue.drain))
+
+# Прием обновлений в процессе-диспетчере и раздача их шардам до SIGINT/SIGTERM
+async def dispatch_updates(dispatcher) -> None:
+    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    await application.initialize()
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    server = polling = None
+    if BOT_MODE == 'webhook':
+        server = WebhookServer(application, WEBHOOK_URL, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                               host=WEBHOOK_HOST, port=WEBHOOK_PORT, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                               on_update=dispatcher.route)
+        await server.start()
+    else:
+        polling = asyncio.create_task(dispatcher.poll(application.bot))
+    try:
+        await stop_event.wait()
+    finally:
+        if server is not None:
+            await server.stop()
+        if polling is not None:
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+        await application.shutdown()
+
+def run_sharded() -> None:
+    # Таблица эфемерид рассчитывается один раз до запуска шардов, шарды только открывают готовый файл
+    chart_engine.ephemeris.table
+    dispatcher = ShardDispatcher(SHARD_COUNT, run_shard, max_queue=SHARD_QUEUE_SIZE)
+    dispatcher.start()
+    try:
+        asyncio.run(dispatch_updates(dispatcher))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Остановка шардов: дорабатываем принятые обновления")
+        dispatcher.stop()
+
+# Основная функция запуска бота
+def main() -> None:
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+    if SHARD_COUNT > 1:
+        run_sharded()
+        return
+    if BOT_MODE == 'webhook':
+        # Не больше WEBHOOK_MAX_QUEUE принятых и необработанных обновлений: сверх них webhook отвечает 503
+        # и Telegram повторит доставку
+        application = build_application(update_processor=PendingUpdatesProcessor(CONCURRENT_UPDATES, WEBHOOK_MAX_QUEUE))
+        server = WebhookServer(application, WEBHOOK_URL, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                               host=WEBHOOK_HOST, port=WEBHOOK_PORT, max_connections=WEBHOOK_MAX_CONNECTIONS)
+        metrics.gauge('webhook_queue_size', lambda: server.pending, "Принятые обновления, обработка которых не закончилась")
+        asyncio.run(run_webhook(application, server, drain=user_queue.drain))
+        return
+
+    application = build_application()
 
     # Запуск бота
     application.run_polling()
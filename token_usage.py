@@ -0,0 +1,69 @@
+import asyncio
+import functools
+import logging
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_MODEL = "gpt-4o-mini"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=TOKENIZER_MODEL):
+    """Создает кодировщик tiktoken один раз на модель."""
+    return tiktoken.encoding_for_model(model)
+
+
+# Функция для подсчета токенов
+def count_tokens(text):
+    if isinstance(text, list):
+        # Список messages: считаем содержимое всех сообщений
+        return sum(count_tokens(message['content']) for message in text)
+    return len(get_encoding().encode(text or ''))
+
+
+class TokenUsage:
+    """Счетчики токенов запроса и ответа по пользователям и ролям.
+
+    Счетчики копятся в памяти и пачкой прибавляются к таблице token_usage
+    в UserStore при вызове flush.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._pending = {}
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, user_id, role, prompt_tokens, completion_tokens):
+        key = (user_id, role or 'default')
+        counters = self._pending.setdefault(key, [0, 0, 0])
+        counters[0] += prompt_tokens
+        counters[1] += completion_tokens
+        counters[2] += 1
+
+    def totals_by_role(self):
+        """Итоги по ролям с учетом еще не сброшенных счетчиков."""
+        totals = {role: dict(stats) for role, stats in self.store.token_usage_by_role().items()}
+        for (_, role), (prompt_tokens, completion_tokens, requests) in self._pending.items():
+            stats = totals.setdefault(role, {'prompt_tokens': 0, 'completion_tokens': 0, 'requests': 0})
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+            stats['requests'] += requests
+        return totals
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            rows = [(user_id, role, *counters) for (user_id, role), counters in pending.items()]
+            try:
+                await asyncio.to_thread(self.store.add_token_usage, rows)
+            except Exception:
+                for user_id, role, prompt_tokens, completion_tokens, requests in rows:
+                    counters = self._pending.setdefault((user_id, role), [0, 0, 0])
+                    counters[0] += prompt_tokens
+                    counters[1] += completion_tokens
+                    counters[2] += requests
+                raise
+            return len(rows)
@@ -0,0 +1,147 @@
+import asyncio
+import io
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptionError(Exception):
+    """Базовая ошибка распознавания голосового сообщения."""
+
+
+class TranscriptionBusy(TranscriptionError):
+    """Очередь распознавания заполнена или у пользователя уже есть сообщение в обработке."""
+
+
+class AudioTooLong(TranscriptionError):
+    """Голосовое сообщение длиннее допустимого."""
+
+
+class AudioDecodeError(TranscriptionError):
+    """Не удалось сконвертировать OGG в WAV."""
+
+
+class SpeechNotRecognized(TranscriptionError):
+    """Речь в сообщении не распознана."""
+
+
+class RecognizerUnavailable(TranscriptionError):
+    """Сервис распознавания речи недоступен."""
+
+
+class GoogleRecognizer:
+    """Распознавание через Google Web Speech API (библиотека SpeechRecognition)."""
+
+    def recognize(self, wav_bytes: bytes, language: str) -> str:
+        import speech_recognition as sr
+        recognizer = sr.Recognizer()
+        try:
+            with sr.AudioFile(io.BytesIO(wav_bytes)) as source:
+                audio_data = recognizer.record(source)
+            return recognizer.recognize_google(audio_data, language=language)
+        except sr.UnknownValueError as e:
+            raise SpeechNotRecognized(str(e))
+        except sr.RequestError as e:
+            raise RecognizerUnavailable(str(e))
+
+
+class StubRecognizer:
+    """Локальная заглушка распознавания для тестов и нагрузочных прогонов."""
+
+    def __init__(self, text="Что меня ждет завтра?"):
+        self.text = text
+
+    def recognize(self, wav_bytes: bytes, language: str) -> str:
+        return self.text
+
+
+RECOGNIZERS = {
+    'google': GoogleRecognizer,
+    'stub': StubRecognizer,
+}
+
+
+class TranscriptionResult(NamedTuple):
+    text: str
+    duration: float
+    decode_seconds: float
+    recognize_seconds: float
+
+
+def _decode_job(ogg_bytes: bytes, max_duration: float):
+    """Конвертирует OGG в WAV. Выполняется в пуле воркеров."""
+    from pydub import AudioSegment
+    started = time.perf_counter()
+    try:
+        audio = AudioSegment.from_file(io.BytesIO(ogg_bytes), format="ogg")
+    except Exception as e:
+        raise AudioDecodeError(str(e))
+    duration = len(audio) / 1000
+    if max_duration and duration > max_duration:
+        raise AudioTooLong(f"{duration:.1f} с")
+    wav_io = io.BytesIO()
+    audio.export(wav_io, format="wav")
+    return wav_io.getvalue(), duration, time.perf_counter() - started
+
+
+def _recognize_job(recognizer, wav_bytes: bytes, language: str):
+    """Распознает речь в WAV. Выполняется в пуле воркеров."""
+    started = time.perf_counter()
+    text = recognizer.recognize(wav_bytes, language)
+    return text, time.perf_counter() - started
+
+
+class TranscriptionPipeline:
+    """Конвертация и распознавание голосовых сообщений в ограниченном пуле потоков или процессов.
+
+    Ограничивает общее число сообщений в очереди (max_queue), число сообщений
+    одного пользователя в обработке (max_per_user) и длительность аудио.
+    """
+
+    def __init__(self, recognizer, max_workers=2, max_queue=20, max_per_user=1, max_duration=120,
+                 language="ru-RU", use_processes=False):
+        self.recognizer = recognizer
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_duration = max_duration
+        self.language = language
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self._executor = executor_class(max_workers=max_workers)
+        self._queued = 0
+        self._per_user = {}
+
+    @property
+    def queue_depth(self):
+        return self._queued
+
+    async def transcribe(self, user_id: int, ogg_bytes: bytes, duration_hint: float = None) -> TranscriptionResult:
+        if duration_hint and self.max_duration and duration_hint > self.max_duration:
+            raise AudioTooLong(f"{duration_hint} с")
+        if self._queued >= self.max_queue:
+            raise TranscriptionBusy("очередь распознавания заполнена")
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            raise TranscriptionBusy("у пользователя уже есть сообщение в обработке")
+
+        self._queued += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        try:
+            loop = asyncio.get_running_loop()
+            wav_bytes, duration, decode_seconds = await loop.run_in_executor(
+                self._executor, _decode_job, ogg_bytes, self.max_duration)
+            text, recognize_seconds = await loop.run_in_executor(
+                self._executor, _recognize_job, self.recognizer, wav_bytes, self.language)
+        finally:
+            self._queued -= 1
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+
+        logger.debug(f"Голосовое сообщение {duration:.1f} с: конвертация {decode_seconds:.2f} с, "
+                     f"распознавание {recognize_seconds:.2f} с")
+        return TranscriptionResult(text, duration, decode_seconds, recognize_seconds)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
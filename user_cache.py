@@ -0,0 +1,99 @@
+import asyncio
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """Кэш записей пользователей в памяти с отложенной пакетной записью в UserStore.
+
+    Все пользователи загружаются один раз при запуске. Изменения помечаются как
+    грязные и сбрасываются в хранилище пачками не больше max_batch записей по
+    таймеру и при остановке. Каждая пачка пишется одной транзакцией SQLite, поэтому
+    после сбоя в базе остается либо старое, либо новое состояние записи.
+
+    Новые записи (put) пишутся целиком, у существующих (update) - только
+    измененные поля, поэтому сброс не затирает поля, которые в хранилище
+    изменил другой процесс (например, отписку пользователя чужого шарда).
+    """
+
+    def __init__(self, store, max_batch=500):
+        self.store = store
+        self.max_batch = max_batch
+        self._users = {}
+        # user_id -> измененные поля или None, если запись пишется целиком
+        self._dirty = {}
+        self._flush_lock = asyncio.Lock()
+
+    def load(self, owns=None):
+        """Загружает пользователей из хранилища (только тех, для кого owns(user_id) истинно, если задан)."""
+        self._users = {user['user_id']: user for user in self.store.all_users()
+                       if owns is None or owns(user['user_id'])}
+        self._dirty.clear()
+        logger.info(f"В кэш загружено {len(self._users)} пользователей")
+
+    def get(self, user_id):
+        return self._users.get(user_id)
+
+    def put(self, user):
+        self._users[user['user_id']] = user
+        self._dirty[user['user_id']] = None
+
+    def update(self, user_id, **fields):
+        """Обновляет поля пользователя. Возвращает False, если пользователь не найден."""
+        user = self._users.get(user_id)
+        if user is None:
+            return False
+        user.update(fields)
+        self._mark_dirty(user_id, set(fields))
+        return True
+
+    def _mark_dirty(self, user_id, fields):
+        if user_id in self._dirty and self._dirty[user_id] is None:
+            return
+        self._dirty[user_id] = None if fields is None else self._dirty.get(user_id, set()) | fields
+
+    def subscribed_users(self):
+        return [dict(user) for user in self._users.values()
+                if user.get('subscribe') and user.get('date_of_birth')
+                and user.get('time_of_birth') and user.get('place_of_birth')]
+
+    def all_users(self):
+        return [dict(user) for user in self._users.values()]
+
+    @property
+    def dirty_count(self):
+        return len(self._dirty)
+
+    async def flush(self):
+        """Сбрасывает все грязные записи в хранилище пачками по max_batch."""
+        async with self._flush_lock:
+            written = 0
+            while self._dirty:
+                batch_ids = list(itertools.islice(self._dirty, self.max_batch))
+                batch_fields = [self._dirty.pop(user_id) for user_id in batch_ids]
+                # Снимок делается в цикле событий, запись - в отдельном потоке
+                rows, updates = [], []
+                for user_id, fields in zip(batch_ids, batch_fields):
+                    user = self._users[user_id]
+                    if fields is None:
+                        rows.append(dict(user))
+                    else:
+                        updates.append((user_id, {field: user.get(field) for field in fields}))
+                try:
+                    await asyncio.to_thread(self._write_batch, rows, updates)
+                except Exception:
+                    for user_id, fields in zip(batch_ids, batch_fields):
+                        self._mark_dirty(user_id, fields)
+                    raise
+                written += len(batch_ids)
+            if written:
+                logger.info(f"Сброшено в хранилище {written} записей пользователей")
+            return written
+
+    def _write_batch(self, rows, updates):
+        if rows:
+            self.store.upsert_many(rows)
+        if updates:
+            self.store.update_many(updates)
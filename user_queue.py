@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    __slots__ = ('handler', 'args', 'text', 'merge_if', 'behind', 'future', 'created')
+
+    def __init__(self, handler, args, text, merge_if, behind):
+        self.handler = handler
+        self.args = args
+        self.text = text
+        self.merge_if = merge_if
+        # Поставлен, пока у пользователя уже было необработанное обновление
+        self.behind = behind
+        self.future = asyncio.get_running_loop().create_future()
+        self.created = time.monotonic()
+
+
+class UserUpdateQueue:
+    """Очередь обработки обновлений по пользователям.
+
+    Обновления одного пользователя выполняются строго по очереди, разные
+    пользователи обрабатываются параллельно. Сообщение, пришедшее, когда у
+    пользователя ничего не обрабатывается, выполняется сразу. Текстовые
+    сообщения, накопившиеся за время обработки предыдущего, склеиваются в один
+    вызов обработчика, если пауза между ними меньше coalesce_window секунд (но
+    ожидание не дольше max_wait секунд от первого сообщения).
+    Рабочая задача пользователя живет, только пока у него есть необработанные
+    обновления.
+    """
+
+    def __init__(self, coalesce_window=1.5, max_wait=5.0, max_coalesce=5):
+        self.coalesce_window = coalesce_window
+        self.max_wait = max_wait
+        self.max_coalesce = max_coalesce
+        self.coalesced = 0
+        self._pending = {}
+        self._workers = {}
+
+    async def run(self, user_id, handler, *args, text=None, merge_if=None):
+        """Ставит вызов handler(*args) в очередь пользователя и ждет его выполнения.
+
+        Если передан text, вызов можно склеить с соседними: обработчик получит
+        аргументы последнего сообщения и объединенный текст последним аргументом.
+        merge_if() проверяется перед склейкой, когда предыдущие обновления уже
+        обработаны: False - сообщение обрабатывается отдельно.
+        """
+        job = _Job(handler, args, text, merge_if, behind=user_id in self._workers)
+        self._pending.setdefault(user_id, deque()).append(job)
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.get_running_loop().create_task(self._worker(user_id))
+        return await asyncio.shield(job.future)
+
+    async def drain(self):
+        """Дожидается обработки всех поставленных в очередь обновлений."""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    @property
+    def active_users(self):
+        return len(self._workers)
+
+    async def _worker(self, user_id):
+        pending = self._pending[user_id]
+        try:
+            while pending:
+                job = pending[0]
+                if not self._mergeable(job):
+                    pending.popleft()
+                    batch = [job]
+                    call = job.handler(*job.args) if job.text is None else job.handler(*job.args, job.text)
+                else:
+                    batch = await self._collect_texts(pending)
+                    last = batch[-1]
+                    call = last.handler(*last.args, '\n'.join(item.text for item in batch))
+                try:
+                    result = await call
+                except Exception as e:
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                else:
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_result(result)
+        finally:
+            del self._pending[user_id]
+            del self._workers[user_id]
+
+    async def _collect_texts(self, pending):
+        """Ждет паузы в сообщениях и забирает из начала очереди подряд идущие тексты."""
+        deadline = pending[0].created + self.max_wait
+        while True:
+            texts = self._leading_texts(pending)
+            quiet_until = texts[-1].created + self.coalesce_window
+            wait = min(quiet_until, deadline) - time.monotonic()
+            if wait <= 0 or len(texts) >= self.max_coalesce or len(texts) < len(pending):
+                break
+            await asyncio.sleep(wait)
+        batch = [pending.popleft() for _ in texts]
+        if len(batch) > 1:
+            self.coalesced += len(batch) - 1
+            logger.debug(f"Склеено {len(batch)} сообщений пользователя в один запрос")
+        return batch
+
+    @staticmethod
+    def _mergeable(job):
+        return job.text is not None and job.behind and (job.merge_if is None or job.merge_if())
+
+    def _leading_texts(self, pending):
+        texts = []
+        for job in pending:
+            if not self._mergeable(job) or len(texts) >= self.max_coalesce:
+                break
+            texts.append(job)
+        return texts
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Поля записи пользователя в порядке колонок таблицы
+USER_FIELDS = (
+    'user_id', 'username', 'registration_date', 'last_active', 'tokens_used',
+    'date_of_birth', 'time_of_birth', 'place_of_birth', 'subscribe',
+    'daily_requests', 'last_request_date'
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    registration_date TEXT,
+    last_active TEXT,
+    tokens_used INTEGER NOT NULL DEFAULT 0,
+    date_of_birth TEXT,
+    time_of_birth TEXT,
+    place_of_birth TEXT,
+    subscribe INTEGER NOT NULL DEFAULT 1,
+    daily_requests INTEGER NOT NULL DEFAULT 0,
+    last_request_date TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_subscribe ON users (subscribe);
+CREATE INDEX IF NOT EXISTS idx_users_last_request_date ON users (last_request_date);
+CREATE TABLE IF NOT EXISTS token_usage (
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    requests INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, role)
+);
+"""
+
+
+def _row_to_user(row):
+    user = dict(row)
+    user['subscribe'] = bool(user['subscribe'])
+    return user
+
+
+class UserStore:
+    """Хранилище пользователей в SQLite (WAL) с доступом по user_id."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    def get(self, user_id):
+        """Возвращает запись пользователя или None."""
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return _row_to_user(row) if row else None
+
+    def upsert_many(self, users):
+        """Записывает несколько пользователей в одной транзакции."""
+        placeholders = ', '.join('?' for _ in USER_FIELDS)
+        updates = ', '.join(f'{field} = excluded.{field}' for field in USER_FIELDS[1:])
+        sql = (f"INSERT INTO users ({', '.join(USER_FIELDS)}) VALUES ({placeholders}) "
+               f"ON CONFLICT(user_id) DO UPDATE SET {updates}")
+        rows = [tuple(user.get(field) for field in USER_FIELDS) for user in users]
+        with self._lock, self._conn:
+            self._conn.executemany(sql, rows)
+
+    def update(self, user_id, **fields):
+        """Обновляет отдельные поля пользователя. Возвращает False, если пользователь не найден."""
+        sql = self._update_sql(fields)
+        with self._lock, self._conn:
+            cursor = self._conn.execute(sql, (*fields.values(), user_id))
+        return cursor.rowcount > 0
+
+    def update_many(self, updates):
+        """Обновляет отдельные поля нескольких пользователей в одной транзакции: updates - пары (user_id, поля)."""
+        statements = [(self._update_sql(fields), (*fields.values(), user_id)) for user_id, fields in updates]
+        with self._lock, self._conn:
+            for sql, params in statements:
+                self._conn.execute(sql, params)
+
+    @staticmethod
+    def _update_sql(fields):
+        unknown = set(fields) - set(USER_FIELDS[1:])
+        if unknown:
+            raise ValueError(f"Неизвестные поля пользователя: {', '.join(sorted(unknown))}")
+        return f"UPDATE users SET {', '.join(f'{field} = ?' for field in fields)} WHERE user_id = ?"
+
+    def subscribed_users(self):
+        """Возвращает подписанных на рассылку пользователей с заполненными данными о рождении."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM users WHERE subscribe = 1 AND date_of_birth IS NOT NULL "
+                "AND time_of_birth IS NOT NULL AND place_of_birth IS NOT NULL"
+            ).fetchall()
+        return [_row_to_user(row) for row in rows]
+
+    def all_users(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM users').fetchall()
+        return [_row_to_user(row) for row in rows]
+
+    def add_token_usage(self, rows):
+        """Прибавляет счетчики токенов: rows - кортежи (user_id, role, prompt, completion, requests)."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO token_usage (user_id, role, prompt_tokens, completion_tokens, requests) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id, role) DO UPDATE SET "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "requests = requests + excluded.requests",
+                rows
+            )
+
+    def token_usage_by_role(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens, "
+                "SUM(requests) AS requests FROM token_usage GROUP BY role"
+            ).fetchall()
+        return {row['role']: {'prompt_tokens': row['prompt_tokens'], 'completion_tokens': row['completion_tokens'],
+                              'requests': row['requests']} for row in rows}
+
+    def migrate_from_jsonl(self, file_path):
+        """Однократно переносит пользователей из старого user_data.json (по записи в строке)."""
+        if not os.path.exists(file_path):
+            return 0
+        with self._lock:
+            has_users = self._conn.execute('SELECT 1 FROM users LIMIT 1').fetchone()
+        if has_users:
+            logger.warning(f"Файл {file_path} не перенесен: в базе {self.db_path} уже есть пользователи")
+            return 0
+
+        users = []
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                user = json.loads(line)
+                user.setdefault('tokens_used', 0)
+                user.setdefault('subscribe', True)
+                user.setdefault('daily_requests', 0)
+                users.append(user)
+        self.upsert_many(users)
+        os.replace(file_path, file_path + '.migrated')
+        logger.info(f"Перенесено {len(users)} пользователей из {file_path} в {self.db_path}")
+        return len(users)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,172 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class PendingUpdatesProcessor(SimpleUpdateProcessor):
+    """Обработчик обновлений приложения, который считает принятые, но еще не обработанные обновления.
+
+    Application с concurrent_updates сразу забирает обновление из update_queue
+    и запускает для него задачу, поэтому очередь не отражает нагрузку. Счетчик
+    pending растет при приеме обновления (try_accept) и уменьшается, когда его
+    обработка закончилась, включая ожидание свободного слота max_concurrent_updates.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending):
+        super().__init__(max_concurrent_updates)
+        self.max_pending = max_pending
+        self.pending = 0
+
+    def try_accept(self):
+        """Резервирует место для нового обновления. False - обработчики перегружены."""
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        return True
+
+    async def do_process_update(self, update, coroutine):
+        try:
+            await coroutine
+        finally:
+            self.pending -= 1
+
+
+class WebhookServer:
+    """Прием обновлений Telegram через webhook на встроенном HTTP-сервере (aiohttp).
+
+    Обработчик запроса только проверяет секретный токен, разбирает обновление
+    и кладет его в update_queue приложения, после чего сразу отвечает 200.
+    Обработку из очереди ведет само приложение (Application.start) с его
+    ограничением concurrent_updates. Если приложение собрано с
+    PendingUpdatesProcessor, число принятых и еще не обработанных обновлений
+    ограничено его max_pending: сверх него отвечаем 503, и Telegram повторит
+    доставку позже.
+
+    Если задан on_update(data), JSON обновления передается ему вместо очереди
+    приложения (так диспетчер шардов раздает обновления процессам); False в
+    ответ означает, что получатель перегружен.
+    """
+
+    def __init__(self, application, url, path='/telegram', secret_token=None, host='0.0.0.0', port=8080,
+                 max_connections=40, on_update=None):
+        self.application = application
+        self.on_update = on_update
+        self.url = url.rstrip('/') + path
+        self.path = path
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.accepted = 0
+        self.rejected = 0
+        self._runner = None
+        self._stopping = False
+
+    async def _handle_update(self, request):
+        from aiohttp import web
+
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            logger.warning(f"Запрос к webhook с неверным секретным токеном от {request.remote}")
+            return web.Response(status=403)
+        if self._stopping:
+            return web.Response(status=503)
+        try:
+            data = json.loads(await request.read())
+            update = None if self.on_update else Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"Некорректное обновление в webhook: {e}")
+            return web.Response(status=400)
+        if self.on_update:
+            if not self.on_update(data):
+                self.rejected += 1
+                return web.Response(status=503)
+        else:
+            processor = self.application.update_processor
+            if isinstance(processor, PendingUpdatesProcessor) and not processor.try_accept():
+                self.rejected += 1
+                return web.Response(status=503)
+            self.application.update_queue.put_nowait(update)
+        self.accepted += 1
+        return web.Response()
+
+    async def _handle_health(self, request):
+        from aiohttp import web
+
+        status = 503 if self._stopping else 200
+        return web.json_response({'queue': self.pending, 'accepted': self.accepted,
+                                  'rejected': self.rejected}, status=status)
+
+    @property
+    def pending(self):
+        """Принятые обновления, обработка которых еще не закончилась."""
+        processor = self.application.update_processor
+        if isinstance(processor, PendingUpdatesProcessor):
+            return processor.pending
+        return self.application.update_queue.qsize()
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post(self.path, self._handle_update)
+        app.router.add_get('/healthz', self._handle_health)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        await self.application.bot.set_webhook(url=self.url, secret_token=self.secret_token,
+                                               allowed_updates=Update.ALL_TYPES, max_connections=self.max_connections)
+        logger.info(f"Webhook {self.url} принимает обновления на {self.host}:{self.port}")
+
+    async def stop(self):
+        """Перестает принимать обновления. Webhook в Telegram не удаляется: пока бот
+        перезапускается, обновления копятся на стороне Telegram."""
+        self._stopping = True
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def run_webhook(application, server, drain=None, drain_timeout=30.0):
+    """Запускает приложение в режиме webhook до SIGINT/SIGTERM и корректно останавливает его.
+
+    При остановке сначала закрывается прием, затем приложение дорабатывает
+    обновления из очереди, drain() дожидается уже начатых обработчиков, и в
+    конце post_shutdown сбрасывает накопленное состояние на диск.
+    """
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows: остановка только по Ctrl+C через KeyboardInterrupt
+            pass
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка webhook: дорабатываем принятые обновления")
+        await server.stop()
+        await application.stop()
+        if drain is not None:
+            try:
+                await asyncio.wait_for(drain(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не все обработчики завершились за {drain_timeout} с")
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)